@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import paho.mqtt.client as mqtt
+import asyncio
+import threading
+from Mqtt import Mqtt, Beebotte
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+class AsyncMqtt:
+    '''
+    asyncio client on top of ``Mqtt`` (or its subclass, e.g. ``Beebotte``)
+
+    The paho client of ``mqtt`` is driven by the event loop
+    (add_reader/add_writer) instead of the ``loop_start()`` thread.
+    The timer threads of ``mqtt`` (``pub_rate``, ``batch_size``)
+    are started by ``start()``, and pending data are sent by ``end()``.
+    ``data2payload()``, ``payload2data()`` and ``get_ts()`` of ``mqtt``
+    are used as they are.
+
+    usage:
+      amqtt = AsyncMqtt(Beebotte(None, ['ch1/res1'], 'token_XXXX'))
+      await amqtt.start()
+
+      await amqtt.send_data(data, 'ch1/res1')
+
+      async for (data, topic, ts) in amqtt:
+          ...
+
+      await amqtt.end()
+
+    If ``mqtt`` has a callback function (not ``CB_QPUT``),
+    it is called too.
+    '''
+    MISC_INTERVAL = 1  # sec
+    END_TIMEOUT = 5  # sec
+
+    _log = get_logger(__name__, False)
+
+    def __init__(self, mqtt_obj, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('mqtt_obj=%s', mqtt_obj)
+
+        self._mqtt = mqtt_obj
+        self._mqttc = mqtt_obj._mqttc
+
+        self._cb_user = mqtt_obj._cb_recv
+        if self._cb_user == mqtt_obj.cb_qput:
+            self._cb_user = None
+        mqtt_obj._cb_recv = self._cb_recv
+
+        self._mqttc.on_connect = self._on_connect
+        self._mqttc.on_disconnect = self._on_disconnect
+        self._mqttc.on_publish = self._on_publish
+        self._mqttc.on_socket_open = self._on_socket_open
+        self._mqttc.on_socket_close = self._on_socket_close
+        self._mqttc.on_socket_register_write = self._on_socket_reg_write
+        self._mqttc.on_socket_unregister_write = self._on_socket_unreg_write
+
+        self._loop = None
+        self._loop_th = None  # thread id of the event loop
+        self._misc = None
+        self._dataq = None
+        self._con_fut = None
+        self._discon_fut = None
+        self._pub_fut = {}  # {mid: Future}
+        self._pub_sending = False  # in publish() of send_data(wait=True)
+        self._pub_acked = set()  # mids acked in that publish()
+
+    @property
+    def active(self):
+        return self._mqtt.active
+
+    async def start(self):
+        '''
+        return: rc of CONNACK
+        raise: ConnectionError  disconnected before CONNACK
+        '''
+        self._log.debug('')
+
+        self._loop = asyncio.get_running_loop()
+        self._loop_th = threading.get_ident()
+        self._dataq = asyncio.Queue()
+        self._con_fut = self._loop.create_future()
+
+        # DNS lookup and TCP handshake block: run them in a thread.
+        # socket callbacks are passed to the event loop by _in_loop()
+        await self._loop.run_in_executor(
+            None, self._mqttc.connect,
+            self._mqtt._host, self._mqtt._port, 60)
+
+        rc = await self._con_fut
+        if rc == 0:
+            self._mqtt.active = True
+            self._mqtt._start_senders()
+
+        self._log.debug('done: rc=%s', rc)
+        return rc
+
+    async def end(self):
+        self._log.debug('')
+
+        # pending data of the limiter/batcher are sent before disconnect
+        self._mqtt._end_senders()
+        self._mqtt.active = False
+
+        self._discon_fut = self._loop.create_future()
+        self._mqttc.disconnect()
+        try:
+            await asyncio.wait_for(self._discon_fut, self.END_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._log.warning('disconnect: timeout')
+
+        self._dataq.put_nowait(None)  # stop iterators
+
+        self._log.debug('done')
+
+    async def send_data(self, data, topics, qos=0, retain=False, wait=True):
+        '''
+        wait: wait for PUBACK (QoS 1, 2) or sending (QoS 0)
+
+        return: [MQTTMessageInfo or None(spooled), ..]
+        raise: ConnectionError  disconnected while waiting
+        '''
+        self._log.debug('data=%a, topics=%s, qos=%s', data, topics, qos)
+
+        if not wait:
+            return self._mqtt.send_data(data, topics, qos=qos, retain=retain)
+
+        # QoS 0 messages may be acked (sent) in publish(),
+        # before the futures are registered below
+        self._pub_sending = True
+        try:
+            rets = self._mqtt.send_data(data, topics, qos=qos, retain=retain)
+        finally:
+            self._pub_sending = False
+            acked = self._pub_acked
+            self._pub_acked = set()
+
+        futs = []
+        for ret in rets:
+            if ret is None:
+                # spooled
+                continue
+            if ret.rc != 0:
+                self._log.error('publish: rc=%s', ret.rc)
+                continue
+            if ret.mid in acked:
+                continue
+            fut = self._loop.create_future()
+            self._pub_fut[ret.mid] = fut
+            futs.append(fut)
+
+        if len(futs) > 0:
+            await asyncio.gather(*futs)
+
+        self._log.debug('done')
+        return rets
+
+    async def recv_data(self, timeout=None):
+        '''
+        return: (data, topic, ts) or None(timeout or end)
+        '''
+        try:
+            return await asyncio.wait_for(self._dataq.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        ret = await self._dataq.get()
+        if ret is None:
+            self._dataq.put_nowait(None)  # for other iterators
+            raise StopAsyncIteration
+        return ret
+
+    def _cb_recv(self, data, topic, ts):
+        self._dataq.put_nowait((data, topic, ts))
+
+        if self._cb_user is not None:
+            self._cb_user(data, topic, ts)
+
+    def _on_connect(self, client, userdata, flag, rc):
+        self._mqtt._on_connect(client, userdata, flag, rc)
+
+        if self._con_fut is not None and not self._con_fut.done():
+            self._con_fut.set_result(rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self._mqtt._on_disconnect(client, userdata, rc)
+
+        # no reconnect: waiters would never be resolved
+        err = ConnectionError('disconnected: rc=%s' % rc)
+        if self._con_fut is not None and not self._con_fut.done():
+            self._con_fut.set_exception(err)
+        futs = self._pub_fut
+        self._pub_fut = {}
+        for fut in futs.values():
+            if not fut.done():
+                fut.set_exception(err)
+
+        if self._discon_fut is not None and not self._discon_fut.done():
+            self._discon_fut.set_result(rc)
+
+    def _on_publish(self, client, userdata, mid):
+        self._mqtt._on_publish(client, userdata, mid)
+        # limiter/batcher threads publish and get acks on their threads
+        self._in_loop(self._pub_done, mid)
+
+    def _pub_done(self, mid):
+        fut = self._pub_fut.pop(mid, None)
+        if fut is None:
+            if self._pub_sending:
+                # acked in publish() before send_data() registered it
+                self._pub_acked.add(mid)
+            return
+        if not fut.done():
+            fut.set_result(mid)
+
+    def _in_loop(self, func, *args):
+        '''
+        call ``func`` on the event loop thread
+        (socket callbacks are called on the connect() thread, too)
+        '''
+        if threading.get_ident() == self._loop_th:
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._log.debug('sock=%s', sock)
+        self._in_loop(self._socket_open, client, sock)
+
+    def _socket_open(self, client, sock):
+        self._loop.add_reader(sock, client.loop_read)
+        self._misc = self._loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._log.debug('sock=%s', sock)
+        self._in_loop(self._socket_close, sock)
+
+    def _socket_close(self, sock):
+        self._loop.remove_reader(sock)
+        if self._misc is not None:
+            self._misc.cancel()
+            self._misc = None
+
+    def _on_socket_reg_write(self, client, userdata, sock):
+        self._in_loop(self._loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unreg_write(self, client, userdata, sock):
+        self._in_loop(self._loop.remove_writer, sock)
+
+    async def _misc_loop(self):
+        '''
+        keepalive and retry, instead of the loop thread
+        '''
+        while self._mqttc.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(self.MISC_INTERVAL)
+            except asyncio.CancelledError:
+                break
+
+        self._log.debug('done')
+
+
+async def async_main(topics, user, pw, svr_host, beebotte, debug):
+    log = get_logger(__name__, debug=debug)
+
+    if beebotte:
+        mq = Beebotte(None, topics, user, debug=debug)
+    else:
+        mq = Mqtt(None, topics, user, pw, svr_host, debug=debug)
+
+    amqtt = AsyncMqtt(mq, debug=debug)
+    rc = await amqtt.start()
+    if rc != 0:
+        log.error('start(): rc=%s', rc)
+        return
+
+    try:
+        async for (data, topic, ts) in amqtt:
+            if beebotte:
+                ts = Beebotte.ts2datestr(ts)
+            print('%s [%s] %s' % (ts, topic, data))
+    finally:
+        await amqtt.end()
+
+
+@click.command(context_settings=CONTEXT_SETTINGS, help='asyncio MQTT Sample')
+@click.argument('user', type=str)
+@click.argument('topic1', type=str)
+@click.argument('topic2', type=str, nargs=-1)
+@click.option('--password', '-p', 'password', type=str, default='',
+              help='password')
+@click.option('--svr_host', '-s', 'svr_host', type=str,
+              default=Mqtt.DEF_HOST,
+              help='server host name')
+@click.option('--beebotte', '-b', 'beebotte', is_flag=True, default=False,
+              help='Beebotte flag')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(user, topic1, topic2, password, svr_host, beebotte, debug):
+    try:
+        asyncio.run(async_main([topic1] + list(topic2), user, password,
+                               svr_host, beebotte, debug))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
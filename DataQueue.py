@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+DataQueue.py
+
+bounded queue with overflow policies
+
+  policy            when full
+  ----------------  ---------------------------------------------
+  BLOCK             put() waits for get()
+  DROP_OLDEST       the oldest item is dropped
+  DROP_NEWEST       the new item is dropped
+  LATEST            only the latest item is kept per key (topic),
+                    the oldest key is dropped if still full
+
+Usage:
+------
+from DataQueue import DataQueue
+
+q = DataQueue(1000, DataQueue.DROP_OLDEST)
+q.put((data, topic, ts), topic)
+(data, topic, ts) = q.get(timeout=2)  # raise queue.Empty
+items = q.get_many(100, timeout=1)     # [(data, topic, ts), ..]
+------
+
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import queue
+import threading
+import time
+from collections import deque
+
+
+class DataQueue:
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    LATEST = 'latest'
+
+    POLICIES = [BLOCK, DROP_OLDEST, DROP_NEWEST, LATEST]
+
+    def __init__(self, maxsize=0, policy=BLOCK):
+        '''
+        maxsize: 0: unlimited
+        '''
+        if policy not in self.POLICIES:
+            raise ValueError('policy: %a not in %s' % (policy, self.POLICIES))
+
+        self.maxsize = maxsize
+        self.policy = policy
+
+        self._q = deque()   # items, or keys if LATEST
+        self._latest = {}   # {key: item} if LATEST
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self.n_put = 0
+        self.n_dropped = 0
+
+    def qsize(self):
+        return len(self._q)
+
+    def full(self):
+        return self.maxsize > 0 and len(self._q) >= self.maxsize
+
+    def put(self, item, key=None):
+        '''
+        key: for LATEST policy
+
+        return: True if queued
+        '''
+        with self._cond:
+            self.n_put += 1
+
+            if self.policy == self.LATEST:
+                if key in self._latest:
+                    self._latest[key] = item
+                    self.n_dropped += 1
+                    return True
+                if self.full():
+                    del self._latest[self._q.popleft()]
+                    self.n_dropped += 1
+                self._latest[key] = item
+                self._q.append(key)
+                self._cond.notify()
+                return True
+
+            if self.full():
+                if self.policy == self.DROP_NEWEST:
+                    self.n_dropped += 1
+                    return False
+
+                if self.policy == self.DROP_OLDEST:
+                    self._q.popleft()
+                    self.n_dropped += 1
+
+                else:  # BLOCK
+                    while self.full() and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        self.n_dropped += 1
+                        return False
+
+            self._q.append(item)
+            self._cond.notify()
+            return True
+
+    def get(self, block=True, timeout=None):
+        '''
+        raise: queue.Empty
+        '''
+        with self._cond:
+            if not block:
+                timeout = 0
+            if not self._wait(timeout):
+                raise queue.Empty
+
+            return self._pop()
+
+    def get_many(self, max_items, timeout=None):
+        '''
+        return as soon as ``max_items`` items are got
+        or ``timeout`` sec passed.
+
+        return: [item, ..] (may be empty, or the rest if closed)
+        '''
+        ret = []
+        end = None
+        if timeout is not None:
+            end = time.monotonic() + timeout
+
+        with self._cond:
+            while True:
+                n = min(max_items - len(ret), len(self._q))
+                for _ in range(n):
+                    ret.append(self._pop())
+
+                if len(ret) >= max_items or self._closed:
+                    break
+
+                if end is None:
+                    self._cond.wait()
+                    continue
+
+                remain = end - time.monotonic()
+                if remain <= 0:
+                    break
+                self._cond.wait(remain)
+
+        return ret
+
+    def close(self):
+        '''
+        wake up and drop blocking put(),
+        and release get()/get_many() waiting on the empty queue
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def open(self):
+        with self._cond:
+            self._closed = False
+
+    def stats(self):
+        with self._cond:
+            return {'depth': len(self._q), 'maxsize': self.maxsize,
+                    'policy': self.policy,
+                    'put': self.n_put, 'dropped': self.n_dropped}
+
+    def _wait(self, timeout):
+        '''
+        call with ``_cond`` held
+
+        return: False if timeout, or closed and empty
+        '''
+        if timeout is None:
+            while len(self._q) == 0:
+                if self._closed:
+                    return False
+                self._cond.wait()
+            return True
+
+        end = time.monotonic() + timeout
+        while len(self._q) == 0:
+            if self._closed:
+                return False
+            remain = end - time.monotonic()
+            if remain <= 0:
+                return False
+            self._cond.wait(remain)
+        return True
+
+    def _pop(self):
+        '''
+        call with ``_cond`` held
+        '''
+        item = self._q.popleft()
+        if self.policy == self.LATEST:
+            item = self._latest.pop(item)
+        elif self.policy == self.BLOCK and self.maxsize > 0:
+            self._cond.notify_all()  # wake up put()
+        return item
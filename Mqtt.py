@@ -7,8 +7,17 @@ __date__   = '2020'
 
 import paho.mqtt.client as mqtt
 import time
-import json
 import queue
+from collections import deque
+from MqttCodec import TopicCodecs
+from TopicTrie import TopicTrie
+from DataQueue import DataQueue
+from MqttBatch import Batcher
+from MqttLimiter import PubLimiter
+from MqttStats import LatencyHist
+from MqttMsg import MqttMsg
+from MqttFilter import FilterSet
+from MqttCompress import get_compressor
 from MyLogger import get_logger
 import click
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
@@ -22,32 +31,96 @@ class Mqtt:
     キューを介して同期的にデータ受信する場合は、
     _cb_recvに``Mqtt.CB_QPUT``を指定して、
     ``recv_data()`` で受信する。
+    キューの最大長は``q_maxsize``(0:無制限)、
+    溢れた時の動作は``q_policy`` (``DataQueue``参照)。
+    破棄した件数などは、``qstats()``。
+    キューには受信したbytesのまま入れて、``recv_data()``で
+    デコードする。デコードせずに受け取る場合は、``recv_msg()``
+    (``MqttMsg``)。
+
+    ``latency``をTrue(または``[topic_filter, ..]``)にすると、
+    topic毎に配信遅延(msec)を集計し、
+    ``stats()``で取得できる。``lat_budget``を超えた件数も数える。
+    (送信時刻が分かる``Beebotte``のみ。対象topicのpayloadだけを
+    受信スレッドでデコードする)
+
+    ``metrics``に``MqttStats.Metrics``を指定すると、
+    送受信数、バイト数、送信失敗、再接続、キュー長、
+    コールバック実行時間を記録する。
+
+    ``spool``に``MqttSpool``を指定すると、接続断中のデータを
+    ディスクに保存し、再接続後に送信する。
+
+    ``pub_rate``を指定すると、topic毎に送信頻度を制限する
+    (token bucket: ``pub_rate`` msgs/sec, 最大``pub_burst``)。
+    送信待ちの間に来たデータは、最後の値 (または``pub_reducer``で
+    まとめた値)だけを送る (``MqttLimiter``参照)。
+
+    ``recorder``に``MqttRecorder``を指定すると、受信したメッセージを
+    そのまま記録する。
+
+    ``compress``に``MqttCompress.Compressor``(またはアルゴリズム名)を
+    指定すると、``threshold``以上のpayloadを圧縮して送る。
+    受信側も``compress``を指定すると(``Compressor(None)``: 展開のみ)、
+    圧縮されたpayloadを自動で展開する。展開できないものはそのまま渡す。
+    topic毎の圧縮率、CPU時間は``compress_stats()``。
+
+    ``filters``に``{topic_filter: MqttFilter.MsgFilter}``を指定すると、
+    受信スレッドでキューに入れる前にメッセージをふるい落とす。
+    (``route(.., msg_filter=)``, ``set_filter()``でも指定可)
+    落とした件数は``filter_stats()``と``filtered_total``。
+
+    codec: payloadのエンコード方式 (``MqttCodec``)。
+    topic毎に変える場合は、``set_codec()`` (``+``, ``#`` 使用可)。
+
+    topic毎にコールバック関数を分ける場合は、
+    ``route(topic_filter, cb)`` (``+``, ``#`` 使用可)。
+    ``raw=True``の場合は、デコードせずに``cb(MqttMsg)``。
+    どのrouteにもマッチしないデータは、_cb_recvへ。
 
     '''
     DEF_HOST = 'mqtt.beebotte.com'
     DEF_PORT = 1883
     CB_QPUT = '__Q_PUT__'
+    DEF_CODEC = 'json'
+    SPOOL_ACK_TIMEOUT = 10  # sec
+    SPOOL_WAIT_SEC = 0.5  # check MqttSpool.draining
 
     _log = get_logger(__name__, False)
     # _log.info('%s', __name__)  # for debug
     
     def __init__(self, cb_recv=None, topics_sub=None,
                  user='', pw='', host=DEF_HOST, port=DEF_PORT,
+                 codec=DEF_CODEC,
+                 q_maxsize=0, q_policy=DataQueue.BLOCK,
+                 latency=False, lat_budget=None, metrics=None,
+                 spool=None, recorder=None, filters=None, compress=None,
+                 pub_rate=0, pub_burst=1, pub_reducer=None,
                  debug=False):
         self._dbg = debug
         __class__._log = get_logger(__class__.__name__, self._dbg)
         self._log.debug('cb_recv=%s, topics_sub=%s', cb_recv, topics_sub)
         self._log.debug('user=%s, pw=%s, host=%s, port=%s',
                         user, pw, host, port)
-
+        self._log.debug('codec=%s', codec)
+        self._log.debug('q_maxsize=%s, q_policy=%s', q_maxsize, q_policy)
+        self._log.debug('latency=%s, lat_budget=%s', latency, lat_budget)
+        self._log.debug('metrics=%s, spool=%s', metrics, spool)
+        self._log.debug('recorder=%s, filters=%s', recorder, filters)
+        self._log.debug('compress=%s', compress)
+        self._log.debug('pub_rate=%s, pub_burst=%s, pub_reducer=%s',
+                        pub_rate, pub_burst, pub_reducer)
+
+        self._cb_qput = self.cb_qput  # bound once, see _on_message()
         if cb_recv == self.CB_QPUT:
-            cb_recv = self.cb_qput
+            cb_recv = self._cb_qput
             self._log.debug('cb_recv=%s', cb_recv)
         self._cb_recv = cb_recv
 
         if type(topics_sub) != list:
             topics_sub = [topics_sub]
         self._topics_sub = topics_sub
+        self._sub_qos = {}  # {topic_filter: qos}, default: 0
         self._user = user
         self._pw = pw
         self._host = host
@@ -57,7 +130,44 @@ class Mqtt:
             self._topics_sub = [ self._topics_sub ]
             self._log.warning('self._topics_sub=%s', self._topics_sub)
 
-        self._dataq = queue.Queue()
+        self._dataq = DataQueue(q_maxsize, q_policy)
+
+        self._codecs = TopicCodecs(codec)
+
+        self._routes = TopicTrie()  # {topic_filter: [cb, ..]}
+        self._raw_routes = TopicTrie()  # {topic_filter: [cb, ..]}
+        self._recv_rest = deque()  # rest of a batch for recv_data()
+        self._filters = FilterSet(filters)
+        self._compress = get_compressor(compress)
+
+        self._lat = None  # {topic: LatencyHist}
+        self._lat_topics = None  # TopicTrie, None: all topics
+        if latency and type(self).latency_msec is Mqtt.latency_msec:
+            # decoding payloads on the network thread for nothing
+            self._log.warning('latency: no timestamp in payloads: ignored')
+        elif latency:
+            self._lat = {}
+            if type(latency) == list:
+                self._lat_topics = TopicTrie()
+                for t in latency:
+                    self._lat_topics.add(t, True)
+        self._lat_budget = lat_budget
+
+        self._spool = spool
+        self._recorder = recorder
+
+        self._limiter = None
+        if pub_rate > 0:
+            self._limiter = PubLimiter(self._send_limited,
+                                       pub_rate, pub_burst, pub_reducer)
+
+        self.metrics = metrics
+        if self.metrics is not None:
+            self.metrics.gauge_func('dataq_depth', self._dataq.qsize)
+            if self._spool is not None:
+                self.metrics.gauge_func('spool_pending', self._spool.pending)
+        self._n_connect = 0
+        self._connected = False
 
         self._mqttc = mqtt.Client()
         self._mqttc.enable_logger()
@@ -75,16 +185,25 @@ class Mqtt:
     def start(self):
         self._log.debug('')
 
+        self._dataq.open()
+
         ret = self._mqttc.connect(self._host, self._port, keepalive=60)
         self._log.debug('ret=%s', ret)
 
         self._mqttc.loop_start()
         self.active = True
 
+        self._start_senders()
+
     def end(self):
         self._log.debug('')
 
+        self._end_senders()
+
         self.active = False
+        self._dataq.close()
+        if self._spool is not None:
+            self._spool.stop_drain()
 
         self._mqttc.disconnect()
         # time.sleep(1)
@@ -93,27 +212,211 @@ class Mqtt:
         self._log.debug('done')
 
     def send_data(self, data, topics, qos=0, retain=False):
-        self._log.debug('data=%a, topics=%s', data, topics)
+        '''
+        return: [MQTTMessageInfo or None(spooled), ..]
+                [] if ``pub_rate`` (sent by ``PubLimiter``)
+        '''
+        if self._dbg:
+            self._log.debug('data=%a, topics=%s', data, topics)
+
+        if self._limiter is not None:
+            if type(topics) != list:
+                topics = [ topics ]
+            for t in topics:
+                if t is None or t == '':
+                    continue
+                self._limiter.submit((t, qos, retain), data)
+            return []
+
+        return self._publish(self.data2payload(data), topics, qos, retain)
+
+    def publish(self, obj, topics, qos=0, retain=False):
+        '''
+        publish ``obj`` as it is (encoded by the codec of each topic):
+        no ``data2payload()``, not limited by ``pub_rate``,
+        not batched. Compressed and spooled as ``send_data()``.
+
+        e.g. raw bytes with ``set_codec(topic, 'raw')`` (MqttStream)
+
+        return: [MQTTMessageInfo or None(spooled), ..]
+        '''
+        return self._publish(obj, topics, qos, retain)
+
+    def _start_senders(self):
+        '''
+        start the timer threads of ``PubLimiter`` (and ``Batcher``)
+        (called by ``AsyncMqtt``, too)
+        '''
+        if self._limiter is not None:
+            self._limiter.start()
 
+    def _end_senders(self):
+        '''
+        stop the timer thread and send pending data
+        '''
+        if self._limiter is not None:
+            self._limiter.end()
+
+    def limit_stats(self):
+        '''
+        return: {'submit', 'sent', 'coalesced', 'pending'}
+        '''
+        if self._limiter is None:
+            return {}
+        return self._limiter.stats()
+
+    def _send_limited(self, key, data):
+        (topic, qos, retain) = key
+        self._publish(self.data2payload(data), topic, qos, retain)
+
+    def _publish(self, obj, topics, qos=0, retain=False):
+        '''
+        obj: payload object (before encode)
+
+        return: [MQTTMessageInfo or None(spooled), ..]
+        '''
         if type(topics) != list:
             topics = [ topics ]
-            self._log.debug('topics=%s', topics)
-
-        payload = json.dumps(self.data2payload(data)).encode('utf-8')
-        self._log.debug('payload=%a', payload)
 
+        payloads = {}  # {Codec: payload}, encode once per codec
+        rets = []
         for t in topics:
             if t is None or t == '':
                 self._log.debug('t=\'%s\': ** ignore **', t)
                 continue
 
+            codec = self.topic_codec(t)
+            payload = payloads.get(codec)
+            if payload is None:
+                payload = codec.encode(obj)
+                if self._compress is not None:
+                    payload = self._compress.compress(t, payload)
+                payloads[codec] = payload
+
+            if self._spool is not None and not self._connected:
+                self._spool_put(t, payload, qos, retain)
+                rets.append(None)
+                continue
+
             ret = self._mqttc.publish(t, payload,
                                       qos=qos, retain=retain)
-            self._log.debug('publish(%s) ==> ret=%s', t, ret)
+            if self._dbg:
+                self._log.debug('publish(%s, %a) ==> ret=%s', t, payload, ret)
+
+            # disconnected but on_disconnect() is not called yet.
+            # (QoS 1, 2 messages are kept by paho on MQTT_ERR_NO_CONN)
+            if (self._spool is not None and ret.rc != 0 and
+                    (qos == 0 or ret.rc != mqtt.MQTT_ERR_NO_CONN)):
+                self._log.warning('publish(%s): rc=%s: spooled', t, ret.rc)
+                self._spool_put(t, payload, qos, retain)
+                rets.append(None)
+                continue
+            rets.append(ret)
+
+            if self.metrics is not None:
+                if ret.rc != 0:
+                    self.metrics.inc('publish_failures_total')
+                else:
+                    self.metrics.inc('published_total')
+                    self.metrics.inc('published_bytes_total', len(payload))
+
+        return rets
+
+    def set_codec(self, topic_filter, codec):
+        '''
+        topic_filter: topic or filter (``+``, ``#``)
+                      a literal topic wins, then the longest filter
+        codec:        Codec object or name, None: default codec
+        '''
+        self._log.debug('topic_filter=%s, codec=%s', topic_filter, codec)
+        self._codecs.set(topic_filter, codec)
+
+    def topic_codec(self, topic):
+        return self._codecs.get(topic)
+
+    def route(self, topic_filter, cb, qos=0, raw=False, msg_filter=None):
+        '''
+        cb(data, topic, ts) for messages matching ``topic_filter``.
+        ``topic_filter`` is subscribed if not yet.
+
+        raw: cb(MqttMsg), the payload is not decoded
+        msg_filter: MqttFilter.MsgFilter, see set_filter()
+        '''
+        self._log.debug('topic_filter=%s, cb=%s, raw=%s, msg_filter=%s',
+                        topic_filter, cb, raw, msg_filter)
+
+        if msg_filter is not None:
+            self.set_filter(topic_filter, msg_filter)
+
+        if raw:
+            self._raw_routes.add(topic_filter, cb)
+        else:
+            self._routes.add(topic_filter, cb)
+
+        if topic_filter not in self._topics_sub:
+            self.subscribe(topic_filter, qos)
+
+    def subscribe(self, topic_filter, qos=0):
+        '''
+        subscribe ``topic_filter`` with ``qos``,
+        and again on reconnect
+        '''
+        self._log.debug('topic_filter=%s, qos=%s', topic_filter, qos)
+
+        self._sub_qos[topic_filter] = qos
+        if topic_filter not in self._topics_sub:
+            self._topics_sub.append(topic_filter)
+        if self.active:
+            ret = self._mqttc.subscribe(topic_filter, qos)
+            self._log.debug('subscribe(%s) ==> ret=%s', topic_filter, ret)
+
+    def unroute(self, topic_filter, cb=None):
+        '''
+        cb: None: all callbacks of ``topic_filter``
+
+        The subscription is kept.
+        '''
+        self._log.debug('topic_filter=%s, cb=%s', topic_filter, cb)
+        ret = self._routes.remove(topic_filter, cb)
+        ret += self._raw_routes.remove(topic_filter, cb)
+        return ret
+
+    def set_filter(self, topic_filter, msg_filter):
+        '''
+        drop messages of ``topic_filter`` rejected by ``msg_filter``
+        before queueing/callbacks
+
+        msg_filter: MqttFilter.MsgFilter, None: remove
+        '''
+        self._log.debug('topic_filter=%s, msg_filter=%s',
+                        topic_filter, msg_filter)
+        self._filters.set(topic_filter, msg_filter)
+
+    def compress_stats(self):
+        '''
+        return: {topic: {'msgs', 'compressed', 'ratio', 'compress_sec', ..}}
+          see MqttCompress.Compressor.stats()
+        '''
+        if self._compress is None:
+            return {}
+        return self._compress.stats()
+
+    def filter_stats(self):
+        '''
+        return: {'filtered', 'filters': {topic_filter: MsgFilter.stats()}}
+        '''
+        return self._filters.stats()
 
     def cb_qput(self, data, topic, ts):
-        self._log.debug('data=%s, topic=%s, ts=%s', data, topic, ts)
-        self._dataq.put((data, topic, ts))
+        if self._dbg:
+            self._log.debug('data=%s, topic=%s, ts=%s', data, topic, ts)
+        self._dataq.put((data, topic, ts), topic)
+
+    def qstats(self):
+        '''
+        return: {'depth', 'maxsize', 'policy', 'put', 'dropped'}
+        '''
+        return self._dataq.stats()
 
     def recv_data(self, timeout=2):
         '''
@@ -121,17 +424,73 @@ class Mqtt:
         '''
         self._log.debug('timeout=%s', timeout)
 
-        while self.active:
+        while True:
             try:
-                ret = self._dataq.get(timeout=timeout)
-                self._log.debug('ret=%s', ret)
-                return ret
+                return self._recv_rest.popleft()
+            except IndexError:
+                pass
+
+            m = self.recv_msg(timeout)
+            if m is None:
+                return None
+            if not isinstance(m, MqttMsg):
+                return m  # cb_qput()
+
+            items = self._msg_items(m)
+            if len(items) == 0:
+                continue
+            self._recv_rest.extend(items[1:])
+            if self._dbg:
+                self._log.debug('ret=%s', items[0])
+            return items[0]
 
+    def recv_msg(self, timeout=2):
+        '''
+        return: MqttMsg (not decoded)
+                or (data, topic, ts) put by ``cb_qput()``
+        '''
+        while self.active:
+            try:
+                return self._dataq.get(timeout=timeout)
             except queue.Empty as e:
                 self._log.debug('%s:%s', type(e).__name__, e)
 
         return None
 
+    def recv_many(self, max_items=100, max_wait=1, columnar=False):
+        '''
+        return as soon as ``max_items`` data are received
+        or ``max_wait`` sec passed.
+
+        return:
+          [(data, topic, ts), ..]
+          ([data, ..], [topic, ..], [ts, ..])  if ``columnar``
+        '''
+        self._log.debug('max_items=%s, max_wait=%s', max_items, max_wait)
+
+        ret = []
+        while len(self._recv_rest) > 0 and len(ret) < max_items:
+            ret.append(self._recv_rest.popleft())
+
+        if len(ret) < max_items:
+            for m in self._dataq.get_many(max_items - len(ret),
+                                          max_wait if len(ret) == 0 else 0):
+                if isinstance(m, MqttMsg):
+                    ret += self._msg_items(m)
+                else:
+                    ret.append(m)
+            if len(ret) > max_items:
+                # batches
+                self._recv_rest.extend(ret[max_items:])
+                del ret[max_items:]
+        self._log.debug('len(ret)=%s', len(ret))
+
+        if columnar:
+            if len(ret) == 0:
+                return [], [], []
+            return tuple(list(c) for c in zip(*ret))
+        return ret
+
     def data2payload(self, data):
         return data
 
@@ -141,21 +500,154 @@ class Mqtt:
     def get_ts(self, msg, payload):
         return msg.timestamp
 
+    def payload2items(self, msg, payload):
+        '''
+        return: [(data, ts), ..]
+          a payload may carry some data (batch)
+        '''
+        return [(self.payload2data(payload), self.get_ts(msg, payload))]
+
+    def latency_msec(self, msg, payload, ts):
+        '''
+        return: delivery delay [msec], None if unknown
+
+        override this to measure latency (see ``latency``)
+        '''
+        return None
+
+    def stats(self):
+        '''
+        return: {topic: LatencyHist.summary(), ..}
+        '''
+        if self._lat is None:
+            return {}
+        return {t: h.summary() for t, h in list(self._lat.items())}
+
     def _on_message(self, client, userdata, msg):
-        self._log.debug('userdata=%s', userdata)
-        self._log.debug('msg.topic=%s', msg.topic)
+        if self._dbg:
+            self._log.debug('userdata=%s, msg.topic=%s', userdata, msg.topic)
+
+        if self.metrics is not None:
+            self.metrics.inc('received_total')
+            self.metrics.inc('received_bytes_total', len(msg.payload))
+
+        if self._recorder is not None:
+            self._recorder.record(msg.topic, msg.payload)
 
-        payload = json.loads(msg.payload.decode('utf-8'))
-        self._log.debug('payload=%s', payload)
+        topic = msg.topic
+        raw = msg.payload
+        if self._compress is not None:
+            raw = self._compress.decompress(topic, raw)
 
-        data = self.payload2data(payload)
-        self._log.debug('data=%s', data)
+        m = MqttMsg(topic, raw, self.topic_codec(topic),
+                    msg.timestamp, msg.qos, msg.retain)
 
-        ts = self.get_ts(msg, payload)
-        self._log.debug('ts=%s', ts)
+        if len(self._filters) > 0 and not self._filters.accept(m):
+            if self.metrics is not None:
+                self.metrics.inc('filtered_total')
+            return
+
+        items = None
+        if self._lat is not None and (self._lat_topics is None or
+                                      self._lat_topics.match(topic)):
+            items = self.payload2items(m, m.payload)
+            for (data, ts) in items:
+                lat = self.latency_msec(m, m.payload, ts)
+                if lat is not None:
+                    hist = self._lat.get(topic)
+                    if hist is None:
+                        hist = self._lat[topic] = LatencyHist(
+                            self._lat_budget)
+                    hist.record(lat)
+
+        routed = False
+        if len(self._raw_routes) > 0:
+            for cb in self._raw_routes.match(topic):
+                self._call(cb, m)
+                routed = True
+
+        cbs = None
+        if len(self._routes) > 0:
+            cbs = self._routes.match(topic)
+        if not cbs:
+            if routed or self._cb_recv is None:
+                return
+            if self._cb_recv is self._cb_qput:
+                # decoded by recv_data()
+                self._dataq.put(m, topic)
+                return
+            cbs = [self._cb_recv]
+
+        if items is None:
+            items = self.payload2items(m, m.payload)
+        if self._dbg:
+            self._log.debug('payload=%s, items=%s', m.payload, items)
+
+        for (data, ts) in items:
+            for cb in cbs:
+                self._call(cb, data, topic, ts)
+
+    def _call(self, cb, *args):
+        if self.metrics is None:
+            cb(*args)
+            return
+
+        t0 = time.perf_counter()
+        cb(*args)
+        self.metrics.observe('callback_seconds', time.perf_counter() - t0)
 
-        if self._cb_recv is not None:
-            self._cb_recv(data, msg.topic, ts)
+    def _msg_items(self, m):
+        '''
+        return: [(data, topic, ts), ..], [] if decode error
+        '''
+        try:
+            return [(data, m.topic, ts)
+                    for (data, ts) in self.payload2items(m, m.payload)]
+        except Exception as e:
+            self._log.warning('%s: %s:%s', m, type(e).__name__, e)
+            return []
+
+    def _spool_put(self, topic, payload, qos, retain):
+        self._spool.put(topic, payload, qos, retain)
+        if self.metrics is not None:
+            self.metrics.inc('spooled_total')
+
+        # connected meanwhile (or rc != 0 while connected):
+        # on_connect() may have missed this record
+        if self._connected and self.active:
+            self._spool.start_drain(self._spool_publish)
+
+    def _spool_publish(self, records):
+        '''
+        publish records from ``MqttSpool`` and wait for acks
+
+        return: True if all records are delivered
+        '''
+        rets = []
+        for (topic, payload, qos, retain) in records:
+            if not self._connected or not self._spool.draining:
+                return False
+            ret = self._mqttc.publish(topic, payload, qos=qos, retain=retain)
+            if ret.rc != 0:
+                self._log.warning('publish(%s): rc=%s', topic, ret.rc)
+                return False
+            rets.append(ret)
+
+        for ret in rets:
+            deadline = time.monotonic() + self.SPOOL_ACK_TIMEOUT
+            while not ret.is_published():
+                if (not self._spool.draining or
+                        time.monotonic() >= deadline):
+                    return False
+                try:
+                    ret.wait_for_publish(self.SPOOL_WAIT_SEC)
+                except (ValueError, RuntimeError) as e:
+                    self._log.warning('%s:%s', type(e).__name__, e)
+                    return False
+
+        if self.metrics is not None:
+            self.metrics.inc('published_total', len(rets))
+        return True
 
     def _on_connect(self, client, userdata, flag, rc):
         self._log.debug('userdata=%s, flag=%s, rc=%s', userdata, flag, rc)
@@ -164,21 +656,32 @@ class Mqtt:
             self._log.error('rc=%s (flag=%s)', rc, flag)
             return
 
+        self._n_connect += 1
+        self._connected = True
+        if self._n_connect > 1 and self.metrics is not None:
+            self.metrics.inc('reconnects_total')
+
         # subscribe
         topics = []
         for t in self._topics_sub:
             if t is None or t == '':
                 self._log.debug('t=%a: ** ignore **', t)
                 continue
-            topics.append((t, 0))
+            topics.append((t, self._sub_qos.get(t, 0)))
         if len(topics) >= 1:
             ret = self._mqttc.subscribe(topics)
             self._log.debug('subscribe(%s) ==> ret=%s', topics, ret)
 
+        if self._spool is not None and self._spool.pending() > 0:
+            self._spool.start_drain(self._spool_publish)
+
     def _on_disconnect(self, client, userdata, rc):
         self._log.debug('userdata=%s, rc=%s', userdata, rc)
+        self._connected = False
         if rc != 0:
             self._log.error('rc=%s', rc)
+            if self.metrics is not None:
+                self.metrics.inc('disconnects_total')
 
     def _on_subscribe(self, client, userdata, mid, granted_qos):
         self._log.debug('userdata=%s, mid=%s, granted_qos=%s',
@@ -196,7 +699,8 @@ class Mqtt:
         self._log.debug('userdata=%s, mid', userdata, mid)
 
     def _on_publish(self, client, userdata, mid):
-        self._log.debug('userdata=%s, mid=%s', userdata, mid)
+        if self._dbg:
+            self._log.debug('userdata=%s, mid=%s', userdata, mid)
 
 
 class MqttSubscriber(Mqtt):
@@ -217,7 +721,7 @@ class MqttPublisher(Mqtt):
         self._log.debug('user=%s, pw=%s, host=%s, port=%s',
                         user, pw, host, port)
 
-        super().__init__(None, None, user, pw, host, port, self._dbg)
+        super().__init__(None, None, user, pw, host, port, debug=self._dbg)
 
 
 class Beebotte(Mqtt):
@@ -227,37 +731,101 @@ class Beebotte(Mqtt):
     * ``token``は、``channel``毎
 
     従って、``topics_sub``などは、全て同じ``channel``でなければならない。
+
+    ``batch_size``を指定すると、topic毎に``batch_size``個、
+    または``batch_sec``秒分のデータをまとめて1つのメッセージで送信する。
+      {'data': [[ts, data], ..], 'ts': ts, 'ispublic': False, 'batch': True}
+    受信側では、1データずつ_cb_recvが呼ばれる。
     '''
     BEEBOTTE_HOST = 'mqtt.beebotte.com'
     BEEBOTTE_PORT = 1883
 
+    DEF_BATCH_SEC = 1.0
+
     _log = get_logger(__name__, False)
 
-    def __init__(self, cb_recv=None, topics_sub=None, token='', debug=False):
+    def __init__(self, cb_recv=None, topics_sub=None, token='', debug=False,
+                 batch_size=0, batch_sec=DEF_BATCH_SEC, **opts):
+        '''
+        batch_size: 0: no batch
+        opts: options of ``Mqtt`` (codec, q_maxsize, latency, ..)
+        '''
         self._dbg = debug
         __class__._log = get_logger(__class__.__name__, self._dbg)
         self._log.debug('topics_sub=%s, token=%s', topics_sub, token)
+        self._log.debug('batch_size=%s, batch_sec=%s', batch_size, batch_sec)
+        self._log.debug('opts=%s', opts)
 
         super().__init__(cb_recv, topics_sub, token, '',
                          self.BEEBOTTE_HOST, self.BEEBOTTE_PORT,
-                         debug=self._dbg)
+                         debug=self._dbg, **opts)
 
-    def data2payload(self, data):
-        self._log.debug('data=%s', data)
+        self._batcher = None
+        if batch_size > 0:
+            self._batcher = Batcher(self._send_batch, batch_size, batch_sec)
+
+    def _start_senders(self):
+        super()._start_senders()
+        if self._batcher is not None:
+            self._batcher.start()
+
+    def _end_senders(self):
+        if self._batcher is not None:
+            self._batcher.end()
+        super()._end_senders()
+
+    def send_data(self, data, topics, qos=0, retain=False):
+        '''
+        return: [MQTTMessageInfo or None(spooled), ..]
+                [] if batched (sent later)
+        '''
+        if self._batcher is None:
+            return super().send_data(data, topics, qos, retain)
+
+        if type(topics) != list:
+            topics = [ topics ]
 
+        ts = int(time.time() * 1000)
+        for t in topics:
+            if t is None or t == '':
+                continue
+            self._batcher.add((t, qos, retain), [ts, data])
+        return []
+
+    def batch_stats(self):
+        '''
+        return: {'added', 'batches', 'pending'}
+        '''
+        if self._batcher is None:
+            return {}
+        return self._batcher.stats()
+
+    def _send_batch(self, key, items):
+        (topic, qos, retain) = key
+        payload = {'data': items, 'ts': items[-1][0], 'ispublic': False,
+                   'batch': True}
+        self._publish(payload, topic, qos, retain)
+
+    def data2payload(self, data):
         ts = int(time.time() * 1000)
         payload = {'data': data, 'ts': ts, 'ispublic': False}
-        self._log.debug('payload=%s', payload)
+        if self._dbg:
+            self._log.debug('payload=%s', payload)
         return payload
 
     def payload2data(self, payload):
-        self._log.debug('payload=%s', payload)
         return payload['data']
 
     def get_ts(self, msg, payload):
-        ts = payload['ts']
-        self._log.debug('ts=%s', ts)
-        return ts
+        return payload['ts']
+
+    def payload2items(self, msg, payload):
+        if payload.get('batch'):
+            return [(data, ts) for (ts, data) in payload['data']]
+        return [(payload['data'], payload['ts'])]
+
+    def latency_msec(self, msg, payload, ts):
+        return time.time() * 1000 - ts
 
     @classmethod
     def ts2datestr(cls, ts_msec):
@@ -278,12 +846,15 @@ class BeebotteSubscriber(Beebotte):
 class BeebottePublisher(Beebotte):
     _log = get_logger(__name__, False)
 
-    def __init__(self, token='', debug=False):
+    def __init__(self, token='', debug=False, **opts):
+        '''
+        opts: options of ``Mqtt`` (codec, spool, ..)
+        '''
         self._dbg = debug
         __class__._log = get_logger(__class__.__name__, self._dbg)
         self._log.debug('token=%s', token)
 
-        super().__init__(None, [], token, debug=self._dbg)
+        super().__init__(None, [], token, debug=self._dbg, **opts)
 
 
 class App:
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+MqttBatch.py
+
+buffer items per key, and flush them as a batch
+when ``max_items`` items are buffered or ``max_sec`` passed
+since the first item
+
+Usage:
+------
+from MqttBatch import Batcher
+
+def flush(key, items):
+    mqtt.send_data(items, key)
+
+batcher = Batcher(flush, max_items=100, max_sec=1.0)
+batcher.start()
+batcher.add('ch1/res1', (ts, data))
+  :
+batcher.end()   # flush all
+------
+
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import threading
+import time
+
+
+class Batcher:
+    def __init__(self, flush_func, max_items=100, max_sec=1.0):
+        '''
+        flush_func(key, [item, ..]): called without lock held
+        '''
+        self._flush_func = flush_func
+        self.max_items = max_items
+        self.max_sec = max_sec
+
+        self._lock = threading.Lock()
+        self._buf = {}   # {key: (t_first, [item, ..])}
+
+        self._stop = threading.Event()
+        self._th = None
+
+        self.n_added = 0
+        self.n_batches = 0
+
+    def add(self, key, item):
+        batch = None
+        with self._lock:
+            self.n_added += 1
+
+            ent = self._buf.get(key)
+            if ent is None:
+                ent = self._buf[key] = (time.monotonic(), [])
+            ent[1].append(item)
+
+            if len(ent[1]) >= self.max_items:
+                batch = self._buf.pop(key)[1]
+                self.n_batches += 1
+
+        if batch is not None:
+            self._flush_func(key, batch)
+
+    def flush(self, expired_only=False):
+        '''
+        expired_only: flush only batches older than ``max_sec``
+        '''
+        now = time.monotonic()
+        with self._lock:
+            keys = [k for k, (t_first, _) in self._buf.items()
+                    if not expired_only or now - t_first >= self.max_sec]
+            batches = [(k, self._buf.pop(k)[1]) for k in keys]
+            self.n_batches += len(batches)
+
+        for key, batch in batches:
+            self._flush_func(key, batch)
+
+    def pending(self):
+        with self._lock:
+            return sum(len(items) for _, items in self._buf.values())
+
+    def stats(self):
+        return {'added': self.n_added, 'batches': self.n_batches,
+                'pending': self.pending()}
+
+    def start(self):
+        '''
+        start the timer thread for ``max_sec``
+        '''
+        if self._th is not None:
+            return
+        self._stop.clear()
+        self._th = threading.Thread(target=self._timer, daemon=True)
+        self._th.start()
+
+    def end(self):
+        '''
+        stop the timer thread and flush all
+        '''
+        if self._th is not None:
+            self._stop.set()
+            self._th.join()
+            self._th = None
+        self.flush()
+
+    def _timer(self):
+        interval = max(self.max_sec / 4, 0.01)
+        while not self._stop.wait(interval):
+            self.flush(expired_only=True)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+MqttBench.py
+
+throughput and latency benchmark of Mqtt.py and ytMqtt.py
+
+  client        publish                   receive
+  ------------  ------------------------  --------------------------
+  Mqtt.cb       Mqtt.send_data()          callback
+  Mqtt.qput     Mqtt.send_data()          CB_QPUT + recv_many(),
+                                          taken as soon as they arrive
+  ytMqtt        publish() (waits ack)     recv_data()
+  ytMqtt.async  publish_async() + flush() get_msg(MSG_DATA, topic)
+
+Subscriptions use the same QoS as publishing. ``--size`` is the
+length of the padding string in the payload ({'t': .., 'pad': ..}),
+``payload_bytes`` in the result is the encoded payload size.
+
+A local broker (MqttBroker) is used unless ``--host`` is given.
+Results are written as JSON.
+
+$ ./MqttBench.py -c 10000 -s 16,1024 -q 0,1 -t 1,10 -o result.json
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import json
+import platform
+import threading
+import time
+import uuid
+from Mqtt import Mqtt
+import ytMqtt
+from MqttBroker import MqttBroker
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+CLIENTS = ['Mqtt.cb', 'Mqtt.qput', 'ytMqtt', 'ytMqtt.async']
+
+SETTLE_SEC = 0.5  # wait for connect and subscribe
+
+
+def lat_stats(lats):
+    '''
+    lats: [msec, ..]
+
+    return: {'p50', 'p99', 'p999', 'max', 'mean'} [msec]
+    '''
+    if len(lats) == 0:
+        return {}
+
+    lats = sorted(lats)
+    n = len(lats)
+
+    def pct(p):
+        return lats[min(n - 1, int(n * p))]
+
+    return {'p50': pct(0.50), 'p99': pct(0.99), 'p999': pct(0.999),
+            'max': lats[-1], 'mean': sum(lats) / n}
+
+
+class Receiver:
+    '''
+    count received messages and latency
+    '''
+    def __init__(self, count):
+        self.count = count
+        self.lats = []
+        self.t_last = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def recv(self, data):
+        now = time.perf_counter()
+        with self._lock:
+            self.lats.append((now - data['t']) * 1000)
+            self.t_last = now
+            if len(self.lats) >= self.count:
+                self.done.set()
+
+
+def bench_data(pad):
+    return {'t': time.perf_counter(), 'pad': pad}
+
+
+def result(client, size, qos, topics, count, t_start, t_pub, rcv):
+    pub_sec = t_pub - t_start
+    ret = {'client': client, 'size': size, 'qos': qos, 'topics': topics,
+           'payload_bytes': len(json.dumps(bench_data('x' * size))),
+           'count': count, 'received': len(rcv.lats),
+           'pub_msgs_per_sec': count / pub_sec if pub_sec > 0 else None,
+           'sub_msgs_per_sec': None,
+           'lat_ms': lat_stats(rcv.lats)}
+    if rcv.t_last is not None and len(rcv.lats) > 0:
+        ret['sub_msgs_per_sec'] = len(rcv.lats) / (rcv.t_last - t_start)
+    return ret
+
+
+def bench_mqtt(host, port, mode, count, size, qos, topics, timeout):
+    '''
+    mode: 'cb' or 'qput'
+    '''
+    prefix = 'bench/%s' % uuid.uuid4().hex[:8]
+    topic_list = ['%s/%d' % (prefix, i) for i in range(topics)]
+    rcv = Receiver(count)
+
+    def cb(data, topic, ts):
+        rcv.recv(data)
+
+    if mode == 'cb':
+        sub = Mqtt(cb, [], host=host, port=port)
+    else:
+        sub = Mqtt(Mqtt.CB_QPUT, [], host=host, port=port)
+    sub.subscribe(prefix + '/#', qos)
+    pub = Mqtt(None, None, host=host, port=port)
+
+    sub.start()
+    pub.start()
+    time.sleep(SETTLE_SEC)
+
+    if mode == 'qput':
+        def consumer():
+            # take messages as soon as they arrive
+            while not rcv.done.is_set():
+                item = sub.recv_data()  # None after sub.end()
+                if item is None:
+                    break
+                rcv.recv(item[0])
+                for (data, topic, ts) in sub.recv_many(1000, 0):
+                    rcv.recv(data)
+        th = threading.Thread(target=consumer, daemon=True)
+        th.start()
+
+    pad = 'x' * size
+    t_start = time.perf_counter()
+    for i in range(count):
+        pub.send_data(bench_data(pad), topic_list[i % topics], qos=qos)
+    t_pub = time.perf_counter()
+
+    rcv.done.wait(timeout)
+    ret = result('Mqtt.' + mode, size, qos, topics, count,
+                 t_start, t_pub, rcv)
+
+    pub.end()
+    sub.end()
+    return ret
+
+
+def bench_ytmqtt(host, port, mode, count, size, qos, topics, timeout):
+    '''
+    mode: 'sync':  publish() + recv_data()
+          'async': publish_async() + flush(), get_msg()
+    '''
+    prefix = 'bench/%s' % uuid.uuid4().hex[:8]
+    topic_list = ['%s/%d' % (prefix, i) for i in range(topics)]
+    rcv = Receiver(count)
+
+    sub = ytMqtt.Mqtt('', '', host, port)
+    pub = ytMqtt.Mqtt('', '', host, port)
+    sub.start()
+    pub.start()
+    sub.do_subscribe(topic_list, qos)
+    time.sleep(SETTLE_SEC)
+
+    def consumer_async(topic):
+        while not rcv.done.is_set():
+            t, d = sub.get_msg(sub.MSG_DATA, topic, timeout=0.1)
+            if t == sub.MSG_DATA:
+                rcv.recv(d['payload'])
+
+    def consumer_sync(topic):
+        while not rcv.done.is_set():
+            data = sub.recv_data(topic)  # None after sub.end()
+            if data is None:
+                break
+            rcv.recv(data)
+
+    consumer = consumer_sync if mode == 'sync' else consumer_async
+    ths = [threading.Thread(target=consumer, args=(t,), daemon=True)
+           for t in topic_list]
+    for th in ths:
+        th.start()
+
+    pad = 'x' * size
+    t_start = time.perf_counter()
+    if mode == 'sync':
+        for i in range(count):
+            pub.publish(topic_list[i % topics], bench_data(pad), qos=qos)
+    else:
+        for i in range(count):
+            pub.publish_async(topic_list[i % topics], bench_data(pad),
+                              qos=qos)
+        pub.flush(timeout)
+    t_pub = time.perf_counter()
+
+    rcv.done.wait(timeout)
+    client = 'ytMqtt' if mode == 'sync' else 'ytMqtt.async'
+    ret = result(client, size, qos, topics, count, t_start, t_pub, rcv)
+
+    rcv.done.set()
+    pub.end()
+    sub.end()
+    for th in ths:
+        th.join()
+    return ret
+
+
+def run(host, port, clients, count, sizes, qoss, topicss, timeout, log):
+    results = []
+    for client in clients:
+        for size in sizes:
+            for qos in qoss:
+                for topics in topicss:
+                    log.info('%s: size=%s, qos=%s, topics=%s',
+                             client, size, qos, topics)
+                    if client.startswith('ytMqtt'):
+                        mode = 'async' if client.endswith('.async') \
+                            else 'sync'
+                        ret = bench_ytmqtt(host, port, mode, count, size,
+                                           qos, topics, timeout)
+                    else:
+                        ret = bench_mqtt(host, port, client.split('.')[1],
+                                         count, size, qos, topics, timeout)
+                    log.info('%s', ret)
+                    results.append(ret)
+    return results
+
+
+def int_list(s):
+    return [int(v) for v in s.split(',')]
+
+
+@click.command(context_settings=CONTEXT_SETTINGS,
+               help='MQTT client benchmark')
+@click.option('--host', '-H', 'host', type=str, default='',
+              help='broker host (default: local MqttBroker)')
+@click.option('--port', '-p', 'port', type=int, default=MqttBroker.DEF_PORT,
+              help='broker port')
+@click.option('--client', '-C', 'clients', type=str,
+              default=','.join(CLIENTS),
+              help='clients (%s)' % ','.join(CLIENTS))
+@click.option('--count', '-c', 'count', type=int, default=10000,
+              help='messages per run')
+@click.option('--size', '-s', 'sizes', type=str, default='16,1024',
+              help='padding lengths in the payload')
+@click.option('--qos', '-q', 'qoss', type=str, default='0,1',
+              help='QoS levels')
+@click.option('--topics', '-t', 'topicss', type=str, default='1,10',
+              help='number of topics')
+@click.option('--timeout', 'timeout', type=float, default=60,
+              help='max wait for receiving [sec]')
+@click.option('--out', '-o', 'out', type=str, default='',
+              help='output file (default: stdout)')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(host, port, clients, count, sizes, qoss, topicss, timeout, out,
+         debug):
+    log = get_logger(__name__, debug=debug)
+
+    broker = None
+    if host == '':
+        broker = MqttBroker(port=0)
+        port = broker.start()
+        host = 'localhost'
+
+    try:
+        results = run(host, port, clients.split(','), count,
+                      int_list(sizes), int_list(qoss), int_list(topicss),
+                      timeout, log)
+    finally:
+        if broker is not None:
+            broker.end()
+
+    doc = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(),
+           'host': host if broker is None else 'MqttBroker',
+           'results': results}
+
+    if out == '':
+        print(json.dumps(doc, indent=2))
+    else:
+        with open(out, 'w') as f:
+            json.dump(doc, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,565 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+MqttBroker.py
+
+lightweight MQTT 3.1.1 broker for tests and benchmarks
+
+* QoS 0, 1 (QoS 2 is accepted and delivered as QoS 1)
+* retained messages
+* wildcard subscriptions ('+', '#')
+* persistent sessions (clean_session=False)
+* will messages
+* Beebotte emulation (optional):
+  payloads are delivered as ``{'data', 'ts', 'ispublic'}``
+
+Usage:
+------
+from MqttBroker import MqttBroker
+
+broker = MqttBroker(port=0)  # 0: any free port
+port = broker.start()
+
+mqtt = Mqtt(Mqtt.CB_QPUT, ['test/#'], host='localhost', port=port)
+..
+
+broker.end()
+------
+
+$ ./MqttBroker.py -p 1883
+
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import json
+import socket
+import socketserver
+import struct
+import threading
+import time
+from collections import deque
+from TopicTrie import TopicTrie, topic_match
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+# packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def enc_len(n):
+    '''
+    remaining length
+    '''
+    ret = bytearray()
+    while True:
+        b = n % 128
+        n //= 128
+        if n > 0:
+            b |= 0x80
+        ret.append(b)
+        if n == 0:
+            return bytes(ret)
+
+
+def enc_str(s):
+    if isinstance(s, str):
+        s = s.encode('utf-8')
+    return struct.pack('!H', len(s)) + s
+
+
+def packet(ptype, flags, body=b''):
+    return bytes([ptype << 4 | flags]) + enc_len(len(body)) + body
+
+
+class Session:
+    '''
+    state of a client (kept after disconnect if not clean_session)
+    '''
+    MAX_PENDING = 1000  # queued messages while offline
+
+    def __init__(self, client_id, clean):
+        self.client_id = client_id
+        self.clean = clean
+        self.subs = {}    # {topic_filter: qos}
+        self.conn = None  # Handler
+        self.pending = deque(maxlen=self.MAX_PENDING)  # (topic, payload, qos)
+        self._mid = 0
+
+    def next_mid(self):
+        self._mid = self._mid % 65535 + 1
+        return self._mid
+
+
+class Handler(socketserver.BaseRequestHandler):
+    '''
+    a client connection
+    '''
+    def setup(self):
+        self.broker = self.server.broker
+        self._log = self.broker._log
+        self._rfile = self.request.makefile('rb')
+        self._wlock = threading.Lock()
+        self.session = None
+        self._will = None  # (topic, payload, qos, retain)
+
+    def send(self, data):
+        with self._wlock:
+            self.request.sendall(data)
+
+    def handle(self):
+        try:
+            while True:
+                pkt = self.read_packet()
+                if pkt is None:
+                    break
+                ptype, flags, body = pkt
+                if not self.dispatch(ptype, flags, body):
+                    break
+        except (OSError, ValueError, IndexError, struct.error) as e:
+            self._log.debug('%s:%s', type(e).__name__, e)
+        finally:
+            self.broker.detach(self)
+
+    def read_packet(self):
+        '''
+        return: (ptype, flags, body) or None(closed)
+        '''
+        b = self._rfile.read(1)
+        if len(b) == 0:
+            return None
+
+        n = 0
+        mul = 1
+        while True:
+            d = self._rfile.read(1)
+            if len(d) == 0:
+                return None
+            n += (d[0] & 0x7f) * mul
+            if d[0] & 0x80 == 0:
+                break
+            mul *= 128
+
+        body = self._rfile.read(n)
+        if len(body) < n:
+            return None
+        return b[0] >> 4, b[0] & 0x0f, body
+
+    def dispatch(self, ptype, flags, body):
+        '''
+        return: False to close
+        '''
+        if self.session is None and ptype != CONNECT:
+            return False
+
+        if ptype == CONNECT:
+            return self.on_connect(body)
+
+        if ptype == PUBLISH:
+            self.on_publish(flags, body)
+        elif ptype == PUBREL:
+            self.send(packet(PUBCOMP, 0, body[:2]))
+        elif ptype == SUBSCRIBE:
+            self.on_subscribe(body)
+        elif ptype == UNSUBSCRIBE:
+            self.on_unsubscribe(body)
+        elif ptype == PINGREQ:
+            self.send(packet(PINGRESP, 0))
+        elif ptype == DISCONNECT:
+            self._will = None
+            return False
+        # PUBACK, PUBREC, PUBCOMP: nothing to do (no retry)
+        return True
+
+    def on_connect(self, body):
+        pos = 0
+
+        def get_str():
+            nonlocal pos
+            (n,) = struct.unpack_from('!H', body, pos)
+            s = body[pos + 2:pos + 2 + n]
+            pos += 2 + n
+            return s
+
+        proto = get_str()
+        level = body[pos]
+        cflags = body[pos + 1]
+        (keepalive,) = struct.unpack_from('!H', body, pos + 2)
+        pos += 4
+        self._log.debug('proto=%s, level=%s, cflags=0x%02x, keepalive=%s',
+                        proto, level, cflags, keepalive)
+
+        if level not in (3, 4):
+            self.send(packet(CONNACK, 0, b'\x00\x01'))
+            return False
+
+        client_id = get_str().decode('utf-8')
+        clean = bool(cflags & 0x02)
+
+        if cflags & 0x04:
+            will_topic = get_str().decode('utf-8')
+            will_payload = get_str()
+            self._will = (will_topic, will_payload,
+                          (cflags >> 3) & 0x03, bool(cflags & 0x20))
+
+        user = get_str().decode('utf-8') if cflags & 0x80 else ''
+        pw = get_str() if cflags & 0x40 else b''
+        self._log.debug('client_id=%s, clean=%s, user=%s',
+                        client_id, clean, user)
+
+        if not self.broker.auth(user, pw):
+            self.send(packet(CONNACK, 0, b'\x00\x05'))
+            return False
+
+        if keepalive > 0:
+            self.request.settimeout(keepalive * 1.5)
+
+        present = self.broker.attach(self, client_id, clean)
+        self.send(packet(CONNACK, 0, bytes([1 if present else 0, 0])))
+        self.broker.flush_pending(self.session)
+        return True
+
+    def on_publish(self, flags, body):
+        qos = (flags >> 1) & 0x03
+        retain = bool(flags & 0x01)
+
+        (n,) = struct.unpack_from('!H', body, 0)
+        topic = body[2:2 + n].decode('utf-8')
+        pos = 2 + n
+        if qos > 0:
+            mid = body[pos:pos + 2]
+            pos += 2
+        payload = body[pos:]
+
+        self.broker.publish(topic, payload, qos, retain)
+
+        if qos == 1:
+            self.send(packet(PUBACK, 0, mid))
+        elif qos == 2:
+            self.send(packet(PUBREC, 0, mid))
+
+    def on_subscribe(self, body):
+        mid = body[:2]
+        pos = 2
+        subs = []
+        while pos < len(body):
+            (n,) = struct.unpack_from('!H', body, pos)
+            topic_filter = body[pos + 2:pos + 2 + n].decode('utf-8')
+            qos = body[pos + 2 + n]
+            pos += 3 + n
+            subs.append((topic_filter, qos))
+
+        granted = self.broker.subscribe(self.session, subs)
+        self.send(packet(SUBACK, 0, mid + bytes(granted)))
+
+        for topic_filter, qos in subs:
+            self.broker.send_retained(self.session, topic_filter, qos)
+
+    def on_unsubscribe(self, body):
+        mid = body[:2]
+        pos = 2
+        filters = []
+        while pos < len(body):
+            (n,) = struct.unpack_from('!H', body, pos)
+            filters.append(body[pos + 2:pos + 2 + n].decode('utf-8'))
+            pos += 2 + n
+
+        self.broker.unsubscribe(self.session, filters)
+        self.send(packet(UNSUBACK, 0, mid))
+
+    def deliver(self, topic, payload, qos, retain=False):
+        flags = qos << 1 | (1 if retain else 0)
+        body = enc_str(topic)
+        with self._wlock:
+            if qos > 0:
+                body += struct.pack('!H', self.session.next_mid())
+            self.request.sendall(packet(PUBLISH, flags, body + payload))
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MqttBroker:
+    DEF_HOST = 'localhost'
+    DEF_PORT = 1883
+
+    MAX_QOS = 1
+
+    _log = get_logger(__name__, False)
+
+    def __init__(self, host=DEF_HOST, port=DEF_PORT, users=None,
+                 beebotte=False, debug=False):
+        '''
+        users: {user: password}, None: anyone
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('host=%s, port=%s, beebotte=%s',
+                        host, port, beebotte)
+
+        self._host = host
+        self._port = port
+        self._users = users
+        self._beebotte = beebotte
+
+        self._lock = threading.RLock()
+        self._sessions = {}        # {client_id: Session}
+        self._subs = TopicTrie()   # {topic_filter: [(Session, filter), ..]}
+        self._retained = {}        # {topic: (payload, qos)}
+
+        self._svr = None
+        self._th = None
+
+        self.n_in = 0
+        self.n_out = 0
+
+    @property
+    def port(self):
+        return self._port
+
+    def start(self):
+        '''
+        return: port
+        '''
+        self._log.debug('')
+
+        self._svr = Server((self._host, self._port), Handler)
+        self._svr.broker = self
+        self._port = self._svr.server_address[1]
+
+        self._th = threading.Thread(target=self._svr.serve_forever,
+                                    daemon=True)
+        self._th.start()
+
+        self._log.debug('done: port=%s', self._port)
+        return self._port
+
+    def end(self):
+        self._log.debug('')
+
+        self._svr.shutdown()
+        self._svr.server_close()
+
+        with self._lock:
+            conns = [s.conn for s in self._sessions.values()
+                     if s.conn is not None]
+        for conn in conns:
+            try:
+                conn.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        self._th.join()
+        self._log.debug('done')
+
+    def auth(self, user, pw):
+        if self._users is None:
+            return True
+        return self._users.get(user) == pw.decode('utf-8')
+
+    def attach(self, conn, client_id, clean):
+        '''
+        return: session present
+        '''
+        with self._lock:
+            if client_id == '':
+                client_id = '_anon_%x' % id(conn)
+
+            old = self._sessions.get(client_id)
+            if old is not None and old.conn is not None:
+                # take over
+                self._log.debug('take over: %s', client_id)
+                try:
+                    old.conn.request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                old.conn.session = None
+
+            if old is not None and (clean or old.clean):
+                self._drop_session(old)
+                old = None
+
+            present = old is not None
+            session = old
+            if session is None:
+                session = Session(client_id, clean)
+                self._sessions[client_id] = session
+
+            session.conn = conn
+            conn.session = session
+
+        return present
+
+    def detach(self, conn):
+        session = conn.session
+        if session is None:
+            return
+
+        will = conn._will
+        if will:
+            self.publish(*will)
+
+        with self._lock:
+            if session.conn is conn:
+                session.conn = None
+                if session.clean:
+                    self._drop_session(session)
+        conn.session = None
+
+    def _drop_session(self, session):
+        '''
+        call with ``_lock`` held
+        '''
+        for topic_filter in session.subs:
+            self._subs.remove(topic_filter, (session, topic_filter))
+        session.subs = {}
+        if self._sessions.get(session.client_id) is session:
+            del self._sessions[session.client_id]
+
+    def subscribe(self, session, subs):
+        '''
+        return: granted QoS list
+        '''
+        granted = []
+        with self._lock:
+            for topic_filter, qos in subs:
+                try:
+                    TopicTrie.check_filter(topic_filter)
+                except ValueError as e:
+                    self._log.warning('%s', e)
+                    granted.append(0x80)
+                    continue
+
+                qos = min(qos, self.MAX_QOS)
+                if topic_filter not in session.subs:
+                    self._subs.add(topic_filter, (session, topic_filter))
+                session.subs[topic_filter] = qos
+                granted.append(qos)
+        return granted
+
+    def unsubscribe(self, session, filters):
+        with self._lock:
+            for topic_filter in filters:
+                if session.subs.pop(topic_filter, None) is not None:
+                    self._subs.remove(topic_filter, (session, topic_filter))
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        '''
+        deliver a message to subscribers
+        (can be called in-process)
+        '''
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        if self._beebotte:
+            payload = self.beebotte_payload(payload)
+
+        self.n_in += 1
+
+        with self._lock:
+            if retain:
+                if len(payload) == 0:
+                    self._retained.pop(topic, None)
+                else:
+                    self._retained[topic] = (payload, qos)
+
+            # one delivery per session, with the max QoS of the filters
+            targets = {}
+            for session, topic_filter in self._subs.match(topic):
+                sub_qos = session.subs.get(topic_filter, 0)
+                targets[session] = max(targets.get(session, 0), sub_qos)
+
+            offline = [(s, min(qos, q)) for s, q in targets.items()
+                       if s.conn is None]
+            for session, q in offline:
+                if q > 0:
+                    session.pending.append((topic, payload, q))
+
+        for session, q in targets.items():
+            conn = session.conn
+            if conn is None:
+                continue
+            try:
+                conn.deliver(topic, payload, min(qos, q))
+                self.n_out += 1
+            except OSError as e:
+                self._log.debug('%s: %s:%s', session.client_id,
+                                type(e).__name__, e)
+
+    def flush_pending(self, session):
+        while session.conn is not None and len(session.pending) > 0:
+            topic, payload, qos = session.pending.popleft()
+            session.conn.deliver(topic, payload, qos)
+            self.n_out += 1
+
+    def send_retained(self, session, topic_filter, qos):
+        with self._lock:
+            retained = [(t, p, q) for t, (p, q) in self._retained.items()
+                        if topic_match(topic_filter, t)]
+
+        for topic, payload, q in retained:
+            session.conn.deliver(topic, payload, min(qos, q, self.MAX_QOS),
+                                 retain=True)
+            self.n_out += 1
+
+    def beebotte_payload(self, payload):
+        '''
+        payload ==> {'data': .., 'ts': msec, 'ispublic': False}
+        '''
+        try:
+            obj = json.loads(payload)
+        except ValueError:
+            return payload
+
+        if not isinstance(obj, dict) or 'data' not in obj:
+            obj = {'data': obj}
+        obj.setdefault('ts', int(time.time() * 1000))
+        obj.setdefault('ispublic', False)
+        return json.dumps(obj).encode('utf-8')
+
+
+@click.command(context_settings=CONTEXT_SETTINGS,
+               help='lightweight MQTT broker')
+@click.option('--host', '-H', 'host', type=str, default='0.0.0.0',
+              help='listen address')
+@click.option('--port', '-p', 'port', type=int, default=MqttBroker.DEF_PORT,
+              help='listen port')
+@click.option('--beebotte', '-b', 'beebotte', is_flag=True, default=False,
+              help='emulate Beebotte payload')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(host, port, beebotte, debug):
+    log = get_logger(__name__, debug=debug)
+
+    broker = MqttBroker(host, port, beebotte=beebotte, debug=debug)
+    port = broker.start()
+    log.info('listening on %s:%s', host, port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.end()
+        log.info('in=%s, out=%s', broker.n_in, broker.n_out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+MqttCodec.py
+
+payload codecs for Mqtt.py and ytMqtt.py
+
+  name        format                  module
+  ----------  ----------------------  ----------------
+  'json'      JSON (default)          json
+  'fastjson'  JSON                    orjson or ujson
+  'msgpack'   MessagePack             msgpack
+  'cbor'      CBOR                    cbor2
+  'raw'       bytes as they are       -
+
+Codecs whose module is not installed are not registered.
+
+``TopicCodecs`` selects a codec by topic filter (``+``, ``#``).
+
+Usage:
+------
+from MqttCodec import get_codec
+
+codec = get_codec('msgpack')
+payload = codec.encode({'data': 1})
+data = codec.decode(payload)
+------
+
+benchmark:
+$ ./MqttCodec.py
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import json
+import time
+from TopicTrie import TopicTrie
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class Codec:
+    '''
+    base class of codecs
+
+    encode(obj) -> bytes
+    decode(bytes) -> obj
+    '''
+    name = ''
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, payload):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, self.name)
+
+
+class JsonCodec(Codec):
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class FastJsonCodec(Codec):
+    '''
+    orjson or ujson
+    '''
+    name = 'fastjson'
+
+    def __init__(self):
+        if orjson is not None:
+            self.encode = orjson.dumps
+            self.decode = orjson.loads
+        else:
+            self.decode = ujson.loads
+
+    def encode(self, obj):
+        return ujson.dumps(obj).encode('utf-8')
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+class CborCodec(Codec):
+    name = 'cbor'
+
+    def encode(self, obj):
+        return cbor2.dumps(obj)
+
+    def decode(self, payload):
+        return cbor2.loads(payload)
+
+
+class RawCodec(Codec):
+    '''
+    bytes (or str as UTF-8) pass through
+    '''
+    name = 'raw'
+
+    def encode(self, obj):
+        if isinstance(obj, bytes):
+            return obj
+        if isinstance(obj, (bytearray, memoryview)):
+            return bytes(obj)
+        if isinstance(obj, str):
+            return obj.encode('utf-8')
+        raise TypeError('raw codec: %s is not bytes' % type(obj).__name__)
+
+    def decode(self, payload):
+        return payload
+
+
+_codecs = {}
+
+
+def register_codec(codec):
+    '''
+    codec: Codec object
+    '''
+    _codecs[codec.name] = codec
+
+
+def get_codec(codec):
+    '''
+    codec: Codec object or name
+
+    return: Codec object
+    '''
+    if isinstance(codec, Codec):
+        return codec
+
+    try:
+        return _codecs[codec]
+    except KeyError:
+        raise ValueError('unknown codec: %a (available: %s)' % (
+            codec, codec_names())) from None
+
+
+def codec_names():
+    return list(_codecs.keys())
+
+
+register_codec(JsonCodec())
+register_codec(RawCodec())
+if orjson is not None or ujson is not None:
+    register_codec(FastJsonCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+if cbor2 is not None:
+    register_codec(CborCodec())
+
+
+class TopicCodecs:
+    '''
+    codecs per topic filter (``+``, ``#`` allowed)
+
+    A literal topic wins over wildcard filters, and the most specific
+    wildcard filter wins (more levels before ``#``, then fewer ``+``).
+    '''
+    CACHE_MAX = 10000  # topics matched by wildcard filters
+
+    def __init__(self, default):
+        self.default = get_codec(default)
+        self._literal = {}  # {topic: Codec}
+        self._trie = TopicTrie()  # {topic_filter: (specificity, Codec)}
+        self._cache = {}  # {topic: Codec} matched by _trie
+
+    def set(self, topic_filter, codec):
+        '''
+        codec: Codec object or name, None: default codec
+
+        raise: ValueError  invalid topic filter or unknown codec
+        '''
+        levels = TopicTrie.check_filter(topic_filter)
+        if codec is not None:
+            codec = get_codec(codec)
+
+        self._literal.pop(topic_filter, None)
+        self._trie.remove(topic_filter)
+        self._cache = {}
+        if codec is None:
+            return
+
+        if TopicTrie.WC_ONE in levels or TopicTrie.WC_ALL in levels:
+            n_lv = len(levels) - (levels[-1] == TopicTrie.WC_ALL)
+            n_literal = n_lv - levels.count(TopicTrie.WC_ONE)
+            self._trie.add(topic_filter, ((n_lv, n_literal), codec))
+        else:
+            self._literal[topic_filter] = codec
+
+    def get(self, topic):
+        codec = self._literal.get(topic)
+        if codec is not None:
+            return codec
+        if len(self._trie) == 0:
+            return self.default
+
+        cache = self._cache
+        codec = cache.get(topic)
+        if codec is None:
+            ents = self._trie.match(topic)
+            codec = self.default
+            if ents:
+                codec = max(ents, key=lambda e: e[0])[1]
+            if len(cache) >= self.CACHE_MAX:
+                cache.clear()
+            cache[topic] = codec
+        return codec
+
+
+def bench(codec, obj, count):
+    '''
+    return: {'codec', 'bytes', 'encode_usec', 'decode_usec'}
+      *_usec: per message
+    '''
+    payload = codec.encode(obj)
+
+    t0 = time.perf_counter()
+    for _ in range(count):
+        codec.encode(obj)
+    t1 = time.perf_counter()
+    for _ in range(count):
+        codec.decode(payload)
+    t2 = time.perf_counter()
+
+    return {'codec': codec.name, 'bytes': len(payload),
+            'encode_usec': (t1 - t0) / count * 1e6,
+            'decode_usec': (t2 - t1) / count * 1e6}
+
+
+@click.command(context_settings=CONTEXT_SETTINGS,
+               help='benchmark of payload codecs')
+@click.option('--count', '-c', 'count', type=int, default=100000,
+              help='messages per codec')
+@click.option('--size', '-s', 'size', type=int, default=1,
+              help='number of data points in a message')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(count, size, debug):
+    log = get_logger(__name__, debug=debug)
+    log.debug('count=%s, size=%s', count, size)
+
+    ts = int(time.time() * 1000)
+    data = 12.34
+    if size > 1:
+        data = [{'ts': ts + i, 'value': i * 0.1, 'unit': 'C'}
+                for i in range(size)]
+    obj = {'data': data, 'ts': ts, 'ispublic': False}  # Beebotte style
+
+    print('%-10s %8s %12s %12s' % ('codec', 'bytes', 'encode[us]',
+                                   'decode[us]'))
+    for name in codec_names():
+        codec = get_codec(name)
+        if name == 'raw':
+            ret = bench(codec, get_codec('json').encode(obj), count)
+        else:
+            ret = bench(codec, obj, count)
+        print('%-10s %8d %12.3f %12.3f' % (
+            ret['codec'], ret['bytes'], ret['encode_usec'],
+            ret['decode_usec']))
+
+
+if __name__ == '__main__':
+    main()
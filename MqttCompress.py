@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+MqttCompress.py
+
+payload compression (after encode by the codec)
+
+A compressed payload is self-describing:
+
+  MAGIC(3) algo(1) compressed_bytes
+
+  algo  module
+  ----  ------
+  'z'   zlib
+  'b'   bz2
+  'x'   lzma
+
+Payloads smaller than ``threshold`` (or not getting smaller)
+are sent as they are. Received payloads starting with MAGIC are
+decompressed only by receivers with a Compressor
+(``Compressor(None)``: decompress only).
+
+A payload not compressed but starting with MAGIC (e.g. raw binary)
+can not be told from a compressed one. If it fails to decompress,
+it is passed as it is (counted as ``decompress_err``).
+
+Usage:
+------
+from MqttCompress import Compressor
+
+mqtt = Mqtt(None, None, compress=Compressor('zlib', threshold=1024))
+mqtt.send_data(big_doc, 'config/1')
+
+mqtt.compress_stats()
+# {'config/1': {'msgs': 10, 'compressed': 10, 'in_bytes': .., 'out_bytes': ..,
+#               'ratio': 0.12, 'compress_sec': .., 'decompressed': 0, ..}}
+#  in_bytes, out_bytes: all payloads, including ones sent as they are
+------
+
+benchmark:
+$ ./MqttCompress.py -s 1000
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import bz2
+import json
+import lzma
+import threading
+import time
+import zlib
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+MAGIC = b'\x00MZ'
+HDR_LEN = len(MAGIC) + 1
+
+ALGOS = {
+    # name: (id, compress(data, level), decompressor())
+    'zlib': (b'z', lambda d, lv: zlib.compress(d, lv),
+             zlib.decompressobj),
+    'bz2':  (b'b', lambda d, lv: bz2.compress(d, 9 if lv < 0 else lv),
+             bz2.BZ2Decompressor),
+    'lzma': (b'x', lambda d, lv: lzma.compress(d, preset=(
+        None if lv < 0 else lv)),
+             lzma.LZMADecompressor),
+}
+_DECOMP = {v[0]: v[2] for v in ALGOS.values()}  # {id: decompressor}
+
+DEF_MAX_SIZE = 64 * 1024 * 1024
+
+
+def is_compressed(payload):
+    return payload[:len(MAGIC)] == MAGIC
+
+
+def compress(payload, algo='zlib', level=-1):
+    '''
+    return: MAGIC + algo + compressed bytes
+    '''
+    algo_id, func, _ = ALGOS[algo]
+    return MAGIC + algo_id + func(payload, level)
+
+
+def decompress(payload, max_size=DEF_MAX_SIZE):
+    '''
+    return: payload as it is, if not compressed
+
+    raise: ValueError  unknown algo, truncated, or larger than ``max_size``
+    '''
+    if not is_compressed(payload):
+        return payload
+
+    d = _DECOMP.get(bytes(payload[len(MAGIC):HDR_LEN]))
+    if d is None:
+        raise ValueError('unknown compression: %a' % payload[:HDR_LEN])
+
+    dobj = d()
+    ret = dobj.decompress(payload[HDR_LEN:], max_size + 1)
+    if len(ret) > max_size:
+        raise ValueError('decompressed size > %s' % max_size)
+    if not dobj.eof:
+        raise ValueError('truncated compressed payload')
+    return ret
+
+
+class _TopicStats:
+    __slots__ = ('msgs', 'compressed', 'in_bytes', 'out_bytes',
+                 'compress_sec', 'decompressed', 'decompress_sec',
+                 'decompress_err')
+
+    def __init__(self):
+        for k in self.__slots__:
+            setattr(self, k, 0)
+
+    def to_dict(self):
+        ret = {k: getattr(self, k) for k in self.__slots__}
+        ret['ratio'] = (self.out_bytes / self.in_bytes
+                        if self.in_bytes else None)
+        return ret
+
+
+class Compressor:
+    DEF_THRESHOLD = 1024  # bytes
+
+    _log = get_logger(__name__, False)
+
+    def __init__(self, algo='zlib', threshold=DEF_THRESHOLD, level=-1,
+                 max_size=DEF_MAX_SIZE, debug=False):
+        '''
+        algo:      'zlib', 'bz2', 'lzma', None: decompress only
+        threshold: compress payloads of ``threshold`` bytes or larger
+        level:     compression level, -1: default of the algo
+        max_size:  max decompressed size
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('algo=%s, threshold=%s, level=%s, max_size=%s',
+                        algo, threshold, level, max_size)
+
+        if algo is not None and algo not in ALGOS:
+            raise ValueError('unknown algo: %a (available: %s)' % (
+                algo, list(ALGOS.keys())))
+
+        self.algo = algo
+        self.threshold = threshold
+        self.level = level
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._stats = {}  # {topic: _TopicStats}
+
+    def compress(self, topic, payload):
+        '''
+        return: compressed payload, or ``payload`` as it is
+        '''
+        if self.algo is None:
+            return payload
+
+        if len(payload) < self.threshold:
+            with self._lock:
+                st = self._topic_stats(topic)
+                st.msgs += 1
+                st.in_bytes += len(payload)
+                st.out_bytes += len(payload)
+            return payload
+
+        t0 = time.thread_time()
+        ret = compress(payload, self.algo, self.level)
+        sec = time.thread_time() - t0
+
+        smaller = len(ret) < len(payload)
+        if not smaller:
+            ret = payload
+
+        with self._lock:
+            st = self._topic_stats(topic)
+            st.msgs += 1
+            st.compress_sec += sec
+            st.in_bytes += len(payload)
+            st.out_bytes += len(ret)
+            if smaller:
+                st.compressed += 1
+
+        return ret
+
+    def decompress(self, topic, payload):
+        '''
+        return: decompressed payload,
+                ``payload`` as it is if not compressed
+                or failed to decompress (not compressed but MAGIC)
+        '''
+        if not is_compressed(payload):
+            return payload
+
+        t0 = time.thread_time()
+        try:
+            ret = decompress(payload, self.max_size)
+        except Exception as e:
+            self._log.warning('%s: %s:%s: passed as it is',
+                              topic, type(e).__name__, e)
+            with self._lock:
+                self._topic_stats(topic).decompress_err += 1
+            return payload
+        sec = time.thread_time() - t0
+
+        with self._lock:
+            st = self._topic_stats(topic)
+            st.decompressed += 1
+            st.decompress_sec += sec
+        return ret
+
+    def stats(self):
+        '''
+        return: {topic: {'msgs', 'compressed', 'in_bytes', 'out_bytes',
+                         'ratio', 'compress_sec',
+                         'decompressed', 'decompress_sec',
+                         'decompress_err'}}
+          *_bytes: all payloads, ratio: out_bytes / in_bytes
+          *_sec: CPU time
+        '''
+        with self._lock:
+            return {t: st.to_dict() for t, st in self._stats.items()}
+
+    def _topic_stats(self, topic):
+        '''
+        call with ``_lock`` held
+        '''
+        st = self._stats.get(topic)
+        if st is None:
+            st = self._stats[topic] = _TopicStats()
+        return st
+
+
+def get_compressor(compress):
+    '''
+    compress: Compressor object or algo name, None: no compression
+
+    return: Compressor object or None
+    '''
+    if compress is None or isinstance(compress, Compressor):
+        return compress
+    return Compressor(compress)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS,
+               help='benchmark of payload compression')
+@click.option('--count', '-c', 'count', type=int, default=100,
+              help='messages per algo')
+@click.option('--size', '-s', 'size', type=int, default=100,
+              help='number of data points in a message')
+@click.option('--level', '-l', 'level', type=int, default=-1,
+              help='compression level, -1: default')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(count, size, level, debug):
+    log = get_logger(__name__, debug=debug)
+    log.debug('count=%s, size=%s, level=%s', count, size, level)
+
+    ts = int(time.time() * 1000)
+    data = [{'ts': ts + i, 'value': i * 0.1, 'unit': 'C'}
+            for i in range(size)]
+    payload = json.dumps({'data': data, 'ts': ts}).encode('utf-8')
+
+    print('%-6s %8s %8s %7s %14s %14s' % (
+        'algo', 'bytes', 'comp', 'ratio', 'compress[us]', 'decompress[us]'))
+    for algo in ALGOS:
+        comp = compress(payload, algo, level)
+
+        t0 = time.perf_counter()
+        for _ in range(count):
+            compress(payload, algo, level)
+        t1 = time.perf_counter()
+        for _ in range(count):
+            decompress(comp)
+        t2 = time.perf_counter()
+
+        print('%-6s %8d %8d %7.3f %14.1f %14.1f' % (
+            algo, len(payload), len(comp), len(comp) / len(payload),
+            (t1 - t0) / count * 1e6, (t2 - t1) / count * 1e6))
+
+
+if __name__ == '__main__':
+    main()
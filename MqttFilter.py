@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+MqttFilter.py
+
+message filter applied on the network thread, before queueing
+
+Checks are done in this order, and the payload is decoded
+only if field predicates are given.
+
+  1. topics:  accept only matching topic filters
+  2. exclude: reject matching topic filters
+  3. fields:  {'key': value or func(value)}, 'key.sub' for nested dict
+  4. where:   func(payload)
+  5. sample:  accept the ratio (0.0 - 1.0) of the messages
+              passed 1-4 (every N-th)
+
+Usage:
+------
+from MqttFilter import MsgFilter, FilterSet
+
+f = MsgFilter(exclude=['sensor/+/debug'], sample=0.1,
+              fields={'data.temp': lambda v: v > 30})
+mqtt = Mqtt(cb, ['sensor/#'], filters={'sensor/#': f})
+
+f.stats()  # {'accepted': 10, 'rejected': 90, 'topic': .., 'sample': ..}
+mqtt.filter_stats()  # {'filtered': 90, 'filters': {'sensor/#': f.stats()}}
+------
+
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+from TopicTrie import TopicTrie
+
+
+class MsgFilter:
+    REASONS = ['topic', 'sample', 'field', 'error']
+
+    def __init__(self, topics=None, exclude=None, sample=1.0, fields=None,
+                 where=None):
+        '''
+        topics:  [topic_filter, ..], None: all
+        exclude: [topic_filter, ..]
+        sample:  ratio of messages to accept, of the ones passed the others
+        fields:  {key: value or func(value)}
+        where:   func(payload) ==> bool
+        '''
+        if not 0.0 <= sample <= 1.0:
+            raise ValueError('sample: %s not in [0.0, 1.0]' % sample)
+
+        self._topics = None
+        if topics is not None:
+            self._topics = TopicTrie()
+            for t in topics:
+                self._topics.add(t, True)
+
+        self._exclude = None
+        if exclude:
+            self._exclude = TopicTrie()
+            for t in exclude:
+                self._exclude.add(t, True)
+
+        self.sample = sample
+        self._acc = 0.0
+
+        self._fields = []  # [([key, ..], value or func), ..]
+        if fields:
+            self._fields = [(k.split('.'), v) for k, v in fields.items()]
+        self._where = where
+
+        self.n_accepted = 0
+        self.n_rejected = dict.fromkeys(self.REASONS, 0)
+
+    def accept(self, msg):
+        '''
+        msg: MqttMsg
+
+        return: True if accepted
+        '''
+        if self._topics is not None and not self._topics.match(msg.topic):
+            return self._reject('topic')
+        if self._exclude is not None and self._exclude.match(msg.topic):
+            return self._reject('topic')
+
+        if self._fields or self._where is not None:
+            try:
+                payload = msg.payload
+                if not self._check_fields(payload):
+                    return self._reject('field')
+                if self._where is not None and not self._where(payload):
+                    return self._reject('field')
+            except Exception:
+                return self._reject('error')
+
+        # after the predicates: sampling only the matching messages
+        # does not alias with the pattern of the traffic
+        if self.sample < 1.0:
+            self._acc += self.sample
+            if self._acc < 1.0:
+                return self._reject('sample')
+            self._acc -= 1.0
+
+        self.n_accepted += 1
+        return True
+
+    def stats(self):
+        ret = {'accepted': self.n_accepted,
+               'rejected': sum(self.n_rejected.values())}
+        ret.update(self.n_rejected)
+        return ret
+
+    def _reject(self, reason):
+        self.n_rejected[reason] += 1
+        return False
+
+    def _check_fields(self, payload):
+        for keys, cond in self._fields:
+            v = payload
+            for k in keys:
+                if not isinstance(v, dict) or k not in v:
+                    return False
+                v = v[k]
+            if callable(cond):
+                if not cond(v):
+                    return False
+            elif v != cond:
+                return False
+        return True
+
+
+class FilterSet:
+    '''
+    MsgFilters attached to subscriptions (topic filters)
+
+    A message is accepted if no filter is attached to the subscriptions
+    matching its topic, or any of them accepts it.
+    '''
+    def __init__(self, filters=None):
+        '''
+        filters: {topic_filter: MsgFilter}
+        '''
+        self._trie = TopicTrie()
+        self._filters = {}  # {topic_filter: MsgFilter}
+        self.n_filtered = 0
+
+        for topic_filter, msg_filter in (filters or {}).items():
+            self.set(topic_filter, msg_filter)
+
+    def __len__(self):
+        return len(self._trie)
+
+    def set(self, topic_filter, msg_filter):
+        '''
+        msg_filter: None: remove the filter of ``topic_filter``
+        '''
+        self._trie.remove(topic_filter)
+        self._filters.pop(topic_filter, None)
+        if msg_filter is not None:
+            self._trie.add(topic_filter, msg_filter)
+            self._filters[topic_filter] = msg_filter
+
+    def accept(self, msg):
+        flts = self._trie.match(msg.topic)
+        if not flts:
+            return True
+        for f in flts:
+            if f.accept(msg):
+                return True
+        self.n_filtered += 1
+        return False
+
+    def stats(self):
+        return {'filtered': self.n_filtered,
+                'filters': {tf: f.stats() for tf, f in self._filters.items()}}
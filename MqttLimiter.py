@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+MqttLimiter.py
+
+per-topic rate limit (token bucket) with coalescing
+
+A value is sent at once if the topic has a token.
+Otherwise it is kept as the pending value of the topic
+(the last value wins, or ``reducer(pending, value)``),
+and sent by the timer thread when a token is available.
+
+Usage:
+------
+from MqttLimiter import PubLimiter
+
+def send(key, value):
+    mqtt.publish(key, value)
+
+limiter = PubLimiter(send, rate=1, burst=1)       # 1 msg/sec/topic
+limiter = PubLimiter(send, rate=1, reducer=max)   # max in the interval
+limiter.start()
+limiter.submit('sensor/1', 21.5)
+  :
+limiter.end()   # send pending values
+------
+
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import threading
+import time
+
+
+class _Bucket:
+    __slots__ = ('tokens', 't_last', 'pending', 'has_pending')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.t_last = now
+        self.pending = None
+        self.has_pending = False
+
+
+class PubLimiter:
+    def __init__(self, send_func, rate=1.0, burst=1, reducer=None):
+        '''
+        send_func(key, value): called without lock held
+        rate:    tokens per sec per key
+        burst:   max tokens (values sent at once)
+        reducer: reducer(pending, value) ==> new pending
+                 None: the last value wins
+        '''
+        if rate <= 0:
+            raise ValueError('rate: %s <= 0' % rate)
+
+        self._send_func = send_func
+        self.rate = rate
+        self.burst = burst
+        self.reducer = reducer
+
+        self._lock = threading.Lock()
+        self._buckets = {}  # {key: _Bucket}
+
+        self._stop = threading.Event()
+        self._th = None
+
+        self.n_submit = 0
+        self.n_sent = 0
+        self.n_coalesced = 0
+
+    def submit(self, key, value):
+        '''
+        return: True if sent at once
+        '''
+        now = time.monotonic()
+        with self._lock:
+            self.n_submit += 1
+
+            b = self._buckets.get(key)
+            if b is None:
+                b = self._buckets[key] = _Bucket(self.burst, now)
+            else:
+                self._refill(b, now)
+
+            if not b.has_pending and b.tokens >= 1:
+                b.tokens -= 1
+                self.n_sent += 1
+                send = True
+            else:
+                if b.has_pending:
+                    self.n_coalesced += 1
+                    if self.reducer is not None:
+                        value = self.reducer(b.pending, value)
+                b.pending = value
+                b.has_pending = True
+                send = False
+
+        if send:
+            self._send_func(key, value)
+        return send
+
+    def flush(self, force=False):
+        '''
+        send pending values of the keys with a token
+
+        force: send all pending values
+        '''
+        now = time.monotonic()
+        sends = []
+        with self._lock:
+            for key, b in self._buckets.items():
+                if not b.has_pending:
+                    continue
+                self._refill(b, now)
+                if b.tokens < 1 and not force:
+                    continue
+                b.tokens = max(b.tokens - 1, 0)
+                sends.append((key, b.pending))
+                b.pending = None
+                b.has_pending = False
+            self.n_sent += len(sends)
+
+        for key, value in sends:
+            self._send_func(key, value)
+
+    def pending(self):
+        with self._lock:
+            return sum(1 for b in self._buckets.values() if b.has_pending)
+
+    def stats(self):
+        return {'submit': self.n_submit, 'sent': self.n_sent,
+                'coalesced': self.n_coalesced, 'pending': self.pending()}
+
+    def start(self):
+        '''
+        start the timer thread
+        '''
+        if self._th is not None:
+            return
+        self._stop.clear()
+        self._th = threading.Thread(target=self._timer, daemon=True)
+        self._th.start()
+
+    def end(self):
+        '''
+        stop the timer thread and send all pending values
+        '''
+        if self._th is not None:
+            self._stop.set()
+            self._th.join()
+            self._th = None
+        self.flush(force=True)
+
+    def _refill(self, b, now):
+        '''
+        call with ``_lock`` held
+        '''
+        b.tokens = min(self.burst, b.tokens + (now - b.t_last) * self.rate)
+        b.t_last = now
+
+    def _timer(self):
+        interval = min(max(0.5 / self.rate, 0.01), 1.0)
+        while not self._stop.wait(interval):
+            self.flush()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+MqttMsg.py
+
+received message, decoded only when ``payload`` is accessed
+
+Usage:
+------
+from MqttMsg import MqttMsg
+
+msg = MqttMsg(topic, raw_bytes, codec)
+msg.topic    # no decode
+msg.raw      # no decode
+msg.payload  # decoded at the first access (cached)
+msg['payload'], msg['topic']  # as ytMqtt's old dict
+------
+
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import time
+
+_NOT_YET = object()
+
+
+class MqttMsg:
+    __slots__ = ('topic', 'raw', 'timestamp', 'qos', 'retain',
+                 '_codec', '_payload')
+
+    def __init__(self, topic, raw, codec, timestamp=None, qos=0,
+                 retain=False):
+        '''
+        raw:       payload bytes as received
+        codec:     MqttCodec.Codec to decode ``raw``
+        timestamp: received time (time.monotonic()), None: now
+        '''
+        self.topic = topic
+        self.raw = raw
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+        self.qos = qos
+        self.retain = retain
+        self._codec = codec
+        self._payload = _NOT_YET
+
+    @property
+    def payload(self):
+        '''
+        raise: decode error of the codec
+        '''
+        if self._payload is _NOT_YET:
+            self._payload = self._codec.decode(self.raw)
+        return self._payload
+
+    @property
+    def decoded(self):
+        return self._payload is not _NOT_YET
+
+    def __getitem__(self, key):
+        if key == 'topic':
+            return self.topic
+        if key == 'payload':
+            return self.payload
+        raise KeyError(key)
+
+    def __repr__(self):
+        return 'MqttMsg(topic=%s, raw=%a)' % (self.topic, self.raw[:64])
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+MqttRecorder.py
+
+record received messages to a binary append log, and replay them
+
+  file:   MAGIC record record ..
+  record: ts(8, float sec) len(topic)(2) len(payload)(4) topic payload
+
+ts is the time received. A truncated last record (crash) is ignored
+by ``read_records()``, and cut off when the file is opened again
+for recording.
+
+Usage:
+------
+from MqttRecorder import MqttRecorder, read_records, replay
+
+rec = MqttRecorder('traffic.rec')
+mqtt = Mqtt(cb, ['ch1/#'], recorder=rec)
+  :
+mqtt.end()
+rec.close()
+
+for (ts, topic, payload) in read_records('traffic.rec'):
+    ..
+
+pub = Mqtt(None, None, host='localhost', codec='raw')
+pub.start()
+replay(pub, 'traffic.rec', speed=10)  # 0: max speed
+------
+
+$ ./MqttRecorder.py record traffic.rec 'ch1/#' -H mqtt.beebotte.com -u token_XXXX
+$ ./MqttRecorder.py replay traffic.rec -H localhost -s 10
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import os
+import struct
+import threading
+import time
+from Mqtt import Mqtt
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+MAGIC = b'MQTTREC1'
+REC_HDR = struct.Struct('<dHI')  # ts, len(topic), len(payload)
+
+
+class MqttRecorder:
+    DEF_BUF_SIZE = 1024 * 1024
+    DEF_FLUSH_SEC = 1.0
+
+    _log = get_logger(__name__, False)
+
+    def __init__(self, path, buf_size=DEF_BUF_SIZE, flush_sec=DEF_FLUSH_SEC,
+                 debug=False):
+        '''
+        flush_sec: flush the write buffer at most every ``flush_sec``
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('path=%s, buf_size=%s, flush_sec=%s',
+                        path, buf_size, flush_sec)
+
+        self.path = path
+        self.flush_sec = flush_sec
+
+        self._lock = threading.Lock()
+
+        # cut off a torn last record, not to append records after it
+        if os.path.exists(path):
+            size = valid_size(path)
+            if size < os.path.getsize(path):
+                self._log.warning('%s: truncate %s -> %s bytes',
+                                  path, os.path.getsize(path), size)
+                os.truncate(path, size)
+
+        self._f = open(path, 'ab', buffering=buf_size)
+        if self._f.tell() == 0:
+            self._f.write(MAGIC)
+        self._t_flush = time.monotonic()
+
+        self.count = 0
+        self.bytes = 0
+
+    def record(self, topic, payload, ts=None):
+        '''
+        payload: bytes as received
+        ts:      None: now
+        '''
+        if ts is None:
+            ts = time.time()
+        btopic = topic.encode('utf-8')
+
+        with self._lock:
+            if self._f is None:
+                return
+            self._f.write(REC_HDR.pack(ts, len(btopic), len(payload)))
+            self._f.write(btopic)
+            self._f.write(payload)
+
+            self.count += 1
+            self.bytes += REC_HDR.size + len(btopic) + len(payload)
+
+            now = time.monotonic()
+            if now - self._t_flush >= self.flush_sec:
+                self._f.flush()
+                self._t_flush = now
+
+    def flush(self):
+        with self._lock:
+            if self._f is not None:
+                self._f.flush()
+
+    def close(self):
+        self._log.debug('count=%s, bytes=%s', self.count, self.bytes)
+
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+
+def valid_size(path):
+    '''
+    return: file size up to the end of the last complete record
+
+    raise: ValueError  not a recording
+    '''
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if len(magic) < len(MAGIC) and MAGIC.startswith(magic):
+            return 0  # crashed while writing MAGIC
+        if magic != MAGIC:
+            raise ValueError('%s: not a recording' % path)
+
+        end = f.tell()
+        while True:
+            hdr = f.read(REC_HDR.size)
+            if len(hdr) < REC_HDR.size:
+                return end
+            _, topic_len, payload_len = REC_HDR.unpack(hdr)
+            rec_end = end + REC_HDR.size + topic_len + payload_len
+            if rec_end > size:
+                return end
+            f.seek(rec_end)
+            end = rec_end
+
+
+def read_records(path):
+    '''
+    yield (ts, topic, payload)
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s: not a recording' % path)
+
+        while True:
+            hdr = f.read(REC_HDR.size)
+            if len(hdr) < REC_HDR.size:
+                return
+            ts, topic_len, payload_len = REC_HDR.unpack(hdr)
+            body = f.read(topic_len + payload_len)
+            if len(body) < topic_len + payload_len:
+                return
+            yield ts, body[:topic_len].decode('utf-8'), body[topic_len:]
+
+
+def replay(mqtt, path, speed=1.0, qos=0, count=0):
+    '''
+    republish a recording by ``mqtt.send_data()``
+    (use ``codec='raw'`` to send payloads as recorded)
+
+    speed: 1: real time, N: N times faster, 0: max speed
+    count: 0: all
+
+    return: {'count', 'sec', 'msgs_per_sec', 'max_lag_sec'}
+    '''
+    n = 0
+    max_lag = 0.0
+    ts0 = None
+    t0 = time.perf_counter()
+    for (ts, topic, payload) in read_records(path):
+        if count > 0 and n >= count:
+            break
+
+        if speed > 0:
+            if ts0 is None:
+                ts0 = ts
+            target = t0 + (ts - ts0) / speed
+            wait_sec = target - time.perf_counter()
+            if wait_sec > 0:
+                time.sleep(wait_sec)
+            else:
+                max_lag = max(max_lag, -wait_sec)
+
+        mqtt.send_data(payload, topic, qos=qos)
+        n += 1
+
+    sec = time.perf_counter() - t0
+    return {'count': n, 'sec': sec,
+            'msgs_per_sec': n / sec if sec > 0 else None,
+            'max_lag_sec': max_lag}
+
+
+@click.command(context_settings=CONTEXT_SETTINGS,
+               help='''
+record received messages, or replay a recording
+
+\b
+  record FILE TOPIC..
+  replay FILE
+''')
+@click.argument('mode', type=click.Choice(['record', 'replay']))
+@click.argument('path', type=str)
+@click.argument('topics', type=str, nargs=-1)
+@click.option('--host', '-H', 'host', type=str, default=Mqtt.DEF_HOST,
+              help='server host')
+@click.option('--port', '-p', 'port', type=int, default=Mqtt.DEF_PORT,
+              help='server port')
+@click.option('--user', '-u', 'user', type=str, default='',
+              help='user name (Beebotte: token)')
+@click.option('--pw', '-P', 'pw', type=str, default='',
+              help='password')
+@click.option('--speed', '-s', 'speed', type=float, default=1.0,
+              help='replay speed, 0: max (replay)')
+@click.option('--qos', '-q', 'qos', type=int, default=0,
+              help='QoS (replay)')
+@click.option('--count', '-c', 'count', type=int, default=0,
+              help='max messages, 0: all (replay)')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(mode, path, topics, host, port, user, pw, speed, qos, count, debug):
+    log = get_logger(__name__, debug=debug)
+    log.debug('mode=%s, path=%s, topics=%s', mode, path, topics)
+
+    if mode == 'record':
+        if len(topics) == 0:
+            print('topics must be specified')
+            return
+
+        rec = MqttRecorder(path, debug=debug)
+        mqtt = Mqtt(None, list(topics), user=user, pw=pw,
+                    host=host, port=port, codec='raw',
+                    recorder=rec, debug=debug)
+        mqtt.start()
+        try:
+            while True:
+                time.sleep(10)
+                log.info('count=%s, bytes=%s', rec.count, rec.bytes)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            mqtt.end()
+            rec.close()
+        return
+
+    mqtt = Mqtt(None, None, user=user, pw=pw, host=host, port=port,
+                codec='raw', debug=debug)
+    mqtt.start()
+    try:
+        ret = replay(mqtt, path, speed=speed, qos=qos, count=count)
+        log.info('%s', ret)
+    finally:
+        mqtt.end()
+
+
+if __name__ == '__main__':
+    main()
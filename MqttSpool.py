@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+MqttSpool.py
+
+disk-backed store-and-forward spool for publishes
+
+Messages that can not be published (disconnected) are appended to
+memory-mapped segment files, and sent in batches by a drain thread
+after reconnect (or at once if put while connected).
+A failed batch is retried with backoff (``RETRY_SEC`` - ``RETRY_MAX``)
+until ``stop_drain()``. ``start_drain()`` wakes up a waiting retry.
+
+  path/
+    spool-00000001.seg   segment (preallocated ``seg_size`` bytes)
+    spool-00000002.seg
+    cursor               "seg offset" of the next record to send
+
+  record: length(4) crc32(4) qos(1) retain(1) len(topic)(2) topic payload
+
+* disk usage is bounded by ``seg_size`` * ``max_segs``.
+  When full, the oldest segment is dropped (counted as ``dropped``).
+* a torn record (crash while writing) fails the CRC check
+  and is discarded at the next open.
+* the cursor is saved after each batch is delivered,
+  so messages are delivered at least once (may be duplicated).
+* spooled messages may be delivered after newer messages.
+
+Usage:
+------
+from MqttSpool import MqttSpool
+
+spool = MqttSpool('/var/spool/mqtt', rate=200)
+bbt = BeebottePublisher('token_XXXX', spool=spool)
+bbt.start()
+  :
+bbt.end()
+spool.close()
+------
+
+$ ./MqttSpool.py /var/spool/mqtt   # show stats
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+class MqttSpool:
+    SEG_PREFIX = 'spool-'
+    SEG_SUFFIX = '.seg'
+    CURSOR_FILE = 'cursor'
+
+    HDR = struct.Struct('<II')     # len(body), crc32(body)
+    BODY = struct.Struct('<BBH')   # qos, retain, len(topic)
+
+    DEF_SEG_SIZE = 4 * 1024 * 1024
+    DEF_MAX_SEGS = 16
+    DEF_RATE = 0      # msgs/sec, 0: unlimited
+    DEF_BATCH = 100   # msgs
+    RETRY_SEC = 1     # first backoff after a failed batch
+    RETRY_MAX = 30    # sec
+
+    _log = get_logger(__name__, False)
+
+    def __init__(self, path, seg_size=DEF_SEG_SIZE, max_segs=DEF_MAX_SEGS,
+                 rate=DEF_RATE, batch=DEF_BATCH, sync=False, debug=False):
+        '''
+        rate:  max drain rate [msgs/sec], 0: unlimited
+        batch: msgs per drain batch
+        sync:  msync() after each put (survive power loss, slow)
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('path=%s, seg_size=%s, max_segs=%s',
+                        path, seg_size, max_segs)
+        self._log.debug('rate=%s, batch=%s, sync=%s', rate, batch, sync)
+
+        if max_segs < 2:
+            raise ValueError('max_segs: %s < 2' % max_segs)
+
+        self.path = path
+        self.seg_size = seg_size
+        self.max_segs = max_segs
+        self.rate = rate
+        self.batch = batch
+        self.sync = sync
+
+        self._lock = threading.Lock()
+        self._segs = []       # [seg_no, ..]
+        self._seg_n = {}      # {seg_no: unsent records}
+
+        self._wseg = None     # segment to write
+        self._wmm = None
+        self._woff = 0
+
+        self._rseg = None     # next record to send
+        self._roff = 0
+        self._rmm = None      # mmap of _rseg if not _wseg
+
+        self._drain_th = None
+        self._draining = False
+        self._wake = threading.Event()  # retry at once
+
+        self.n_put = 0
+        self.n_sent = 0
+        self.n_dropped = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self._open()
+
+    def put(self, topic, payload, qos=0, retain=False):
+        '''
+        payload: bytes
+        '''
+        if self._dbg:
+            self._log.debug('topic=%s, len(payload)=%s', topic, len(payload))
+
+        btopic = topic.encode('utf-8')
+        body = self.BODY.pack(qos, int(retain), len(btopic)) + \
+            btopic + payload
+        rec_len = self.HDR.size + len(body)
+        if rec_len > self.seg_size:
+            raise ValueError('record size %s > seg_size %s' %
+                             (rec_len, self.seg_size))
+
+        with self._lock:
+            if self._woff + rec_len > self.seg_size:
+                self._new_seg()
+
+            off = self._woff
+            # body first, the header makes the record valid
+            self._wmm[off + self.HDR.size:off + rec_len] = body
+            self._wmm[off:off + self.HDR.size] = self.HDR.pack(
+                len(body), zlib.crc32(body))
+            if self.sync:
+                self._wmm.flush()
+
+            self._woff += rec_len
+            self._seg_n[self._wseg] += 1
+            self.n_put += 1
+
+    def pending(self):
+        with self._lock:
+            return sum(self._seg_n.values())
+
+    def stats(self):
+        with self._lock:
+            return {'pending': sum(self._seg_n.values()),
+                    'segments': len(self._segs),
+                    'put': self.n_put, 'sent': self.n_sent,
+                    'dropped': self.n_dropped}
+
+    def peek(self, n):
+        '''
+        return: ([(topic, payload, qos, retain), ..], pos)
+          pass ``pos`` to ``commit()`` when delivered
+        '''
+        with self._lock:
+            recs = []
+            seg, off = self._rseg, self._roff
+            seg_n = 0  # records read in ``seg``
+            mm = self._seg_mm(seg)
+            while len(recs) < n:
+                rec, next_off = self._read(mm, off)
+                if rec is not None:
+                    recs.append(rec)
+                    off = next_off
+                    seg_n += 1
+                    continue
+
+                # end of segment
+                if seg == self._wseg:
+                    break
+                seg = self._segs[self._segs.index(seg) + 1]
+                off = 0
+                seg_n = 0
+                mm = self._seg_mm(seg)
+
+            return recs, (seg, off, seg_n)
+
+    def commit(self, pos):
+        '''
+        mark records until ``pos`` (from ``peek()``) as sent
+        '''
+        seg, off, seg_n = pos
+        with self._lock:
+            if seg not in self._seg_n:
+                # dropped while sending
+                self._log.warning('seg %s: dropped while sending', seg)
+                return
+
+            while self._rseg != seg:
+                self._n_sent(self._rseg, self._seg_n[self._rseg])
+                self._del_seg(self._rseg)
+                self._rseg = self._segs[0]
+            self._n_sent(seg, min(seg_n, self._seg_n[seg]))
+            self._roff = off
+            self._save_cursor()
+
+    def start_drain(self, publish):
+        '''
+        send pending records in a background thread,
+        or wake it up if running
+
+        publish(records): return True if all records are delivered
+          records: [(topic, payload, qos, retain), ..]
+        '''
+        self._log.debug('')
+
+        with self._lock:
+            self._draining = True
+            if self._drain_th is not None and self._drain_th.is_alive():
+                self._wake.set()
+                return
+            self._wake.clear()
+            self._drain_th = threading.Thread(target=self._drain,
+                                              args=(publish,), daemon=True)
+            self._drain_th.start()
+
+    @property
+    def draining(self):
+        '''
+        False after stop_drain(): ``publish()`` should return soon
+        '''
+        return self._draining
+
+    def stop_drain(self):
+        self._log.debug('')
+
+        self._draining = False
+        self._wake.set()
+        th = self._drain_th
+        if th is not None and th is not threading.current_thread():
+            th.join()
+        self._drain_th = None
+
+    def close(self):
+        self._log.debug('')
+
+        self.stop_drain()
+        with self._lock:
+            if self._rmm is not None:
+                self._rmm[1].close()
+                self._rmm = None
+            if self._wmm is not None:
+                self._wmm.flush()
+                self._wmm.close()
+                self._wmm = None
+
+        self._log.debug('done')
+
+    def _drain(self, publish):
+        self._log.debug('start: pending=%s', self.pending())
+
+        retry_sec = self.RETRY_SEC
+        while self._draining:
+            t0 = time.monotonic()
+
+            recs, pos = self.peek(self.batch)
+            if len(recs) == 0:
+                with self._lock:
+                    if sum(self._seg_n.values()) > 0:
+                        continue  # put after peek()
+                    # start_drain() starts a new thread from here
+                    self._drain_th = None
+                break
+
+            if not publish(recs):
+                if not self._draining:
+                    break
+                self._log.warning('publish failed: pending=%s, retry: %s sec',
+                                  self.pending(), retry_sec)
+                self._wake.wait(retry_sec)
+                self._wake.clear()
+                retry_sec = min(retry_sec * 2, self.RETRY_MAX)
+                continue
+            self.commit(pos)
+            retry_sec = self.RETRY_SEC
+
+            if self.rate > 0:
+                wait_sec = len(recs) / self.rate - (time.monotonic() - t0)
+                if wait_sec > 0:
+                    time.sleep(wait_sec)
+
+        self._log.debug('done: pending=%s', self.pending())
+
+    def _open(self):
+        segs = []
+        for f in os.listdir(self.path):
+            if f.startswith(self.SEG_PREFIX) and f.endswith(self.SEG_SUFFIX):
+                segs.append(int(f[len(self.SEG_PREFIX):-len(self.SEG_SUFFIX)]))
+        segs.sort()
+
+        self._rseg, self._roff = self._load_cursor()
+        if self._rseg is None or self._rseg not in segs:
+            self._rseg, self._roff = (segs[0] if segs else 1), 0
+
+        # already sent
+        for seg in segs:
+            if seg < self._rseg:
+                os.remove(self._seg_file(seg))
+        self._segs = [seg for seg in segs if seg >= self._rseg]
+
+        if len(self._segs) == 0:
+            self._segs = [self._rseg]
+            self._seg_n[self._rseg] = 0
+            self._open_wseg(self._rseg)
+            self._save_cursor()
+            return
+
+        # count unsent records
+        for seg in self._segs:
+            mm = self._seg_mm(seg)
+            off = self._roff if seg == self._rseg else 0
+            n = 0
+            while True:
+                rec, next_off = self._read(mm, off)
+                if rec is None:
+                    break
+                n += 1
+                off = next_off
+            self._seg_n[seg] = n
+        self._close_rmm()
+
+        self._open_wseg(self._segs[-1])
+        self._log.debug('segs=%s, pending=%s',
+                        self._segs, sum(self._seg_n.values()))
+
+    def _open_wseg(self, seg):
+        fd = os.open(self._seg_file(seg), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < self.seg_size:
+                os.ftruncate(fd, self.seg_size)
+            self._wmm = mmap.mmap(fd, self.seg_size)
+        finally:
+            os.close(fd)
+        self._wseg = seg
+
+        # skip valid records, clear a torn one
+        off = 0
+        while True:
+            rec, next_off = self._read(self._wmm, off)
+            if rec is None:
+                break
+            off = next_off
+        rest = bytes(self.seg_size - off)
+        if self._wmm[off:] != rest:
+            self._log.warning('seg %s: discard broken data from %s',
+                              seg, off)
+            self._wmm[off:] = rest
+        self._woff = off
+
+    def _new_seg(self):
+        '''
+        call with ``_lock`` held
+        '''
+        self._wmm.flush()
+        self._wmm.close()
+        self._wmm = None
+
+        if len(self._segs) >= self.max_segs:
+            seg = self._segs[0]
+            self.n_dropped += self._seg_n[seg]
+            self._log.warning('spool full: drop seg %s (%s msgs)',
+                              seg, self._seg_n[seg])
+            self._del_seg(seg)
+            if seg == self._rseg:
+                self._rseg, self._roff = self._segs[0], 0
+                self._save_cursor()
+
+        seg = self._segs[-1] + 1
+        self._segs.append(seg)
+        self._seg_n[seg] = 0
+        self._open_wseg(seg)
+
+    def _del_seg(self, seg):
+        '''
+        call with ``_lock`` held
+        '''
+        if self._rmm is not None and self._rmm[0] == seg:
+            self._close_rmm()
+        self._segs.remove(seg)
+        del self._seg_n[seg]
+        os.remove(self._seg_file(seg))
+
+    def _n_sent(self, seg, n):
+        self._seg_n[seg] -= n
+        self.n_sent += n
+
+    def _seg_mm(self, seg):
+        '''
+        call with ``_lock`` held
+        '''
+        if seg == self._wseg:
+            return self._wmm
+        if self._rmm is not None and self._rmm[0] == seg:
+            return self._rmm[1]
+
+        self._close_rmm()
+        with open(self._seg_file(seg), 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._rmm = (seg, mm)
+        return mm
+
+    def _close_rmm(self):
+        if self._rmm is not None:
+            self._rmm[1].close()
+            self._rmm = None
+
+    def _read(self, mm, off):
+        '''
+        return: ((topic, payload, qos, retain), next_off)
+                (None, off) if end of segment or broken
+        '''
+        if off + self.HDR.size > len(mm):
+            return None, off
+
+        body_len, crc = self.HDR.unpack_from(mm, off)
+        start = off + self.HDR.size
+        end = start + body_len
+        if body_len < self.BODY.size or end > len(mm):
+            return None, off
+
+        body = mm[start:end]
+        if zlib.crc32(body) != crc:
+            return None, off
+
+        qos, retain, topic_len = self.BODY.unpack_from(body)
+        p = self.BODY.size
+        topic = body[p:p + topic_len].decode('utf-8')
+        payload = body[p + topic_len:]
+        return (topic, payload, qos, bool(retain)), end
+
+    def _seg_file(self, seg):
+        return os.path.join(self.path, '%s%08d%s' % (
+            self.SEG_PREFIX, seg, self.SEG_SUFFIX))
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.path, self.CURSOR_FILE)) as f:
+                seg, off = f.read().split()
+                return int(seg), int(off)
+        except (OSError, ValueError) as e:
+            self._log.debug('%s:%s', type(e).__name__, e)
+            return None, 0
+
+    def _save_cursor(self):
+        '''
+        call with ``_lock`` held
+        '''
+        path = os.path.join(self.path, self.CURSOR_FILE)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('%d %d\n' % (self._rseg, self._roff))
+        os.replace(tmp, path)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS,
+               help='show MqttSpool stats')
+@click.argument('path', type=click.Path(exists=True, file_okay=False))
+@click.option('--list', '-l', 'list_recs', type=int, default=0,
+              help='list first N pending records')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(path, list_recs, debug):
+    log = get_logger(__name__, debug=debug)
+    log.debug('path=%s', path)
+
+    spool = MqttSpool(path, debug=debug)
+    print(spool.stats())
+    if list_recs > 0:
+        recs, _ = spool.peek(list_recs)
+        for (topic, payload, qos, retain) in recs:
+            print('%s qos=%s retain=%s %a' % (topic, qos, retain, payload))
+    spool.close()
+
+
+if __name__ == '__main__':
+    main()
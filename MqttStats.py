@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+MqttStats.py
+
+statistics for Mqtt.py and ytMqtt.py
+
+LatencyHist:
+  HDR style histogram (log-linear buckets, about 1% precision)
+
+Metrics:
+  counters, gauges and timers, exported as a dict
+  or Prometheus text format
+
+Usage:
+------
+from MqttStats import LatencyHist, Metrics
+
+hist = LatencyHist(budget=500)
+hist.record(12.3)
+hist.summary()  # {'count', 'min', 'max', 'mean',
+                #  'p50', 'p90', 'p99', 'p999', 'over_budget'}
+
+metrics = Metrics('mqtt', {'app': 'sensor1'})
+mqtt = Mqtt(cb, topics, metrics=metrics)
+metrics.snapshot()      # {'received_total': 123, ..}
+metrics.prometheus()    # text format
+metrics.dump('/var/lib/node_exporter/mqtt.prom')
+metrics.serve(9100)     # http://localhost:9100/metrics
+------
+
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import math
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class LatencyHist:
+    SUB_BUCKETS = 64  # per power of 2
+
+    PERCENTILES = [('p50', 0.50), ('p90', 0.90), ('p99', 0.99),
+                   ('p999', 0.999)]
+
+    def __init__(self, budget=None):
+        '''
+        budget: values over this are counted as ``over_budget``
+        '''
+        self.budget = budget
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._buckets = {}  # {key: count}
+            self.count = 0
+            self.n_zero = 0     # <= 0 (clock skew)
+            self.n_over = 0
+            self.total = 0.0
+            self.min = None
+            self.max = None
+
+    def record(self, v):
+        with self._lock:
+            self.count += 1
+            self.total += v
+            if self.min is None or v < self.min:
+                self.min = v
+            if self.max is None or v > self.max:
+                self.max = v
+            if self.budget is not None and v > self.budget:
+                self.n_over += 1
+
+            if v <= 0:
+                self.n_zero += 1
+                return
+
+            m, e = math.frexp(v)  # v = m * 2**e, 0.5 <= m < 1
+            key = e * self.SUB_BUCKETS + int((m - 0.5) * 2 *
+                                             self.SUB_BUCKETS)
+            self._buckets[key] = self._buckets.get(key, 0) + 1
+
+    def percentile(self, p):
+        '''
+        p: 0.0 .. 1.0
+
+        return: upper bound of the bucket, None if no data
+        '''
+        with self._lock:
+            return self._percentiles([p])[0]
+
+    def summary(self):
+        with self._lock:
+            ret = {'count': self.count, 'min': self.min, 'max': self.max,
+                   'mean': self.total / self.count if self.count else None}
+            pcts = self._percentiles([p for _, p in self.PERCENTILES])
+            for (name, _), v in zip(self.PERCENTILES, pcts):
+                ret[name] = v
+            if self.budget is not None:
+                ret['over_budget'] = self.n_over
+            return ret
+
+    def _percentiles(self, ps):
+        '''
+        call with ``_lock`` held
+        '''
+        if self.count == 0:
+            return [None for _ in ps]
+
+        keys = sorted(self._buckets)
+        ret = []
+        for p in ps:
+            target = max(1, math.ceil(self.count * p))
+
+            n = self.n_zero
+            if n >= target:
+                ret.append(0.0)
+                continue
+
+            v = self.max
+            for key in keys:
+                n += self._buckets[key]
+                if n >= target:
+                    e, sub = divmod(key, self.SUB_BUCKETS)
+                    v = math.ldexp(0.5 + (sub + 1) /
+                                   (2 * self.SUB_BUCKETS), e)
+                    break
+            ret.append(min(v, self.max))
+        return ret
+
+
+class Metrics:
+    '''
+    counter: inc(name, n)       e.g. 'received_total'
+    gauge:   set(name, v) or gauge_func(name, func)
+    timer:   observe(name, sec) ==> name_sum, name_count
+
+    Clients update metrics only if a Metrics object is given,
+    so disabled metrics cost only a ``None`` check.
+    '''
+    def __init__(self, prefix='mqtt', labels=None):
+        '''
+        labels: {name: value} added to all metrics (Prometheus)
+        '''
+        self.prefix = prefix
+        self.labels = labels if labels is not None else {}
+
+        self._lock = threading.Lock()
+        self._counter = {}   # {name: n}
+        self._gauge = {}     # {name: v}
+        self._gauge_func = {}  # {name: func}
+        self._timer = {}     # {name: [sum, count]}
+
+        self._svr = None
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self._counter[name] = self._counter.get(name, 0) + n
+
+    def set(self, name, v):
+        self._gauge[name] = v
+
+    def gauge_func(self, name, func):
+        '''
+        func() is called at snapshot
+        '''
+        self._gauge_func[name] = func
+
+    def observe(self, name, sec):
+        with self._lock:
+            t = self._timer.get(name)
+            if t is None:
+                t = self._timer[name] = [0.0, 0]
+            t[0] += sec
+            t[1] += 1
+
+    def snapshot(self):
+        '''
+        return: {name: value}
+        '''
+        with self._lock:
+            ret = dict(self._counter)
+            for name, (total, count) in self._timer.items():
+                ret[name + '_sum'] = total
+                ret[name + '_count'] = count
+        ret.update(self._gauge)
+        for name, func in list(self._gauge_func.items()):
+            ret[name] = func()
+        return ret
+
+    def prometheus(self):
+        '''
+        return: Prometheus text format
+        '''
+        labels = ''
+        if len(self.labels) > 0:
+            labels = '{%s}' % ','.join(
+                '%s="%s"' % (k, str(v).replace('"', '\\"'))
+                for k, v in sorted(self.labels.items()))
+
+        with self._lock:
+            counters = sorted(self._counter.items())
+            timers = sorted((k, list(v)) for k, v in self._timer.items())
+        gauges = dict(self._gauge)
+        for name, func in list(self._gauge_func.items()):
+            gauges[name] = func()
+
+        lines = []
+        for name, v in counters:
+            name = '%s_%s' % (self.prefix, name)
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, labels, v))
+        for name, v in sorted(gauges.items()):
+            name = '%s_%s' % (self.prefix, name)
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s%s %s' % (name, labels, v))
+        for name, (total, count) in timers:
+            name = '%s_%s' % (self.prefix, name)
+            lines.append('# TYPE %s summary' % name)
+            lines.append('%s_sum%s %s' % (name, labels, total))
+            lines.append('%s_count%s %s' % (name, labels, count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        '''
+        write Prometheus text format to ``path`` atomically
+        (e.g. for node_exporter textfile collector)
+        '''
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+    def serve(self, port, host=''):
+        '''
+        serve ``/metrics`` in a background thread
+
+        return: port
+        '''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._svr = ThreadingHTTPServer((host, port), Handler)
+        self._svr.daemon_threads = True
+        threading.Thread(target=self._svr.serve_forever,
+                         daemon=True).start()
+        return self._svr.server_address[1]
+
+    def end(self):
+        if self._svr is not None:
+            self._svr.shutdown()
+            self._svr.server_close()
+            self._svr = None
@@ -0,0 +1,767 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+MqttStream.py
+
+send a large file/bytes/iterator as sequenced chunks on a topic,
+and reassemble them into a preallocated buffer
+
+  packet: HDR body
+  HDR:    MAGIC(4) type(1) sid(16) seq(4) offset(8) crc32(4)
+
+  type  seq       offset      crc32       body
+  ----  --------  ----------  ----------  --------------------
+  'B'   0         total size  chunk size  meta (JSON)
+  'D'   seq       offset      crc32(body) data
+  'E'   n chunks  total size  0           sha256 of the whole
+
+Chunks with a CRC error are dropped. Missing chunks (and 'B', 'E')
+are requested on ``topic + '/nack'``, and resent by the resend thread
+of the sender (not on the network thread: files are read again).
+A received stream is at most ``max_size`` bytes, and at most
+``max_streams`` streams are reassembled at the same time.
+
+Usage:
+------
+from Mqtt import Mqtt
+from MqttStream import StreamSender, StreamReceiver
+
+mqtt = Mqtt(None, None, host='localhost')
+sender = StreamSender(mqtt, 'file/1')
+mqtt.start()
+sender.start()
+sid = sender.send('image.jpg', meta={'name': 'image.jpg'})
+
+def done(sid, meta, data):  # data: memoryview
+    open(meta['name'], 'wb').write(data)
+
+mqtt = Mqtt(None, None, host='localhost')
+receiver = StreamReceiver(mqtt, 'file/1', done, max_size=64 * 1024 * 1024)
+mqtt.start()
+receiver.start()
+------
+
+$ ./MqttStream.py recv file/1 -o /tmp/recv -H localhost
+$ ./MqttStream.py send file/1 image.jpg -H localhost
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import hashlib
+import json
+import os
+import queue
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+from Mqtt import Mqtt
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+MAGIC = b'MQS1'
+HDR = struct.Struct('<4sc16sIQI')  # magic, type, sid, seq, offset, crc32
+T_BEGIN = b'B'
+T_DATA = b'D'
+T_END = b'E'
+
+NACK_SUFFIX = '/nack'
+
+
+def _pack(ptype, sid, seq, offset, crc, body):
+    '''
+    return: bytearray (one copy of ``body``)
+    '''
+    buf = bytearray(HDR.size + len(body))
+    HDR.pack_into(buf, 0, MAGIC, ptype, sid, seq, offset, crc)
+    buf[HDR.size:] = body
+    return buf
+
+
+class _SendStream:
+    __slots__ = ('sid', 'src', 'size', 'n_chunks', 'begin', 'end',
+                 'cache', 'cache_bytes', 't_end')
+
+    def __init__(self, sid, src, begin):
+        self.sid = sid
+        self.src = src      # path or memoryview, None: use cache
+        self.size = 0
+        self.n_chunks = None
+        self.begin = begin  # 'B' packet
+        self.end = None     # 'E' packet
+        self.cache = {}     # {seq: packet} if src is None
+        self.cache_bytes = 0
+        self.t_end = None
+
+
+class StreamSender:
+    DEF_CHUNK_SIZE = 64 * 1024
+    DEF_WINDOW = 16           # chunks not yet written to the socket
+    DEF_KEEP_SEC = 60         # keep finished streams for resend
+    DEF_CACHE_SIZE = 16 * 1024 * 1024  # per stream, iterator sources
+    NACK_QSIZE = 100   # NACKs waiting for the resend thread
+    WAIT_TIMEOUT = 10  # sec
+
+    _log = get_logger(__name__, False)
+
+    def __init__(self, mqtt, topic, chunk_size=DEF_CHUNK_SIZE, qos=1,
+                 window=DEF_WINDOW, keep_sec=DEF_KEEP_SEC,
+                 cache_size=DEF_CACHE_SIZE, debug=False):
+        '''
+        mqtt:       Mqtt object (started by the caller),
+                    chunks are sent by ``mqtt.publish()``
+        window:     max chunks queued in paho, bounds the memory
+        keep_sec:   resend chunks on NACK for ``keep_sec`` after sent
+        cache_size: max bytes kept for resend,
+                    if the source can not be read again (iterator, file obj)
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('topic=%s, chunk_size=%s, qos=%s, window=%s',
+                        topic, chunk_size, qos, window)
+        self._log.debug('keep_sec=%s, cache_size=%s', keep_sec, cache_size)
+
+        self._mqtt = mqtt
+        self.topic = topic
+        self.nack_topic = topic + NACK_SUFFIX
+        self.chunk_size = chunk_size
+        self.qos = qos
+        self.window = window
+        self.keep_sec = keep_sec
+        self.cache_size = cache_size
+
+        self._mqtt.set_codec(self.topic, 'raw')
+        self._mqtt.set_codec(self.nack_topic, 'json')
+
+        self._lock = threading.Lock()
+        self._streams = {}  # {sid: _SendStream}
+
+        self._nackq = queue.Queue(self.NACK_QSIZE)  # MqttMsg, None: end
+        self._th = None
+
+        self.n_streams = 0
+        self.n_chunks = 0
+        self.n_bytes = 0
+        self.n_resent = 0
+        self.n_failed = 0
+
+    def start(self):
+        if self._th is None:
+            self._th = threading.Thread(target=self._resender, daemon=True)
+            self._th.start()
+
+        self._mqtt.route(self.nack_topic, self._on_nack, qos=self.qos,
+                         raw=True)
+
+    def end(self):
+        self._mqtt.unroute(self.nack_topic, self._on_nack)
+
+        if self._th is not None:
+            self._nackq.put(None)
+            self._th.join()
+            self._th = None
+
+    def send(self, src, meta=None, size=0):
+        '''
+        src:  file path, bytes-like, binary file object
+              or iterator of bytes-like
+        meta: JSON serializable, passed to the receiver
+        size: total size of an iterator, 0: unknown
+              (the receiver preallocates the buffer if known)
+
+        return: stream id (hex),
+                None: publish error (disconnected, paho queue full, ..)
+        '''
+        sid = uuid.uuid4().bytes
+        self._log.debug('sid=%s, src=%s, meta=%s', sid.hex(), src, meta)
+
+        keep = None
+        if isinstance(src, str):
+            size = os.path.getsize(src)
+            keep = src
+            chunks = self._path_chunks(src)
+        elif isinstance(src, (bytes, bytearray, memoryview)):
+            keep = memoryview(src).cast('B')
+            size = len(keep)
+            chunks = self._mem_chunks(keep)
+        elif hasattr(src, 'readinto'):
+            chunks = self._file_chunks(src)
+        else:
+            chunks = self._iter_chunks(src)
+
+        meta_bytes = json.dumps(meta).encode('utf-8')
+        begin = _pack(T_BEGIN, sid, 0, size, self.chunk_size, meta_bytes)
+        st = _SendStream(sid, keep, begin)
+        with self._lock:
+            self._expire()
+            self._streams[sid] = st
+            self.n_streams += 1
+
+        sha = hashlib.sha256()
+        inflight = deque()
+        seq = 0
+        offset = 0
+        try:
+            self._send_packet(begin, inflight)
+
+            for body in chunks:
+                sha.update(body)
+                pkt = _pack(T_DATA, sid, seq, offset, zlib.crc32(body), body)
+                if st.src is None and st.cache_bytes < self.cache_size:
+                    st.cache[seq] = pkt
+                    st.cache_bytes += len(pkt)
+                self._send_packet(pkt, inflight)
+
+                self.n_chunks += 1
+                self.n_bytes += len(body)
+                seq += 1
+                offset += len(body)
+
+            st.size = offset
+            st.n_chunks = seq
+            st.end = _pack(T_END, sid, seq, offset, 0, sha.digest())
+            self._send_packet(st.end, inflight)
+
+            while len(inflight) > 0:
+                inflight.popleft().wait_for_publish(self.WAIT_TIMEOUT)
+
+        except (RuntimeError, ValueError) as e:
+            # wait_for_publish(): publish failed or not queued
+            self._log.error('sid=%s: %s:%s: %s chunks sent',
+                            sid.hex(), type(e).__name__, e, seq)
+            inflight.clear()
+            self.n_failed += 1
+            return None
+
+        finally:
+            chunks.close()
+            st.t_end = time.monotonic()  # expired after ``keep_sec``
+
+        self._log.debug('sid=%s: %s chunks, %s bytes', sid.hex(), seq, offset)
+        return sid.hex()
+
+    def stats(self):
+        '''
+        return: {'streams', 'chunks', 'bytes', 'resent', 'failed', 'kept'}
+          failed: streams not sent by publish errors
+          kept:   streams kept for resend
+        '''
+        with self._lock:
+            n_keep = len(self._streams)
+        return {'streams': self.n_streams, 'chunks': self.n_chunks,
+                'bytes': self.n_bytes, 'resent': self.n_resent,
+                'failed': self.n_failed, 'kept': n_keep}
+
+    def _send_packet(self, pkt, inflight):
+        # not limited nor batched: every chunk must be sent
+        for info in self._mqtt.publish(pkt, self.topic, qos=self.qos):
+            if info is None:  # spooled
+                continue
+            inflight.append(info)
+            if len(inflight) > self.window:
+                inflight.popleft().wait_for_publish(self.WAIT_TIMEOUT)
+
+    def _path_chunks(self, path):
+        '''
+        the file is opened at the first chunk, closed by close()
+        '''
+        with open(path, 'rb') as f:
+            yield from self._file_chunks(f)
+
+    def _file_chunks(self, f):
+        while True:
+            buf = bytearray(self.chunk_size)
+            n = f.readinto(buf)
+            if not n:
+                return
+            yield memoryview(buf)[:n]
+
+    def _mem_chunks(self, mv):
+        for off in range(0, len(mv), self.chunk_size):
+            yield mv[off:off + self.chunk_size]
+
+    def _iter_chunks(self, it):
+        '''
+        re-chunk to ``chunk_size``
+        '''
+        buf = bytearray()
+        for data in it:
+            buf += data
+            while len(buf) >= self.chunk_size:
+                yield buf[:self.chunk_size]
+                del buf[:self.chunk_size]
+        if buf:
+            yield buf
+
+    def _chunk(self, st, seq):
+        '''
+        return: DATA packet of ``seq``, None: not available
+        '''
+        if st.src is None:
+            return st.cache.get(seq)
+
+        offset = seq * self.chunk_size
+        if isinstance(st.src, str):
+            with open(st.src, 'rb') as f:
+                f.seek(offset)
+                body = f.read(self.chunk_size)
+        else:
+            body = st.src[offset:offset + self.chunk_size]
+        return _pack(T_DATA, st.sid, seq, offset, zlib.crc32(body), body)
+
+    def _on_nack(self, m):
+        '''
+        network thread: pass to the resend thread
+        '''
+        try:
+            self._nackq.put_nowait(m)
+        except queue.Full:
+            # requested again by the receiver
+            self._log.warning('%s: too many NACKs: ignored', m)
+
+    def _resender(self):
+        while True:
+            m = self._nackq.get()
+            if m is None:
+                break
+            try:
+                self._resend(m)
+            except (RuntimeError, ValueError) as e:
+                # wait_for_publish(): publish failed or not queued
+                self._log.warning('%s: %s:%s', m, type(e).__name__, e)
+
+    def _resend(self, m):
+        try:
+            nack = m.payload
+            sid = bytes.fromhex(nack['sid'])
+        except Exception as e:
+            self._log.warning('%s: %s:%s', m, type(e).__name__, e)
+            return
+
+        with self._lock:
+            self._expire()
+            st = self._streams.get(sid)
+        if st is None:
+            if self._dbg:
+                self._log.debug('sid=%s: unknown or expired', nack['sid'])
+            return
+        if self._dbg:
+            self._log.debug('nack=%s', nack)
+
+        pkts = []
+        if nack.get('begin'):
+            pkts.append(st.begin)
+        for seq in nack.get('seqs', []):
+            if st.n_chunks is not None and seq >= st.n_chunks:
+                continue
+            pkt = self._chunk(st, seq)
+            if pkt is None:
+                self._log.warning('sid=%s, seq=%s: not cached',
+                                  nack['sid'], seq)
+                continue
+            pkts.append(pkt)
+        if nack.get('end') and st.end is not None:
+            pkts.append(st.end)
+
+        inflight = deque()
+        for pkt in pkts:
+            self._send_packet(pkt, inflight)
+            self.n_resent += 1
+
+    def _expire(self):
+        '''
+        call with ``_lock`` held
+        '''
+        now = time.monotonic()
+        for sid in [sid for sid, st in self._streams.items()
+                    if st.t_end is not None
+                    and now - st.t_end > self.keep_sec]:
+            del self._streams[sid]
+
+
+class _RecvStream:
+    __slots__ = ('sid', 'meta', 'size', 'buf', 'mv', 'got', 'n_got',
+                 'max_seq', 'n_chunks', 'sha', 'has_begin',
+                 't_last', 't_nack')
+
+    def __init__(self, sid, now):
+        self.sid = sid
+        self.meta = None
+        self.size = 0       # 0: unknown until 'E'
+        self.buf = bytearray()
+        self.mv = None      # memoryview of buf, if preallocated
+        self.got = bytearray()  # got[seq]: 1 if received
+        self.n_got = 0
+        self.max_seq = -1
+        self.n_chunks = None
+        self.sha = None
+        self.has_begin = False
+        self.t_last = now
+        self.t_nack = now
+
+    def missing(self, max_n):
+        n = self.n_chunks if self.n_chunks is not None else self.max_seq + 1
+        ret = []
+        for seq in range(n):
+            if seq >= len(self.got) or not self.got[seq]:
+                ret.append(seq)
+                if len(ret) >= max_n:
+                    break
+        return ret
+
+
+class StreamReceiver:
+    DEF_MAX_SIZE = 64 * 1024 * 1024
+    DEF_MAX_STREAMS = 8
+    DEF_NACK_SEC = 2.0      # no progress ==> NACK
+    DEF_TIMEOUT_SEC = 60.0  # no progress ==> give up
+    NACK_MAX_SEQS = 1000
+    DONE_HIST = 100         # ignore late chunks of finished streams
+
+    _log = get_logger(__name__, False)
+
+    def __init__(self, mqtt, topic, cb_done, max_size=DEF_MAX_SIZE,
+                 max_streams=DEF_MAX_STREAMS, qos=1, nack_sec=DEF_NACK_SEC,
+                 timeout_sec=DEF_TIMEOUT_SEC, debug=False):
+        '''
+        cb_done(sid, meta, data): called on the network thread
+          data: memoryview of the reassembled buffer (verified by sha256)
+        '''
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('topic=%s, max_size=%s, max_streams=%s',
+                        topic, max_size, max_streams)
+        self._log.debug('nack_sec=%s, timeout_sec=%s', nack_sec, timeout_sec)
+
+        self._mqtt = mqtt
+        self.topic = topic
+        self.nack_topic = topic + NACK_SUFFIX
+        self._cb_done = cb_done
+        self.max_size = max_size
+        self.max_streams = max_streams
+        self.qos = qos
+        self.nack_sec = nack_sec
+        self.timeout_sec = timeout_sec
+
+        self._mqtt.set_codec(self.topic, 'raw')
+        self._mqtt.set_codec(self.nack_topic, 'json')
+
+        self._lock = threading.Lock()
+        self._streams = {}  # {sid: _RecvStream}
+        self._done = deque(maxlen=self.DONE_HIST)
+
+        self._stop = threading.Event()
+        self._th = None
+
+        self.n_done = 0
+        self.n_failed = 0
+        self.n_rejected = 0
+        self.n_chunks = 0
+        self.n_dup = 0
+        self.n_crc_err = 0
+        self.n_nack = 0
+
+    def start(self):
+        self._mqtt.route(self.topic, self._on_packet, qos=self.qos, raw=True)
+
+        if self._th is None:
+            self._stop.clear()
+            self._th = threading.Thread(target=self._timer, daemon=True)
+            self._th.start()
+
+    def end(self):
+        self._mqtt.unroute(self.topic, self._on_packet)
+
+        if self._th is not None:
+            self._stop.set()
+            self._th.join()
+            self._th = None
+
+    def stats(self):
+        '''
+        return: {'done', 'failed', 'rejected', 'active',
+                 'chunks', 'dup', 'crc_err', 'nack'}
+          dup: duplicated packets, or packets of finished/rejected streams
+        '''
+        with self._lock:
+            n_active = len(self._streams)
+        return {'done': self.n_done, 'failed': self.n_failed,
+                'rejected': self.n_rejected, 'active': n_active,
+                'chunks': self.n_chunks, 'dup': self.n_dup,
+                'crc_err': self.n_crc_err, 'nack': self.n_nack}
+
+    def _on_packet(self, m):
+        mv = memoryview(m.raw)
+        if len(mv) < HDR.size:
+            self._log.warning('%s: too short', m)
+            return
+        magic, ptype, sid, seq, offset, crc = HDR.unpack_from(mv)
+        if magic != MAGIC:
+            self._log.warning('%s: bad magic', m)
+            return
+        body = mv[HDR.size:]
+
+        done = None
+        with self._lock:
+            if sid in self._done:
+                self.n_dup += 1
+                return
+
+            now = time.monotonic()
+            st = self._streams.get(sid)
+            if st is None:
+                if len(self._streams) >= self.max_streams:
+                    self.n_rejected += 1
+                    self._log.warning('sid=%s: too many streams', sid.hex())
+                    return
+                st = self._streams[sid] = _RecvStream(sid, now)
+
+            try:
+                if ptype == T_DATA:
+                    self._on_data(st, seq, offset, crc, body)
+                elif ptype == T_BEGIN:
+                    self._on_begin(st, offset, crc, body)
+                elif ptype == T_END:
+                    self._on_end(st, seq, offset, body)
+                else:
+                    self._log.warning('%s: unknown type %a', m, ptype)
+                    return
+            except ValueError as e:
+                self._log.warning('sid=%s: %s', sid.hex(), e)
+                self._drop(st)
+                self._done.append(sid)  # ignore the rest
+                self.n_rejected += 1
+                return
+            st.t_last = now
+
+            if (st.has_begin and st.n_chunks is not None and
+                    st.n_got >= st.n_chunks):
+                done = self._finish(st)
+
+        if done is not None:
+            self._cb_done(*done)
+
+    def _on_begin(self, st, size, chunk_size, body):
+        '''
+        call with ``_lock`` held
+        '''
+        if st.has_begin:
+            self.n_dup += 1
+            return
+        if size > self.max_size:
+            raise ValueError('size %s > max_size %s' % (size, self.max_size))
+
+        st.has_begin = True
+        st.meta = json.loads(bytes(body))
+        if size > 0 and st.mv is None and len(st.buf) == 0:
+            # preallocate and write chunks through a memoryview
+            st.size = size
+            st.buf = bytearray(size)
+            st.mv = memoryview(st.buf)
+        if self._dbg:
+            self._log.debug('sid=%s, size=%s, chunk_size=%s, meta=%s',
+                            st.sid.hex(), size, chunk_size, st.meta)
+
+    def _on_data(self, st, seq, offset, crc, body):
+        '''
+        call with ``_lock`` held
+        '''
+        if zlib.crc32(body) != crc:
+            self.n_crc_err += 1  # requested again by NACK
+            return
+        if seq < len(st.got) and st.got[seq]:
+            self.n_dup += 1
+            return
+
+        end = offset + len(body)
+        if end > self.max_size:
+            raise ValueError('offset %s > max_size %s' % (end, self.max_size))
+        if seq > offset:
+            # chunks are not empty: a bogus seq would grow ``got``
+            raise ValueError('seq %s > offset %s' % (seq, offset))
+        if st.n_chunks is not None and seq >= st.n_chunks:
+            raise ValueError('seq %s >= n_chunks %s' % (seq, st.n_chunks))
+        if st.size > 0 and end > st.size:
+            raise ValueError('offset %s > size %s' % (end, st.size))
+
+        if st.mv is not None:
+            if end > len(st.mv):
+                raise ValueError('offset %s > size %s' % (end, len(st.mv)))
+            st.mv[offset:end] = body
+        else:
+            if len(st.buf) < end:
+                st.buf.extend(bytes(end - len(st.buf)))
+            st.buf[offset:end] = body
+
+        if len(st.got) <= seq:
+            st.got.extend(bytes(seq + 1 - len(st.got)))
+        st.got[seq] = 1
+        st.n_got += 1
+        st.max_seq = max(st.max_seq, seq)
+        self.n_chunks += 1
+
+    def _on_end(self, st, n_chunks, size, body):
+        '''
+        call with ``_lock`` held
+        '''
+        if st.n_chunks is not None:
+            self.n_dup += 1
+            return
+        if size > self.max_size:
+            raise ValueError('size %s > max_size %s' % (size, self.max_size))
+        st.n_chunks = n_chunks
+        st.size = size
+        st.sha = bytes(body)
+
+    def _finish(self, st):
+        '''
+        call with ``_lock`` held
+
+        return: (sid, meta, data) for cb_done, None: verify error
+        '''
+        self._drop(st)
+        self._done.append(st.sid)
+
+        if st.mv is not None:
+            data = st.mv[:st.size]
+        else:
+            del st.buf[st.size:]
+            data = memoryview(st.buf)
+
+        if hashlib.sha256(data).digest() != st.sha:
+            self.n_failed += 1
+            self._log.error('sid=%s: sha256 mismatch', st.sid.hex())
+            return None
+
+        self.n_done += 1
+        if self._dbg:
+            self._log.debug('sid=%s: %s chunks, %s bytes',
+                            st.sid.hex(), st.n_chunks, st.size)
+        return st.sid.hex(), st.meta, data
+
+    def _drop(self, st):
+        '''
+        call with ``_lock`` held
+        '''
+        self._streams.pop(st.sid, None)
+
+    def _timer(self):
+        interval = min(max(self.nack_sec / 2, 0.1), 1.0)
+        while not self._stop.wait(interval):
+            self._check()
+
+    def _check(self):
+        now = time.monotonic()
+        nacks = []
+        with self._lock:
+            for st in list(self._streams.values()):
+                if now - st.t_last > self.timeout_sec:
+                    self._log.warning('sid=%s: timeout, %s chunks got',
+                                      st.sid.hex(), st.n_got)
+                    self._drop(st)
+                    self.n_failed += 1
+                    continue
+                if now - max(st.t_last, st.t_nack) < self.nack_sec:
+                    continue
+
+                st.t_nack = now
+                nacks.append({'sid': st.sid.hex(),
+                              'seqs': st.missing(self.NACK_MAX_SEQS),
+                              'begin': not st.has_begin,
+                              'end': st.n_chunks is None})
+
+        for nack in nacks:
+            if self._dbg:
+                self._log.debug('nack=%s', nack)
+            self._mqtt.publish(nack, self.nack_topic, qos=self.qos)
+        self.n_nack += len(nacks)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS,
+               help='''
+send a file as a chunked stream, or receive streams
+
+\b
+  send TOPIC FILE
+  recv TOPIC
+''')
+@click.argument('mode', type=click.Choice(['send', 'recv']))
+@click.argument('topic', type=str)
+@click.argument('path', type=str, required=False)
+@click.option('--host', '-H', 'host', type=str, default='localhost',
+              help='server host')
+@click.option('--port', '-p', 'port', type=int, default=Mqtt.DEF_PORT,
+              help='server port')
+@click.option('--user', '-u', 'user', type=str, default='',
+              help='user name')
+@click.option('--pw', '-P', 'pw', type=str, default='',
+              help='password')
+@click.option('--chunk_size', '-s', 'chunk_size', type=int,
+              default=StreamSender.DEF_CHUNK_SIZE, help='chunk size (send)')
+@click.option('--outdir', '-o', 'outdir', type=str, default='.',
+              help='output directory (recv)')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(mode, topic, path, host, port, user, pw, chunk_size, outdir,
+         debug):
+    log = get_logger(__name__, debug=debug)
+    log.debug('mode=%s, topic=%s, path=%s', mode, topic, path)
+
+    mqtt = Mqtt(None, None, user=user, pw=pw, host=host, port=port,
+                debug=debug)
+
+    if mode == 'send':
+        if path is None:
+            print('FILE must be specified')
+            return
+
+        sender = StreamSender(mqtt, topic, chunk_size=chunk_size,
+                              debug=debug)
+        mqtt.start()
+        sender.start()
+        try:
+            t0 = time.perf_counter()
+            sid = sender.send(path, meta={'name': os.path.basename(path)})
+            sec = time.perf_counter() - t0
+            if sid is None:
+                log.error('send failed: %s', sender.stats())
+                return
+            log.info('sid=%s, %s, %.3f sec', sid, sender.stats(), sec)
+
+            # answer NACKs
+            time.sleep(StreamReceiver.DEF_NACK_SEC * 2)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sender.end()
+            mqtt.end()
+        return
+
+    def done(sid, meta, data):
+        name = os.path.basename((meta or {}).get('name') or sid)
+        out = os.path.join(outdir, name)
+        with open(out, 'wb') as f:
+            f.write(data)
+        log.info('%s: %s bytes', out, len(data))
+
+    receiver = StreamReceiver(mqtt, topic, done, debug=debug)
+    mqtt.start()
+    receiver.start()
+    try:
+        while True:
+            time.sleep(10)
+            log.info('%s', receiver.stats())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.end()
+        mqtt.end()
+
+
+if __name__ == '__main__':
+    main()
@@ -23,17 +23,46 @@ class A:
     @classmethod
     def func2(cls, param1):
         cls._log.debug('param1=%s', param1)    
+
+    def hot_path(self, data):
+        if self._dbg:  # cost nothing if not debug
+            self._log.debug('data=%s', data)
+------
+
+Async mode:
 ------
+import MyLogger
+
+MyLogger.set_async(True)
+------
+Log records are handed to a background writer thread, which formats
+and writes them. Arguments are formatted in the writer thread, so
+objects passed as arguments should not be modified after logging.
 
 """
 __author__ = 'Yoichi Tanibayashi'
 __date__   = '2019'
 
 from logging import getLogger, StreamHandler, Formatter, DEBUG, INFO, WARN
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import os
+import queue
+
+
+class AsyncHandler(QueueHandler):
+    '''
+    hand log records to the writer thread as they are
+    (formatting is done in the writer thread)
+    '''
+    def prepare(self, record):
+        return record
 
 
 class MyLogger:
-    def __init__(self, name=''):
+    ENV_ASYNC = 'MYLOGGER_ASYNC'
+
+    def __init__(self, name='', async_mode=False):
         fmt_hdr = '%(asctime)s %(levelname)s '
         fmt_loc = '%(filename)s.%(name)s.%(funcName)s:%(lineno)d> '
         self.handler_fmt = Formatter(fmt_hdr + fmt_loc + '%(message)s',
@@ -48,6 +77,32 @@ class MyLogger:
         self._log.addHandler(self.console_handler)
         self._log.propagate = False
 
+        self.async_handler = None
+        self._listener = None
+        if async_mode:
+            self.set_async(True)
+
+    def set_async(self, enable=True):
+        '''
+        enable: True:  write logs in a background thread
+                False: write logs in the caller thread (flush pending logs)
+        '''
+        if enable and self._listener is None:
+            q = queue.SimpleQueue()
+            self.async_handler = AsyncHandler(q)
+            self._listener = QueueListener(q, self.console_handler,
+                                           respect_handler_level=True)
+            self._listener.start()
+            self._log.addHandler(self.async_handler)
+            self._log.removeHandler(self.console_handler)
+
+        if not enable and self._listener is not None:
+            self._log.addHandler(self.console_handler)
+            self._log.removeHandler(self.async_handler)
+            self._listener.stop()
+            self._listener = None
+            self.async_handler = None
+
     def get_logger(self, name, debug):
         logger = self._log.getChild(name)
         if debug:
@@ -57,8 +112,14 @@ class MyLogger:
         return logger
 
 
-myLogger = MyLogger()
+myLogger = MyLogger(async_mode=os.environ.get(
+    MyLogger.ENV_ASYNC, '').strip().lower() in ('1', 'true', 'yes'))
+atexit.register(myLogger.set_async, False)
 
 
 def get_logger(name, debug):
     return myLogger.get_logger(name, debug)
+
+
+def set_async(enable=True):
+    myLogger.set_async(enable)
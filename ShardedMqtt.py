@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import functools
+import multiprocessing
+import queue
+import threading
+import zlib
+from Mqtt import Mqtt
+from DataQueue import DataQueue
+from MyLogger import get_logger
+import click
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+def new_mqtt(user, pw, host, port, debug, cb_recv, topics_sub):
+    '''
+    default factory of ShardedMqtt
+    '''
+    return Mqtt(cb_recv, topics_sub, user, pw, host, port, debug=debug)
+
+
+def shard_main(factory, cb_recv, topics_sub, cmdq, dataq):
+    '''
+    worker process of ShardedMqtt
+
+    cmdq:  ('pub', data, topics, qos, retain) or ('end',)
+    dataq: (data, topic, ts) for CB_QPUT
+    '''
+    if cb_recv == Mqtt.CB_QPUT:
+        def cb_recv(data, topic, ts):
+            dataq.put((data, topic, ts))
+
+    mq = factory(cb_recv, topics_sub)
+    mq.start()
+    try:
+        while True:
+            cmd = cmdq.get()
+            if cmd[0] == 'end':
+                break
+            if cmd[0] == 'pub':
+                mq.send_data(*cmd[1:])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mq.end()
+
+
+class ShardedMqtt:
+    '''
+    ``Mqtt`` spread over ``shards`` connections.
+
+    Subscribed topics (filters) and published topics are assigned to
+    a shard by hash of the topic.
+    If ``procs`` is True, each shard runs in a worker process, so that
+    decoding and callbacks use multiple cores.
+    In this case, ``cb_recv`` is called in the worker processes
+    and ``factory`` must be picklable (unless 'fork' start method).
+
+    factory(cb_recv, topics_sub) ==> Mqtt object (or its subclass)
+
+    usage: same as ``Mqtt``
+      smqtt = ShardedMqtt(ShardedMqtt.CB_QPUT, topics, shards=4)
+      smqtt.start()
+      (data, topic, ts) = smqtt.recv_data()
+      smqtt.send_data(data, topic)
+      smqtt.end()
+    '''
+    CB_QPUT = Mqtt.CB_QPUT
+    DEF_SHARDS = 4
+
+    _log = get_logger(__name__, False)
+
+    def __init__(self, cb_recv=None, topics_sub=None,
+                 user='', pw='', host=Mqtt.DEF_HOST, port=Mqtt.DEF_PORT,
+                 shards=DEF_SHARDS, procs=False, factory=None,
+                 q_maxsize=0, q_policy=DataQueue.BLOCK, debug=False):
+        self._dbg = debug
+        __class__._log = get_logger(__class__.__name__, self._dbg)
+        self._log.debug('cb_recv=%s, topics_sub=%s', cb_recv, topics_sub)
+        self._log.debug('user=%s, pw=%s, host=%s, port=%s',
+                        user, pw, host, port)
+        self._log.debug('shards=%s, procs=%s, factory=%s',
+                        shards, procs, factory)
+
+        if factory is None:
+            factory = functools.partial(new_mqtt, user, pw, host, port,
+                                        self._dbg)
+
+        if topics_sub is None:
+            topics_sub = []
+        if type(topics_sub) != list:
+            topics_sub = [topics_sub]
+
+        self._n = shards
+        self._procs = procs
+
+        shard_topics = [[] for _ in range(self._n)]
+        for t in topics_sub:
+            if t is None or t == '':
+                continue
+            shard_topics[self.shard_of(t)].append(t)
+        self._log.debug('shard_topics=%s', shard_topics)
+
+        self._dataq = DataQueue(q_maxsize, q_policy)
+
+        self._shards = []
+        if not self._procs:
+            if cb_recv == self.CB_QPUT:
+                cb_recv = self.cb_qput
+            for topics in shard_topics:
+                self._shards.append(factory(cb_recv, topics))
+        else:
+            self._mp_dataq = multiprocessing.Queue()
+            self._cmdq = []
+            for topics in shard_topics:
+                cmdq = multiprocessing.Queue()
+                self._cmdq.append(cmdq)
+                self._shards.append(multiprocessing.Process(
+                    target=shard_main,
+                    args=(factory, cb_recv, topics, cmdq, self._mp_dataq),
+                    daemon=True))
+            self._pump_th = threading.Thread(target=self._pump, daemon=True)
+
+        self.active = False
+
+    def shard_of(self, topic):
+        return zlib.crc32(topic.encode('utf-8')) % self._n
+
+    def start(self):
+        self._log.debug('')
+
+        self._dataq.open()
+        for s in self._shards:
+            s.start()
+        if self._procs:
+            self._pump_th.start()
+
+        self.active = True
+
+    def end(self):
+        self._log.debug('')
+
+        self.active = False
+        self._dataq.close()
+
+        if not self._procs:
+            for s in self._shards:
+                s.end()
+        else:
+            for cmdq in self._cmdq:
+                cmdq.put(('end',))
+            for s in self._shards:
+                s.join()
+            self._mp_dataq.put(None)
+            self._pump_th.join()
+
+        self._log.debug('done')
+
+    def send_data(self, data, topics, qos=0, retain=False):
+        '''
+        return: [MQTTMessageInfo, ..] ([] if ``procs``)
+        '''
+        self._log.debug('data=%a, topics=%s', data, topics)
+
+        if type(topics) != list:
+            topics = [topics]
+
+        groups = {}  # {shard: [topic, ..]}
+        for t in topics:
+            if t is None or t == '':
+                self._log.debug('t=\'%s\': ** ignore **', t)
+                continue
+            groups.setdefault(self.shard_of(t), []).append(t)
+
+        rets = []
+        for i, group in groups.items():
+            if self._procs:
+                self._cmdq[i].put(('pub', data, group, qos, retain))
+            else:
+                rets += self._shards[i].send_data(data, group, qos, retain)
+        return rets
+
+    def cb_qput(self, data, topic, ts):
+        self._dataq.put((data, topic, ts), topic)
+
+    def qstats(self):
+        return self._dataq.stats()
+
+    def recv_data(self, timeout=2):
+        '''
+        return: (data, topic, ts)
+        '''
+        while self.active:
+            try:
+                return self._dataq.get(timeout=timeout)
+            except queue.Empty:
+                pass
+        return None
+
+    def recv_many(self, max_items=100, max_wait=1, columnar=False):
+        '''
+        see ``Mqtt.recv_many()``
+        '''
+        ret = self._dataq.get_many(max_items, max_wait)
+
+        if columnar:
+            if len(ret) == 0:
+                return [], [], []
+            return tuple(list(c) for c in zip(*ret))
+        return ret
+
+    def _pump(self):
+        '''
+        worker processes ==> _dataq
+        '''
+        self._log.debug('')
+
+        while True:
+            ent = self._mp_dataq.get()
+            if ent is None:
+                break
+            self._dataq.put(ent, ent[1])
+
+        self._log.debug('done')
+
+
+@click.command(context_settings=CONTEXT_SETTINGS,
+               help='Sharded MQTT subscriber sample')
+@click.argument('user', type=str)
+@click.argument('topic1', type=str)
+@click.argument('topic2', type=str, nargs=-1)
+@click.option('--password', '-p', 'password', type=str, default='',
+              help='password')
+@click.option('--svr_host', '-s', 'svr_host', type=str,
+              default=Mqtt.DEF_HOST,
+              help='server host name')
+@click.option('--shards', '-n', 'shards', type=int,
+              default=ShardedMqtt.DEF_SHARDS,
+              help='number of connections')
+@click.option('--procs', '-P', 'procs', is_flag=True, default=False,
+              help='run shards in processes')
+@click.option('--debug', '-d', 'debug', is_flag=True, default=False,
+              help='debug flag')
+def main(user, topic1, topic2, password, svr_host, shards, procs, debug):
+    log = get_logger(__name__, debug=debug)
+
+    smqtt = ShardedMqtt(ShardedMqtt.CB_QPUT, [topic1] + list(topic2),
+                        user, password, svr_host,
+                        shards=shards, procs=procs, debug=debug)
+    smqtt.start()
+    try:
+        while True:
+            ret = smqtt.recv_data()
+            if ret is None:
+                break
+            (data, topic, ts) = ret
+            print('%s [%s] %s' % (ts, topic, data))
+    finally:
+        log.debug('finally')
+        smqtt.end()
+        log.debug('done')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+"""
+TopicTrie.py
+
+MQTT topic filters (with '+' and '#' wildcards) to values.
+Matching cost depends on the depth of the topic,
+not on the number of filters.
+
+Usage:
+------
+from TopicTrie import TopicTrie
+
+trie = TopicTrie()
+trie.add('sensor/+/temp', func1)
+trie.add('sensor/#', func2)
+
+trie.match('sensor/room1/temp')  # ==> [func2, func1]
+
+topic_match('sensor/+/temp', 'sensor/room1/temp')  # ==> True
+------
+
+"""
+__author__ = 'Yoichi Tanibayashi'
+__date__   = '2020'
+
+import threading
+
+
+class _Node:
+    __slots__ = ('child', 'values')
+
+    def __init__(self):
+        self.child = {}   # {level: _Node}
+        self.values = []
+
+
+class TopicTrie:
+    SEP = '/'
+    WC_ONE = '+'
+    WC_ALL = '#'
+
+    def __init__(self):
+        self._root = _Node()
+        self._count = 0
+        self._lock = threading.Lock()  # for writers
+
+    def __len__(self):
+        return self._count
+
+    @classmethod
+    def check_filter(cls, topic_filter):
+        '''
+        raise: ValueError
+        '''
+        if topic_filter is None or topic_filter == '':
+            raise ValueError('empty topic filter')
+
+        levels = topic_filter.split(cls.SEP)
+        for i, lv in enumerate(levels):
+            if cls.WC_ALL in lv and (lv != cls.WC_ALL or
+                                     i != len(levels) - 1):
+                raise ValueError('invalid \'#\': %a' % topic_filter)
+            if cls.WC_ONE in lv and lv != cls.WC_ONE:
+                raise ValueError('invalid \'+\': %a' % topic_filter)
+        return levels
+
+    def add(self, topic_filter, value):
+        levels = self.check_filter(topic_filter)
+
+        with self._lock:
+            node = self._root
+            for lv in levels:
+                nxt = node.child.get(lv)
+                if nxt is None:
+                    nxt = node.child[lv] = _Node()
+                node = nxt
+
+            # copy on write: match() may be running on another thread
+            node.values = node.values + [value]
+            self._count += 1
+
+    def remove(self, topic_filter, value=None):
+        '''
+        value: None: remove all values of ``topic_filter``
+
+        return: number of removed values
+        '''
+        levels = self.check_filter(topic_filter)
+
+        with self._lock:
+            path = [self._root]
+            for lv in levels:
+                nxt = path[-1].child.get(lv)
+                if nxt is None:
+                    return 0
+                path.append(nxt)
+
+            node = path[-1]
+            if value is None:
+                values = []
+            else:
+                values = [v for v in node.values if v != value]
+            n = len(node.values) - len(values)
+            node.values = values
+            self._count -= n
+
+            # prune empty nodes
+            for i in range(len(levels), 0, -1):
+                if path[i].values or path[i].child:
+                    break
+                del path[i - 1].child[levels[i - 1]]
+
+        return n
+
+    def match(self, topic):
+        '''
+        return: [value, ..] of all filters matching ``topic``
+        '''
+        ret = []
+        levels = topic.split(self.SEP)
+        sys_topic = topic.startswith('$')  # not matched by 1st wildcard
+
+        nodes = [self._root]
+        for i, lv in enumerate(levels):
+            wc = i > 0 or not sys_topic
+
+            nxt = []
+            for node in nodes:
+                child = node.child
+                if wc:
+                    n = child.get(self.WC_ALL)
+                    if n is not None:
+                        ret.extend(n.values)
+                    n = child.get(self.WC_ONE)
+                    if n is not None:
+                        nxt.append(n)
+                n = child.get(lv)
+                if n is not None:
+                    nxt.append(n)
+
+            nodes = nxt
+            if len(nodes) == 0:
+                return ret
+
+        for node in nodes:
+            ret.extend(node.values)
+            # 'a/#' matches 'a'
+            n = node.child.get(self.WC_ALL)
+            if n is not None:
+                ret.extend(n.values)
+
+        return ret
+
+    def filters(self):
+        '''
+        return: [topic_filter, ..] having values
+        '''
+        ret = []
+        stack = [(self._root, [])]
+        while stack:
+            node, levels = stack.pop()
+            if node.values:
+                ret.append(self.SEP.join(levels))
+            for lv, n in node.child.items():
+                stack.append((n, levels + [lv]))
+        return ret
+
+
+def topic_match(topic_filter, topic):
+    '''
+    return: True if ``topic`` matches ``topic_filter``
+    '''
+    trie = TopicTrie()
+    trie.add(topic_filter, True)
+    return len(trie.match(topic)) > 0
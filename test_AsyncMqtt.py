@@ -0,0 +1,91 @@
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+import asyncio
+import time
+from Mqtt import Mqtt, Beebotte
+from AsyncMqtt import AsyncMqtt
+from MqttBroker import MqttBroker
+
+TIMEOUT = 10  # sec
+SETTLE_SEC = 0.3  # wait for subscribe
+
+
+def wait_for(cond, timeout=TIMEOUT):
+    end = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() >= end:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def run_pub(mqtt_obj, sends):
+    '''
+    sends: [(data, topic) or sleep_sec, ..] sent by AsyncMqtt(mqtt_obj)
+    '''
+    async def main():
+        amqtt = AsyncMqtt(mqtt_obj)
+        assert await amqtt.start() == 0
+        for s in sends:
+            if type(s) != tuple:
+                await asyncio.sleep(s)
+                continue
+            await amqtt.send_data(s[0], s[1], qos=1)
+        await amqtt.end()
+
+    asyncio.run(main())
+
+
+def test_limiter_last_value():
+    broker = MqttBroker(port=0)
+    port = broker.start()
+
+    got = []
+    sub = Mqtt(lambda data, topic, ts: got.append(data), ['lim/#'],
+               host='localhost', port=port)
+    sub.start()
+    try:
+        assert wait_for(lambda: sub._connected)
+        time.sleep(SETTLE_SEC)
+
+        pub = Mqtt(None, None, host='localhost', port=port, pub_rate=1)
+        run_pub(pub, [(i, 'lim/1') for i in range(5)])
+
+        # the first value at once, the coalesced last value by end()
+        assert wait_for(lambda: len(got) >= 2)
+        time.sleep(SETTLE_SEC)
+        assert got == [0, 4]
+        assert pub.limit_stats() == {'submit': 5, 'sent': 2,
+                                     'coalesced': 3, 'pending': 0}
+    finally:
+        sub.end()
+        broker.end()
+
+
+def test_batch_sent_by_timer_and_end():
+    broker = MqttBroker(port=0)
+    port = broker.start()
+
+    class Bbt(Beebotte):
+        BEEBOTTE_HOST = 'localhost'
+        BEEBOTTE_PORT = port
+
+    got = []
+    sub = Bbt(lambda data, topic, ts: got.append(data), ['bat/#'])
+    sub.start()
+    try:
+        assert wait_for(lambda: sub._connected)
+        time.sleep(SETTLE_SEC)
+
+        # batches never fill: sent by the timer (batch_sec) and end()
+        pub = Bbt(None, [], batch_size=100, batch_sec=0.2)
+        run_pub(pub, [(0, 'bat/1'), (1, 'bat/1'), 1.0, (2, 'bat/1')])
+
+        assert wait_for(lambda: len(got) >= 3)
+        time.sleep(SETTLE_SEC)
+        assert got == [0, 1, 2]
+        assert pub.batch_stats() == {'added': 3, 'batches': 2, 'pending': 0}
+    finally:
+        sub.end()
+        broker.end()
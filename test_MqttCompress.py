@@ -0,0 +1,51 @@
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+import pytest
+from MqttCompress import (ALGOS, HDR_LEN, MAGIC, Compressor, compress,
+                          decompress)
+
+PAYLOAD = b'{"data": [' + b'{"value": 0.1, "unit": "C"}, ' * 100 + b'{}]}'
+
+
+@pytest.mark.parametrize('algo', list(ALGOS))
+def test_round_trip(algo):
+    assert decompress(compress(PAYLOAD, algo)) == PAYLOAD
+
+
+@pytest.mark.parametrize('algo', list(ALGOS))
+def test_truncated(algo):
+    comp = compress(PAYLOAD, algo)
+    n = HDR_LEN + (len(comp) - HDR_LEN) // 2
+    with pytest.raises(ValueError):
+        decompress(comp[:n])
+
+
+@pytest.mark.parametrize('algo', list(ALGOS))
+def test_oversized(algo):
+    with pytest.raises(ValueError):
+        decompress(compress(PAYLOAD, algo), max_size=len(PAYLOAD) - 1)
+    assert decompress(compress(PAYLOAD, algo),
+                      max_size=len(PAYLOAD)) == PAYLOAD
+
+
+def test_not_compressed():
+    assert decompress(PAYLOAD) is PAYLOAD
+
+
+def test_stats_all_payloads():
+    c = Compressor('zlib', threshold=100)
+    assert c.compress('t', b'x' * 10) == b'x' * 10        # < threshold
+    assert c.compress('t', PAYLOAD) != PAYLOAD
+    st = c.stats()['t']
+    assert st['msgs'] == 2 and st['compressed'] == 1
+    assert st['in_bytes'] == 10 + len(PAYLOAD)
+    assert st['out_bytes'] == 10 + len(compress(PAYLOAD))
+
+
+def test_magic_not_compressed():
+    c = Compressor(None)
+    raw = MAGIC + b'z' + b'not compressed'
+    assert c.decompress('t', raw) is raw
+    assert c.stats()['t']['decompress_err'] == 1
+    assert c.decompress('t', compress(PAYLOAD)) == PAYLOAD
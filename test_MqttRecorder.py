@@ -0,0 +1,55 @@
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+import os
+from MqttRecorder import MqttRecorder, MAGIC, REC_HDR, read_records, replay
+
+
+class Pub:
+    def __init__(self):
+        self.sent = []
+
+    def send_data(self, data, topic, qos=0):
+        self.sent.append((topic, data))
+
+
+def record(path, recs):
+    rec = MqttRecorder(path)
+    for (topic, payload) in recs:
+        rec.record(topic, payload)
+    rec.close()
+
+
+def test_torn_tail(tmp_path):
+    path = str(tmp_path / 'traffic.rec')
+    before = [('a/1', b'{"v": 1}'), ('a/2', b'{"v": 2}')]
+    after = [('b/1', b'{"v": 3}')]
+
+    record(path, before)
+    size = os.path.getsize(path)
+
+    # crash while writing a record: header and a part of the body
+    with open(path, 'ab') as f:
+        f.write(REC_HDR.pack(0.0, 3, 100) + b'c/1' + b'x' * 10)
+
+    record(path, after)
+
+    got = [(topic, payload) for (_, topic, payload) in read_records(path)]
+    assert got == before + after
+    assert os.path.getsize(path) == size + REC_HDR.size + 3 + 8
+
+    pub = Pub()
+    ret = replay(pub, path, speed=0)
+    assert ret['count'] == 3
+    assert pub.sent == before + after
+
+
+def test_torn_magic(tmp_path):
+    path = str(tmp_path / 'traffic.rec')
+    with open(path, 'wb') as f:
+        f.write(MAGIC[:3])
+
+    record(path, [('a/1', b'1')])
+
+    got = [(topic, payload) for (_, topic, payload) in read_records(path)]
+    assert got == [('a/1', b'1')]
@@ -0,0 +1,88 @@
+#
+# (C) 2020 Yoichi Tanibayashi
+#
+import time
+from Mqtt import Mqtt
+from MqttBroker import MqttBroker
+from MqttSpool import MqttSpool
+
+TIMEOUT = 10  # sec
+
+
+def wait_for(cond, timeout=TIMEOUT):
+    end = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() >= end:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_drain_after_reconnect(tmp_path):
+    broker = MqttBroker(port=0)
+    port = broker.start()
+
+    spool = MqttSpool(str(tmp_path / 'spool'))
+    pub = Mqtt(None, None, host='localhost', port=port, spool=spool)
+    pub.start()
+    assert wait_for(lambda: pub._connected)
+
+    broker.end()
+    assert wait_for(lambda: not pub._connected)
+    for i in range(10):
+        assert pub.send_data({'i': i}, 'spool/1', qos=1) == [None]
+    assert spool.pending() == 10
+
+    broker.start()
+    try:
+        assert wait_for(lambda: spool.pending() == 0)
+        assert spool.stats()['sent'] == 10
+    finally:
+        pub.end()
+        spool.close()
+        broker.end()
+
+
+def test_retry_after_failure(tmp_path):
+    spool = MqttSpool(str(tmp_path / 'spool'))
+    spool.RETRY_SEC = 0.05
+    for i in range(5):
+        spool.put('spool/1', b'%d' % i)
+
+    sent = []
+
+    def publish(records):
+        if len(sent) == 0:
+            sent.append(None)  # the first batch fails
+            return False
+        sent.extend(payload for (_, payload, _, _) in records)
+        return True
+
+    spool.start_drain(publish)
+    try:
+        assert wait_for(lambda: spool.pending() == 0)
+        assert sent[1:] == [b'0', b'1', b'2', b'3', b'4']
+    finally:
+        spool.close()
+
+
+def test_put_after_drained(tmp_path):
+    spool = MqttSpool(str(tmp_path / 'spool'))
+    sent = []
+
+    def publish(records):
+        sent.extend(payload for (_, payload, _, _) in records)
+        return True
+
+    spool.put('spool/1', b'0')
+    spool.start_drain(publish)
+    assert wait_for(lambda: spool.pending() == 0)
+
+    # put while connected: the drain thread may have exited
+    spool.put('spool/1', b'1')
+    spool.start_drain(publish)
+    try:
+        assert wait_for(lambda: spool.pending() == 0)
+        assert sent == [b'0', b'1']
+    finally:
+        spool.close()
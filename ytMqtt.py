@@ -9,15 +9,59 @@ import paho.mqtt.client as mqtt
 import queue
 import os
 import csv
-import json
 import time
-import random
 import threading
+import itertools
+import random
+import uuid
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from MqttCodec import TopicCodecs
+from MqttMsg import MqttMsg
+from MqttFilter import FilterSet
+from MqttCompress import get_compressor
 from MyLogger import get_logger
 import click
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 
+class PubHandle:
+    '''
+    handle of a pipelined publish, see ``Mqtt.publish_async()``
+
+    rc:
+      None: waiting for ack
+      0:    acked
+      >0:   publish error
+
+    spooled: saved to ``MqttSpool`` (disconnected), mid is None
+    '''
+    def __init__(self, mid, topic):
+        self.mid = mid
+        self.topic = topic
+        self.rc = None
+        self.spooled = False
+        self._ev = threading.Event()
+
+    def done(self):
+        return self._ev.is_set()
+
+    def wait(self, timeout=None):
+        '''
+        return: True if acked
+        '''
+        self._ev.wait(timeout)
+        return self.rc == 0
+
+    def _set_rc(self, rc):
+        self.rc = rc
+        self._ev.set()
+
+    def __repr__(self):
+        return 'PubHandle(mid=%s, topic=%s, rc=%s, spooled=%s)' % (
+            self.mid, self.topic, self.rc, self.spooled)
+
+
 class Mqtt:
     CONF_FILENAME = ['mqtt.conf', '.mqtt.conf']
     CONF_PATH = ['.', os.environ['HOME'], '/etc']
@@ -27,15 +71,28 @@ class Mqtt:
 
     DEF_QOS = 0
 
-    MSG_OK     = 'OK'      # {'type':MSG_OK,     'data':'message'}
-    MSG_CON    = 'CON'     # {'type':MSG_CON,    'data':{'rc':rc,'flag':flag}
-    MSG_DISCON = 'DISCON'  # {'type':MSG_DISCON, 'data':{'rc':rc}
-    MSG_SUB    = 'SUB'     # {'type':MSG_SUB,    'data':{'mid':mid,'qos':q}
-    MSG_UNSUB  = 'UNSUB'   # {'type':MSG_UNSUB,  'data':{'rc':rc}
-    MSG_PUB    = 'PUB'     # {'type':MSG_PUB,    'data':{'mid':mid}
-    MSG_DATA   = 'DATA'    # {'type':MSG_DATA,  'data':{'topic':t,'payload':p}}
-    MSG_NONE   = 'NONE'    # {'type':MSG_NONE,   'data':None}
-    MSG_ERR    = 'ERR'     # {'type':MSG_ERR,    'data':'mesage'}
+    DEF_PUB_WINDOW = 100  # max in-flight publishes
+
+    DEF_RECONNECT_MIN = 1   # sec
+    DEF_RECONNECT_MAX = 60  # sec
+
+    DEF_CODEC = 'json'  # see MqttCodec
+
+    WAIT_TIMEOUT = 2  # sec
+    RECOVER_HIST = 100  # reconnect_stats()
+    SPOOL_ACK_TIMEOUT = 10  # sec
+    SPOOL_WAIT_SEC = 0.5  # check MqttSpool.draining
+
+    # mailbox entry: (type, data)
+    MSG_OK     = 'OK'      # (MSG_OK,     'message')
+    MSG_CON    = 'CON'     # (MSG_CON,    {'rc':rc,'flag':flag})
+    MSG_DISCON = 'DISCON'  # (MSG_DISCON, {'rc':rc})
+    MSG_SUB    = 'SUB'     # (MSG_SUB,    {'mid':mid,'qos':q})
+    MSG_UNSUB  = 'UNSUB'   # (MSG_UNSUB,  {'rc':rc})
+    MSG_PUB    = 'PUB'     # (MSG_PUB,    {'mid':mid})
+    MSG_DATA   = 'DATA'    # (MSG_DATA,   MqttMsg)  d['topic'], d['payload']
+    MSG_NONE   = 'NONE'    # (MSG_NONE,   None)
+    MSG_ERR    = 'ERR'     # (MSG_ERR,    'mesage')
 
     CON_RC = [
         'OK',  # 0
@@ -46,12 +103,49 @@ class Mqtt:
         'Connection refused - not authorised',  # 5
     ]
 
+    _log = get_logger(__name__, False)  # for classmethods
+
     def __init__(self, user, pw, host=DEF_HOST, port=DEF_PORT,
-                 debug=False):
+                 pub_window=DEF_PUB_WINDOW, codec=DEF_CODEC, metrics=None,
+                 spool=None, filters=None, compress=None,
+                 client_id='', clean_session=True,
+                 reconnect_min=DEF_RECONNECT_MIN,
+                 reconnect_max=DEF_RECONNECT_MAX, debug=False):
+        '''
+        spool: MqttSpool, save publishes while disconnected
+
+        filters: {topic_filter: MqttFilter.MsgFilter}
+                 drop rejected messages before the mailbox,
+                 see set_filter()
+
+        compress: MqttCompress.Compressor or algo name
+                  compress large payloads, see compress_stats().
+                  compressed payloads are decompressed on receive,
+                  Compressor(None): decompress only
+
+        clean_session: False: the broker keeps subscriptions and
+                       queues QoS 1, 2 messages while disconnected
+                       (``client_id`` is required)
+
+        reconnect_min, reconnect_max:
+          reconnect automatically with exponential backoff
+          (with jitter) between them [sec]
+        '''
+        if not clean_session and client_id == '':
+            raise ValueError('clean_session=False: client_id is required')
+
         self._debug = debug
         self._log = get_logger(__class__.__name__, self._debug)
         self._log.debug('user=%s, pw=%s, host=%s, port=%d',
                         user, pw, host, port)
+        self._log.debug('pub_window=%s, codec=%s', pub_window, codec)
+        self._log.debug('metrics=%s, spool=%s, filters=%s',
+                        metrics, spool, filters)
+        self._log.debug('compress=%s', compress)
+        self._log.debug('client_id=%s, clean_session=%s',
+                        client_id, clean_session)
+        self._log.debug('reconnect_min=%s, reconnect_max=%s',
+                        reconnect_min, reconnect_max)
 
         self._user = user
         self._pw = pw
@@ -59,14 +153,55 @@ class Mqtt:
         self._svr_port = port
 
         self._subsc_topics = []
-        self._msgq = queue.Queue()
+
+        self._codecs = TopicCodecs(codec)
+
+        self._filters = FilterSet(filters)
+        self._compress = get_compressor(compress)
+
+        # mailboxes: {msg_type: Queue, (MSG_DATA, topic): Queue}
+        self._mbox = {}
+        self._mbox_lock = threading.Lock()
+
+        # pipelined publish
+        self._pub_window = pub_window
+        self._pub_inflight = 0
+        self._pub_pending = {}  # {mid: PubHandle}
+        self._pub_acked = set()  # mids acked before registered
+        self._pub_dropped = set()  # mids released on publish error
+        self._pub_cond = threading.Condition()
+
+        self._spool = spool
+
+        # MqttStats.Metrics
+        self.metrics = metrics
+        if self.metrics is not None:
+            self.metrics.gauge_func('msgq_depth', self.mbox_depth)
+            self.metrics.gauge_func('publish_inflight',
+                                    lambda: self._pub_inflight)
+            if self._spool is not None:
+                self.metrics.gauge_func('spool_pending', self._spool.pending)
+        self._n_connect = 0
+        self._connected = False
+
+        # auto reconnect
+        self._reconnect_min = reconnect_min
+        self._reconnect_max = reconnect_max
+        self._backoff = 0
+        self._t_discon = None   # time of unexpected disconnect
+        self._n_discon = 0
+        self._n_recover = 0
+        self._recover_sec = []  # [sec, ..] last RECOVER_HIST
 
         self._connecting = False
         self._disconnecting = False
         self._subscribing = False
 
-        self._mqttc = mqtt.Client()
+        self._mqttc = mqtt.Client(client_id=client_id,
+                                  clean_session=clean_session)
         self._mqttc.username_pw_set(self._user, self._pw)
+        self._mqttc.max_inflight_messages_set(self._pub_window)
+        self._mqttc.reconnect_delay_set(reconnect_min, reconnect_max)
 
         # self._mqttc.enable_logger()
         # self._mqttc.on_log = self.on_log
@@ -76,13 +211,26 @@ class Mqtt:
         self._mqttc.on_unsubscribe = self.on_unsubscribe
         self._mqttc.on_publish = self.on_publish
         self._mqttc.on_message = self.on_message
+        self._mqttc.on_connect_fail = self.on_connect_fail
 
         self._loop_active = False
 
-    def start(self):
-        self._log.debug('')
+    def start(self, wait=True):
+        '''
+        wait: False: return immediately, connect in background
+                     (retry until connected)
+
+        return: see ``connect()``, 0 if not ``wait``
+        '''
+        self._log.debug('wait=%s', wait)
 
         self._loop_active = True
+
+        if not wait:
+            self._mqttc.connect_async(self._svr_host, self._svr_port)
+            self._mqttc.loop_start()
+            return 0
+
         self._mqttc.loop_start()
         ret = self.connect()
 
@@ -93,6 +241,10 @@ class Mqtt:
         self._log.debug('')
 
         self._loop_active = False
+        with self._pub_cond:
+            self._pub_cond.notify_all()  # wake up publish window waiters
+        if self._spool is not None:
+            self._spool.stop_drain()
         self.disconnect()
         self._mqttc.loop_stop()
 
@@ -109,6 +261,8 @@ class Mqtt:
         self._log.debug('keepalive=%s', keepalive)
 
         self._connecting = True
+        # SUBACK may arrive before CONNACK is picked up
+        self._subscribing = len(self._subsc_topics) > 0
         self._mqttc.connect(self._svr_host, self._svr_port,
                             keepalive=keepalive)
 
@@ -124,7 +278,6 @@ class Mqtt:
             return ret
 
         if len(self._subsc_topics) > 0:
-            self._subscribing = True
             t, d = self.wait_msg(self.MSG_SUB)
             self._log.debug('%s, %s', t, d)
             if t == self.MSG_SUB:
@@ -164,54 +317,305 @@ class Mqtt:
         return t, d
 
     def recv_data(self, topic):
-        self._log.debug('topic=%s', topic)
+        while True:
+            t, d = self.wait_msg(self.MSG_DATA, topic)
+
+            if t != self.MSG_DATA:
+                self._log.info('done: (%s, %s), _loop_active=%s'
+                               ' .. return None',
+                               t, d, self._loop_active)
+                return None
 
-        while self._loop_active:
             try:
-                t, d = self.wait_msg(self.MSG_DATA)
-                self._log.debug('t=%s, d=%s', t, d)
+                payload = d.payload
+            except Exception as e:
+                self._log.warning('%s: %s:%s', d, type(e).__name__, e)
+                continue
 
-                if d['topic'] == topic:
-                    self._log.debug('done .. return %s', d['payload'])
-                    return d['payload']
+            if self._debug:
+                self._log.debug('topic=%s: return %s', topic, payload)
+            return payload
 
-            except Exception as e:
-                self._log.debug('%s:%s .. return None', type(e).__name__, e)
-                return None
+    def publish(self, topic, payload, qos=DEF_QOS, retain=False):
+        '''
+        publish and wait for the ack of this message
 
-            self.put_msg(t, d)
-            time.sleep(random.random())
+        return: (msg_type, msg_data)
+          (MSG_PUB, {'mid': mid}): OK
+          (MSG_ERR, 'message'):    publish error
+          (MSG_NONE, None):        loop stopped
+        '''
+        h = self.publish_async(topic, payload, qos=qos, retain=retain)
 
-        self._log.info('done: _loop_active=%s .. return None',
-                       self._loop_active)
-        return None
+        while self._loop_active and not h.done():
+            h.wait(self.WAIT_TIMEOUT)
 
-    def publish(self, topic, payload, qos=DEF_QOS, retain=False):
-        self._log.debug('topic=%s, payload=%s, qos=%d, retain=%s',
-                        topic, payload, qos, retain)
+        if not h.done():
+            (t, d) = (self.MSG_NONE, None)
+        elif h.rc != 0:
+            (t, d) = (self.MSG_ERR, 'publish(%s): rc=%s' % (topic, h.rc))
+        else:
+            (t, d) = (self.MSG_PUB, {'mid': h.mid})
+
+        if self._debug:
+            self._log.debug('done: (%s, %s)', t, d)
+        return t, d
+
+    def publish_async(self, topic, payload, qos=DEF_QOS, retain=False):
+        '''
+        publish without waiting for the ack.
 
-        msg_payload = json.dumps(payload).encode('utf-8')
-        self._log.debug('msg_payload=%s', msg_payload)
+        Blocks only while ``pub_window`` messages are in flight.
+
+        return: PubHandle
+        '''
+        msg_payload = self.topic_codec(topic).encode(payload)
+        if self._compress is not None:
+            msg_payload = self._compress.compress(topic, msg_payload)
+        if self._debug:
+            self._log.debug('topic=%s, msg_payload=%s, qos=%d, retain=%s',
+                            topic, msg_payload, qos, retain)
+
+        if self._spool is not None and not self._connected:
+            return self._spool_put(topic, msg_payload, qos, retain)
+
+        h = self._publish_bytes(topic, msg_payload, qos, retain)
+
+        # disconnected but on_disconnect() is not called yet.
+        # (QoS 1, 2 messages are kept by paho on MQTT_ERR_NO_CONN)
+        if (self._spool is not None and h.rc is not None and h.rc != 0 and
+                (qos == 0 or h.rc != mqtt.MQTT_ERR_NO_CONN)):
+            self._log.warning('publish(%s): rc=%s: spooled', topic, h.rc)
+            h = self._spool_put(topic, msg_payload, qos, retain)
+        return h
+
+    def _spool_put(self, topic, msg_payload, qos, retain):
+        '''
+        return: PubHandle (spooled)
+        '''
+        self._spool.put(topic, msg_payload, qos, retain)
+        if self.metrics is not None:
+            self.metrics.inc('spooled_total')
+
+        # connected meanwhile (or rc != 0 while connected):
+        # on_connect() may have missed this record
+        if self._connected and self._loop_active:
+            self._spool.start_drain(self._spool_publish)
+
+        h = PubHandle(None, topic)
+        h.spooled = True
+        h._set_rc(0)
+        return h
+
+    def _publish_bytes(self, topic, msg_payload, qos, retain):
+        '''
+        return: PubHandle
+        '''
+        with self._pub_cond:
+            while self._loop_active and self._pub_inflight >= self._pub_window:
+                self._pub_cond.wait(self.WAIT_TIMEOUT)
+            self._pub_inflight += 1
 
         ret = self._mqttc.publish(topic, msg_payload, qos=qos, retain=retain)
         if ret.rc != 0:
             self._log.error('_mqttc.publish(%s): failed(%s)', topic, ret)
 
-        t, d = self.wait_msg(self.MSG_PUB)
-        self._log.debug('done: (%s, %s)', t, d)
-        return t, d
+        if self.metrics is not None:
+            if ret.rc != 0:
+                self.metrics.inc('publish_failures_total')
+            else:
+                self.metrics.inc('published_total')
+                self.metrics.inc('published_bytes_total', len(msg_payload))
+
+        h = PubHandle(ret.mid, topic)
+        with self._pub_cond:
+            if ret.rc != 0:
+                # release the slot, the ack may never come
+                if qos > 0:
+                    self._pub_dropped.add(ret.mid)
+                self._pub_done(h, ret.rc)
+            elif ret.mid in self._pub_acked:
+                self._pub_acked.remove(ret.mid)
+                self._pub_done(h, 0)
+            else:
+                self._pub_pending[ret.mid] = h
+
+        return h
+
+    def flush(self, timeout=None):
+        '''
+        wait until all in-flight publishes are acked
 
-    def set_subscribe(self, topics):
-        self._log.debug('topics=%s', topics)
+        return: True if nothing is in flight
+        '''
+        self._log.debug('timeout=%s', timeout)
+
+        if timeout is not None:
+            timeout = time.monotonic() + timeout
+
+        with self._pub_cond:
+            while self._loop_active and self._pub_inflight > 0:
+                wait_sec = self.WAIT_TIMEOUT
+                if timeout is not None:
+                    wait_sec = min(wait_sec, timeout - time.monotonic())
+                    if wait_sec <= 0:
+                        break
+                self._pub_cond.wait(wait_sec)
+
+            ret = self._pub_inflight == 0
+
+        self._log.debug('done: ret=%s', ret)
+        return ret
+
+    def _spool_publish(self, records):
+        '''
+        publish records from ``MqttSpool`` and wait for acks
+
+        return: True if all records are delivered
+        '''
+        hs = []
+        for (topic, msg_payload, qos, retain) in records:
+            if not self._connected or not self._spool.draining:
+                return False
+            hs.append(self._publish_bytes(topic, msg_payload, qos, retain))
+
+        for h in hs:
+            deadline = time.monotonic() + self.SPOOL_ACK_TIMEOUT
+            while not h.done():
+                if (not self._spool.draining or
+                        time.monotonic() >= deadline):
+                    return False
+                h.wait(self.SPOOL_WAIT_SEC)
+            if h.rc != 0:
+                self._log.warning('%s', h)
+                return False
+        return True
+
+    def reconnect_stats(self):
+        '''
+        return: {'connected', 'disconnects', 'recovered',
+                 'last_sec', 'max_sec', 'mean_sec'}
+          *_sec: time from disconnect to reconnect
+        '''
+        secs = list(self._recover_sec)
+        return {'connected': self._connected,
+                'disconnects': self._n_discon,
+                'recovered': self._n_recover,
+                'last_sec': secs[-1] if secs else None,
+                'max_sec': max(secs) if secs else None,
+                'mean_sec': sum(secs) / len(secs) if secs else None}
+
+    def _next_backoff(self):
+        '''
+        set the delay of the next reconnect
+        (exponential backoff, random in [backoff/2, backoff])
+        '''
+        if self._backoff == 0:
+            self._backoff = self._reconnect_min
+        else:
+            self._backoff = min(self._backoff * 2, self._reconnect_max)
+
+        delay = random.uniform(self._backoff / 2, self._backoff)
+        self._mqttc.reconnect_delay_set(delay, delay)
+        self._log.debug('delay=%.2f', delay)
+
+    def _pub_done(self, h, rc):
+        '''
+        call with ``_pub_cond`` held
+        '''
+        h._set_rc(rc)
+        self._pub_inflight -= 1
+        self._pub_cond.notify_all()
+
+    def set_codec(self, topic_filter, codec):
+        '''
+        topic_filter: topic or filter (``+``, ``#``)
+                      a literal topic wins, then the longest filter
+        codec:        Codec object or name, None: default codec
+        '''
+        self._log.debug('topic_filter=%s, codec=%s', topic_filter, codec)
+        self._codecs.set(topic_filter, codec)
+
+    def topic_codec(self, topic):
+        return self._codecs.get(topic)
+
+    def set_filter(self, topic_filter, msg_filter):
+        '''
+        drop messages of ``topic_filter`` rejected by ``msg_filter``
+        on the network thread
+
+        msg_filter: MqttFilter.MsgFilter, None: remove
+        '''
+        self._log.debug('topic_filter=%s, msg_filter=%s',
+                        topic_filter, msg_filter)
+        self._filters.set(topic_filter, msg_filter)
+
+    def compress_stats(self):
+        '''
+        return: {topic: {'msgs', 'compressed', 'ratio', 'compress_sec', ..}}
+          see MqttCompress.Compressor.stats()
+        '''
+        if self._compress is None:
+            return {}
+        return self._compress.stats()
+
+    def filter_stats(self):
+        '''
+        return: {'filtered', 'filters': {topic_filter: MsgFilter.stats()}}
+        '''
+        return self._filters.stats()
+
+    def set_subscribe(self, topics, msg_filter=None):
+        '''
+        msg_filter: set to each topic, see set_filter()
+        '''
+        self._log.debug('topics=%s, msg_filter=%s', topics, msg_filter)
         self._subsc_topics = topics
 
-    def do_subscribe(self, topics, qos=DEF_QOS):
-        self._log.debug('topics=%s, qos=%d', topics, qos)
+        if msg_filter is not None:
+            for t in (topics if type(topics) == list else [topics]):
+                self.set_filter(t, msg_filter)
+
+    def add_subscribe(self, topics):
+        '''
+        add ``topics`` to the topics of set_subscribe(),
+        topics already there are not added again
+
+        return: [topic, ..] added
+        '''
+        self._log.debug('topics=%s', topics)
+
+        cur = self.subsc_topics
+        ret = [t for t in dict.fromkeys(
+            topics if type(topics) == list else [topics]) if t not in cur]
+        if len(ret) > 0:
+            self._subsc_topics = cur + ret
+        return ret
+
+    @property
+    def subsc_topics(self):
+        '''
+        return: [topic, ..] (resubscribed on reconnect)
+        '''
+        if type(self._subsc_topics) != list:
+            return [self._subsc_topics]
+        return list(self._subsc_topics)
+
+    def do_subscribe(self, topics, qos=DEF_QOS, msg_filter=None):
+        '''
+        msg_filter: set to each topic, see set_filter()
+        '''
+        self._log.debug('topics=%s, qos=%d, msg_filter=%s',
+                        topics, qos, msg_filter)
 
         if type(topics) != list:
             topics = [topics]
             self._log.debug('topics=%s', topics)
 
+        if msg_filter is not None:
+            for t in topics:
+                self.set_filter(t, msg_filter)
+
         if len(topics) == 0:
             self._log.warning('do nothing')
             return
@@ -238,81 +642,106 @@ class Mqtt:
         t, d = self.wait_msg(self.MSG_UNSUB)
         self._log.debug('done: (%s, %s)', t, d)
 
-    def wait_msg(self, wait_msg_type):
-        self._log.debug('wait_msg_type=%s, _loop_active=%s',
-                        wait_msg_type, self._loop_active)
+    def wait_msg(self, wait_msg_type, topic=None):
+        '''
+        wait for a message in the mailbox of ``wait_msg_type``
+        (and ``topic`` for MSG_DATA).
+
+        Other messages are never consumed here, so there is
+        no need to put them back.
+        '''
+        if self._debug:
+            self._log.debug('wait_msg_type=%s, topic=%s, _loop_active=%s',
+                            wait_msg_type, topic, self._loop_active)
 
         (t, d) = (self.MSG_NONE, None)
 
         while self._loop_active:
-            t, d = self.get_msg(timeout=2)
+            t, d = self.get_msg(wait_msg_type, topic,
+                                timeout=self.WAIT_TIMEOUT)
 
-            if t == wait_msg_type:
-                self._log.debug('done: (%s, %s)', t, d)
-                return t, d
+            if t == self.MSG_NONE:
+                continue
 
-            # t != wait_msg_type
+            return t, d
 
-            '''
-            if wait_msg_type == self.MSG_DATA:
-                # if t == self.MSG_DISCON or t == self.MSG_CON
-                if t in  [self.MSG_DISCON, self.MSG_CON,
-                          self.MSG_SUB]:
-                    self._log.warning('Ignored: %s, %s', t, d)
-                    continue
-            '''
+        self._log.debug('done: (%s, %s)', t, d)
+        return t, d
 
-            if t == self.MSG_CON:
-                if not self._connecting:
-                    self._log.warning('_connecting=%s .. Ignored: %s, %s',
-                                      self._connecting, t, d)
-                    continue
+    def put_msg(self, msg_type, msg_data):
+        '''
+        route a message to its mailbox.
 
-            if t == self.MSG_DISCON:
-                if not self._disconnecting:
-                    self._log.warning('_disconnecting=%s .. Ignored: %s, %s',
-                                      self._disconnecting, t, d)
-                    continue
+        MSG_DATA goes to the mailbox of its topic,
+        MSG_ERR goes to every mailbox to wake up all waiters.
+        '''
+        if self._debug:
+            self._log.debug('msg_type=%s, msg_data=%s', msg_type, msg_data)
 
-            if t == self.MSG_SUB:
-                if not self._subscribing:
-                    self._log.warning('_subscribing=%s .. Ignored: %s, %s',
-                                      self._subscribing, t, d)
-                    continue
+        if msg_type == self.MSG_CON and not self._connecting:
+            self._log.warning('_connecting=%s .. Ignored: %s, %s',
+                              self._connecting, msg_type, msg_data)
+            return
+
+        if msg_type == self.MSG_DISCON and not self._disconnecting:
+            self._log.warning('_disconnecting=%s .. Ignored: %s, %s',
+                              self._disconnecting, msg_type, msg_data)
+            return
 
-            if t == self.MSG_ERR:
-                self._log.debug('done: (%s, %s)', t, d)
-                return t, d
+        if msg_type == self.MSG_SUB and not self._subscribing:
+            self._log.warning('_subscribing=%s .. Ignored: %s, %s',
+                              self._subscribing, msg_type, msg_data)
+            return
 
-            if t == self.MSG_NONE:
-                continue
+        msg = (msg_type, msg_data)
 
-            sleep_sec = random.random()
-            self._log.debug('waiting %s .. Skip: %s, %s .. sleep %.2f sec ..',
-                            wait_msg_type, t, d, sleep_sec)
-            self.put_msg(t, d)
-            (t, d) = (self.MSG_NONE, None)
-            time.sleep(random.random())
+        if msg_type == self.MSG_ERR:
+            with self._mbox_lock:
+                mboxes = list(self._mbox.values())
+            for mbox in mboxes:
+                mbox.put(msg)
+            return
 
-        self._log.debug('done: (%s, %s)', t, d)
-        return t, d
+        topic = None
+        if msg_type == self.MSG_DATA:
+            topic = msg_data['topic']
 
-    def put_msg(self, msg_type, msg_data):
-        self._log.debug('msg_type=%s, msg_data=%s', msg_type, msg_data)
-        
-        msg = {'type': msg_type, 'data': msg_data}
-        self._log.debug('%s', msg)
-        self._msgq.put(msg)
-
-    def get_msg(self, block=True, timeout=None):
-        # self._log.debug('block=%s, timeout=%s', block, timeout)
+        self.mbox(msg_type, topic).put(msg)
+
+    def get_msg(self, msg_type, topic=None, block=True, timeout=None):
+        # self._log.debug('msg_type=%s, topic=%s, block=%s, timeout=%s',
+        #                 msg_type, topic, block, timeout)
         try:
-            msg = self._msgq.get(block=block, timeout=timeout)
+            msg = self.mbox(msg_type, topic).get(block=block,
+                                                 timeout=timeout)
         except queue.Empty:
-            msg = {'type': self.MSG_NONE, 'data': None}
+            msg = (self.MSG_NONE, None)
 
         # self._log.debug('%s', msg)
-        return msg['type'], msg['data']
+        return msg
+
+    def mbox(self, msg_type, topic=None):
+        '''
+        return: queue.Queue
+          mailbox for ``msg_type`` (and ``topic`` for MSG_DATA)
+        '''
+        key = msg_type
+        if msg_type == self.MSG_DATA:
+            key = (msg_type, topic)
+
+        mbox = self._mbox.get(key)
+        if mbox is None:
+            with self._mbox_lock:
+                mbox = self._mbox.setdefault(key, queue.Queue())
+        return mbox
+
+    def mbox_depth(self):
+        '''
+        return: number of messages in all mailboxes
+        '''
+        with self._mbox_lock:
+            mboxes = list(self._mbox.values())
+        return sum(mbox.qsize() for mbox in mboxes)
 
     def on_log(self, client, userdata, level, buf):
         self._log.debug('userdata=%s, level=%d, buf=%s',
@@ -321,14 +750,67 @@ class Mqtt:
     def on_connect(self, client, userdata, flag, rc):
         self._log.debug('userdata=%s, flag=%s, rc=%s', userdata, flag, rc)
 
-        ret = self.do_subscribe(self._subsc_topics)
-        self._log.debug('do_subscript(%s) ==> %s', self._subsc_topics, ret)
+        if rc != 0:
+            if not self._connecting:
+                self._log.warning('reconnect: rc=%s', rc)
+                self._next_backoff()
+                return
+            self.put_msg(self.MSG_CON, {'rc': rc, 'flag': flag})
+            return
 
-        self.put_msg(self.MSG_CON, {'rc': rc, 'flag': flag})
+        self._connected = True
+        self._n_connect += 1
+        if self._n_connect > 1 and self.metrics is not None:
+            self.metrics.inc('reconnects_total')
+
+        self._backoff = 0
+        self._mqttc.reconnect_delay_set(self._reconnect_min,
+                                        self._reconnect_max)
+
+        if self._t_discon is not None:
+            sec = time.monotonic() - self._t_discon
+            self._t_discon = None
+            self._n_recover += 1
+            self._recover_sec = self._recover_sec[-(self.RECOVER_HIST - 1):]
+            self._recover_sec.append(sec)
+            self._log.info('connected: %.3f sec after disconnect', sec)
+            if self.metrics is not None:
+                self.metrics.observe('reconnect_seconds', sec)
+
+        if not flag.get('session present') and len(self._subsc_topics) > 0:
+            ret = self.do_subscribe(self._subsc_topics)
+            self._log.debug('do_subscript(%s) ==> %s',
+                            self._subsc_topics, ret)
+        elif self._subscribing:
+            # the broker kept subscriptions, no SUBACK
+            self.put_msg(self.MSG_SUB, {'mid': None, 'qos': []})
+
+        if self._spool is not None and self._spool.pending() > 0:
+            self._spool.start_drain(self._spool_publish)
+
+        if self._connecting:
+            self.put_msg(self.MSG_CON, {'rc': rc, 'flag': flag})
         self._log.debug('done')
 
+    def on_connect_fail(self, client, userdata):
+        self._log.debug('userdata=%s', userdata)
+        self._next_backoff()
+
     def on_disconnect(self, client, userdata, rc):
         self._log.debug('userdata=%s, rc=%s', userdata, rc)
+        self._connected = False
+
+        if rc != 0 and self.metrics is not None:
+            self.metrics.inc('disconnects_total')
+
+        if not self._disconnecting:
+            # unexpected: paho reconnects after the backoff
+            if self._t_discon is None:
+                self._t_discon = time.monotonic()
+                self._n_discon += 1
+                self._log.warning('disconnected: rc=%s', rc)
+            self._next_backoff()
+            return
 
         '''
         if rc != 0:
@@ -342,6 +824,13 @@ class Mqtt:
     def on_subscribe(self, client, userdata, mid, granted_qos):
         self._log.debug('userdata=%s, mid=%s, granted_qos=%s',
                         userdata, mid, granted_qos)
+        if not self._subscribing:
+            # resubscribed
+            for q in granted_qos:
+                if q > 2:
+                    self._log.error('subscribe(%s): failed, qos=%s',
+                                    self._subsc_topics, granted_qos)
+            return
         self.put_msg(self.MSG_SUB, {'mid': mid, 'qos': granted_qos})
         self._log.debug('done')
 
@@ -351,62 +840,248 @@ class Mqtt:
         self._log.debug('done')
 
     def on_message(self, client, userdata, msg):
-        self._log.debug('userdata=%s, msg.payload=%s', userdata, msg.payload)
-
         topic = msg.topic
-        self._log.debug('topic=%s', topic)
-        try:
-            payload = json.loads(msg.payload.decode('utf-8'))
-        except Exception as e:
-            self._log.warning('%s:%s', type(e).__name__, e)
-            
-        self._log.debug('payload=%s', payload)
-
-        msg_data = {'topic': topic, 'payload': payload}
-        self.put_msg(self.MSG_DATA, msg_data)
-        self._log.debug('done')
+        if self._debug:
+            self._log.debug('userdata=%s, topic=%s, msg.payload=%s',
+                            userdata, topic, msg.payload)
+
+        if self.metrics is not None:
+            self.metrics.inc('received_total')
+            self.metrics.inc('received_bytes_total', len(msg.payload))
+
+        raw = msg.payload
+        if self._compress is not None:
+            raw = self._compress.decompress(topic, raw)
+
+        # decoded when d['payload'] is accessed
+        m = MqttMsg(topic, raw, self.topic_codec(topic),
+                    msg.timestamp, msg.qos, msg.retain)
+
+        if len(self._filters) > 0 and not self._filters.accept(m):
+            if self.metrics is not None:
+                self.metrics.inc('filtered_total')
+            return
+
+        self.mbox(self.MSG_DATA, topic).put((self.MSG_DATA, m))
 
     def on_publish(self, client, userdata, mid):
-        self._log.debug('userdata=%s, mid=%s', userdata, mid)
-        self.put_msg(self.MSG_PUB, {'mid': mid})
-        self._log.debug('done')
+        if self._debug:
+            self._log.debug('userdata=%s, mid=%s', userdata, mid)
+
+        with self._pub_cond:
+            h = self._pub_pending.pop(mid, None)
+            if h is None and mid in self._pub_dropped:
+                # sent by paho after reconnect, already released
+                self._pub_dropped.remove(mid)
+            elif h is None:
+                # acked before publish_async() registered it
+                self._pub_acked.add(mid)
+            else:
+                self._pub_done(h, 0)
+
+    @classmethod
+    def load_conf(cls, conf_file=None):
+        '''
+        conf_file: None: ``find_conf()``
 
-    def load_conf(self):
-        self._log.debug('')
+        return: [{'host', 'port', 'topic', 'user', 'pw'}, ..]
+                None if no conf file
+        '''
+        cls._log.debug('conf_file=%s', conf_file)
 
-        conf_file = self.find_conf()
-        self._log.debug('conf_file=%s', conf_file)
+        if conf_file is None:
+            conf_file = cls.find_conf()
+            cls._log.debug('conf_file=%s', conf_file)
         if conf_file is None:
             return None
 
+        conf = []
         with open(conf_file, 'r') as f:
             csv_reader = csv.reader(f, skipinitialspace=True, quotechar='"')
             for row in csv_reader:
-                # self._log.debug('row=%s', row)
-                if row[0].startswith('#'):
+                # cls._log.debug('row=%s', row)
+                if len(row) == 0 or row[0].startswith('#'):
                     continue
                 while len(row) < 5:
                     row.append('')
                 conf_ent = {'host': row[0], 'port': int(row[1]),
                             'topic': row[2],
                             'user': row[3], 'pw': row[4]}
-                # self._log.debug('conf_ent=%s', conf_ent)
-                self._conf.append(conf_ent)
+                # cls._log.debug('conf_ent=%s', conf_ent)
+                conf.append(conf_ent)
 
-        self._log.debug('done: _conf=%s', self._conf)
-        return self._conf
+        cls._log.debug('done: conf=%s', conf)
+        return conf
 
-    def find_conf(self):
-        self._log.debug('')
+    @classmethod
+    def find_conf(cls):
+        cls._log.debug('')
 
-        for dir in self.CONF_PATH:
-            for fname in self.CONF_FILENAME:
+        for dir in cls.CONF_PATH:
+            for fname in cls.CONF_FILENAME:
                 pathname = dir + '/' + fname
                 if os.path.isfile(pathname) or os.path.islink(pathname):
                     return pathname
         return None
 
 
+class MqttRouter:
+    '''
+    route publishes and subscriptions to brokers by topic prefix
+
+    conf (rows of ``mqtt.conf``):
+      host, port, topic, user, pw
+
+    ``topic`` is a prefix of topic levels ('ch1' matches 'ch1/res1'),
+    the longest one is used. '' or '#' is the default route.
+    Connections are shared by the routes with the same
+    (host, port, user, pw), and connected at the first use.
+    '''
+    def __init__(self, conf=None, conf_file=None, debug=False, **opts):
+        '''
+        conf: [{'host', 'port', 'topic', 'user', 'pw'}, ..]
+              None: ``Mqtt.load_conf(conf_file)``
+        opts: options of ``Mqtt`` (codec, pub_window, ..)
+        '''
+        self._debug = debug
+        self._log = get_logger(__class__.__name__, self._debug)
+        self._log.debug('conf=%s, conf_file=%s, opts=%s',
+                        conf, conf_file, opts)
+
+        if conf is None:
+            conf = Mqtt.load_conf(conf_file)
+            if conf is None:
+                raise FileNotFoundError('mqtt.conf: not found')
+        self._opts = opts
+
+        self._index = {}  # {(level, ..): conf_ent}
+        for ent in conf:
+            key = self.prefix(ent['topic'])
+            if key in self._index:
+                self._log.warning('%a: duplicated .. ignored', ent)
+                continue
+            self._index[key] = ent
+        self._max_depth = max([len(k) for k in self._index], default=0)
+
+        self._conns = {}  # {(host, port, user, pw): Mqtt}
+        self._conns_lock = threading.Lock()
+
+    @staticmethod
+    def prefix(topic):
+        '''
+        return: (level, ..) before the first wildcard
+        '''
+        levels = []
+        for lv in topic.split('/'):
+            if lv in ('+', '#'):
+                break
+            levels.append(lv)
+        if levels == ['']:
+            return ()
+        return tuple(levels)
+
+    def route(self, topic):
+        '''
+        return: conf entry
+        raise:  KeyError
+        '''
+        levels = self.prefix(topic)
+        for i in range(min(len(levels), self._max_depth), -1, -1):
+            ent = self._index.get(levels[:i])
+            if ent is not None:
+                return ent
+        raise KeyError('no route: %a' % topic)
+
+    def conn(self, topic):
+        '''
+        return: Mqtt for ``topic`` (connected)
+        raise:  KeyError, ConnectionError
+        '''
+        ent = self.route(topic)
+        key = (ent['host'], ent['port'], ent['user'], ent['pw'])
+
+        conn = self._conns.get(key)
+        if conn is not None:
+            return conn
+
+        with self._conns_lock:
+            conn = self._conns.get(key)
+            if conn is None:
+                self._log.debug('connect: %s:%s, user=%s',
+                                ent['host'], ent['port'], ent['user'])
+                conn = Mqtt(ent['user'], ent['pw'], ent['host'], ent['port'],
+                            debug=self._debug, **self._opts)
+                try:
+                    ret = conn.start()
+                except Exception:
+                    conn.end()  # stop the loop thread
+                    raise
+                if ret != 0:
+                    conn.end()
+                    raise ConnectionError('%s:%s: connect error: %s' % (
+                        ent['host'], ent['port'], ret))
+                self._conns[key] = conn
+        return conn
+
+    def end(self):
+        self._log.debug('')
+
+        with self._conns_lock:
+            conns = list(self._conns.values())
+            self._conns = {}
+        for conn in conns:
+            conn.end()
+
+        self._log.debug('done')
+
+    def send_data(self, topic, data):
+        return self.conn(topic).send_data(topic, data)
+
+    def recv_data(self, topic):
+        return self.conn(topic).recv_data(topic)
+
+    def publish(self, topic, payload, qos=Mqtt.DEF_QOS, retain=False):
+        return self.conn(topic).publish(topic, payload, qos, retain)
+
+    def publish_async(self, topic, payload, qos=Mqtt.DEF_QOS, retain=False):
+        return self.conn(topic).publish_async(topic, payload, qos, retain)
+
+    def get_msg(self, msg_type, topic=None, block=True, timeout=None):
+        '''
+        topic: required (routing)
+        '''
+        return self.conn(topic).get_msg(msg_type, topic, block, timeout)
+
+    def subscribe(self, topics, qos=Mqtt.DEF_QOS, msg_filter=None):
+        '''
+        subscribe ``topics`` on their brokers
+        (resubscribed on reconnect)
+
+        msg_filter: MqttFilter.MsgFilter, see Mqtt.set_filter()
+        '''
+        self._log.debug('topics=%s, qos=%s, msg_filter=%s',
+                        topics, qos, msg_filter)
+
+        if type(topics) != list:
+            topics = [topics]
+
+        groups = {}  # {Mqtt: [topic, ..]}
+        for t in dict.fromkeys(topics):
+            groups.setdefault(self.conn(t), []).append(t)
+
+        for conn, ts in groups.items():
+            conn.add_subscribe(ts)
+            conn.do_subscribe(ts, qos, msg_filter)
+
+    def flush(self, timeout=None):
+        '''
+        return: True if nothing is in flight
+        '''
+        with self._conns_lock:
+            conns = list(self._conns.values())
+        return all([conn.flush(timeout) for conn in conns])
+
+
 class MqttApp:
     def __init__(self, user, pw, host, port, topic, debug=False):
         self._debug = debug
@@ -478,8 +1153,56 @@ class MqttApp:
         self._log.debug('done')
 
 
+RPC_ID = 'rpc_id'
+RPC_DATA = 'data'
+
+
+def rpc_wrap(rpc_id, data):
+    '''
+    return: {RPC_ID: rpc_id, RPC_DATA: data}
+    '''
+    return {RPC_ID: rpc_id, RPC_DATA: data}
+
+
+def rpc_unwrap(payload):
+    '''
+    return: (rpc_id, data)
+      rpc_id is None if ``payload`` is not a RPC message
+    '''
+    if isinstance(payload, dict) and RPC_ID in payload:
+        return payload[RPC_ID], payload.get(RPC_DATA)
+    return None, payload
+
+
+def echo_handler(data):
+    '''
+    default request handler of MqttServerApp (dummy)
+
+    A handler must be a module level function when
+    MqttServerApp runs it in worker processes.
+    '''
+    time.sleep(2)  # dummy
+    return data
+
+
 class MqttServerApp:
+    '''
+    workers:
+      0:  handle requests one by one in main()
+      >0: handle requests in a pool of ``workers`` threads
+          (or processes if ``process`` is True)
+    queue_depth:
+      max requests waiting for a worker.
+      main() stops receiving while the pool is full.
+    ordered:
+      True:  reply in the order of requests
+      False: reply as soon as each request is handled
+    '''
+    DEF_QUEUE_DEPTH = 10
+
     def __init__(self, user, pw, host, port, topic_request, topic_reply,
+                 handler=echo_handler, workers=0,
+                 queue_depth=DEF_QUEUE_DEPTH, process=False, ordered=True,
                  debug=False):
         self._debug = debug
         self._log = get_logger(__class__.__name__, self._debug)
@@ -487,11 +1210,32 @@ class MqttServerApp:
                         user, pw, host, port)
         self._log.debug('topic_request=%s, topic_reply=%s',
                         topic_request, topic_reply)
+        self._log.debug('handler=%s, workers=%s, queue_depth=%s',
+                        handler, workers, queue_depth)
+        self._log.debug('process=%s, ordered=%s', process, ordered)
 
         self._mqtt = Mqtt(user, pw, host, port, debug=self._debug)
         self._topic_request = topic_request
         self._topic_reply = topic_reply
 
+        self._handler = handler
+        self._ordered = ordered
+
+        self._pool = None
+        if workers > 0:
+            if process:
+                self._pool = ProcessPoolExecutor(max_workers=workers)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=workers)
+
+            # limit requests in the pool (running + waiting)
+            self._pool_slot = threading.BoundedSemaphore(workers +
+                                                         queue_depth)
+            # futures to reply
+            self._replyq = queue.Queue()
+            self._reply_th = threading.Thread(target=self.replier,
+                                              daemon=True)
+
     def main(self):
         self._log.debug('')
 
@@ -501,6 +1245,9 @@ class MqttServerApp:
             self._log.error('start(): failed')
             return
 
+        if self._pool is not None:
+            self._reply_th.start()
+
         self._active = True
         self._log.info('Ready')
 
@@ -508,19 +1255,12 @@ class MqttServerApp:
             data = self._mqtt.recv_data(self._topic_request)
             self._log.info('recv[%s]: data="%s"', self._topic_request, data)
 
-            #
-            # single thread version
-            #
-            self.handle(data)
-
-            '''
+            rpc_id, data = rpc_unwrap(data)
 
-            #
-            # multi thread version
-            #
-            th = threading.Thread(target=self.handle, args=([data]))
-            th.start()
-            '''
+            if self._pool is None:
+                self.handle(data, rpc_id)
+            else:
+                self.submit(data, rpc_id)
 
         self._log.debug('done')
 
@@ -528,6 +1268,13 @@ class MqttServerApp:
         self._log.info('')
         self._active = False
 
+        if self._pool is not None:
+            self._log.debug('_pool.shutdown() ..')
+            self._pool.shutdown(wait=True)
+            if self._reply_th.is_alive():
+                self._replyq.put(None)
+                self._reply_th.join()
+
         self._mqtt.unsubscribe(self._topic_request)
 
         self._log.debug('_mqtt.end() ..')
@@ -535,12 +1282,53 @@ class MqttServerApp:
 
         self._log.info('done')
 
-    def handle(self, data):
-        time.sleep(2)  # dummy
+    def handle(self, data, rpc_id=None):
+        self.reply(self._handler(data), rpc_id)
+
+    def reply(self, data, rpc_id=None):
+        '''
+        echo ``rpc_id`` back if the request was a RPC message
+        '''
+        self._log.info('send[%s]: data="%s", rpc_id=%s',
+                       self._topic_reply, data, rpc_id)
 
-        self._log.info('send[%s]: data="%s"', self._topic_reply, data)
+        if rpc_id is not None:
+            data = rpc_wrap(rpc_id, data)
         self._mqtt.send_data(self._topic_reply, data)
 
+    def submit(self, data, rpc_id=None):
+        '''
+        run the handler in the pool.
+        block while the pool is full.
+        '''
+        self._log.debug('data=%s, rpc_id=%s', data, rpc_id)
+
+        self._pool_slot.acquire()
+        f = self._pool.submit(self._handler, data)
+
+        if self._ordered:
+            self._replyq.put((f, rpc_id))
+        else:
+            f.add_done_callback(lambda f: self._replyq.put((f, rpc_id)))
+
+    def replier(self):
+        self._log.debug('')
+
+        while True:
+            ent = self._replyq.get()
+            if ent is None:
+                break
+
+            f, rpc_id = ent
+            try:
+                self.reply(f.result(), rpc_id)
+            except Exception as e:
+                self._log.error('%s:%s', type(e).__name__, e)
+            finally:
+                self._pool_slot.release()
+
+        self._log.debug('done')
+
 
 class MqttClientApp:
     def __init__(self, user, pw, host, port, topic_request, topic_reply,
@@ -608,6 +1396,157 @@ class MqttClientApp:
         self._log.debug('done')
 
 
+class MqttRpcClient:
+    '''
+    request/reply client for MqttServerApp
+
+    Every request carries a correlation id (RPC_ID) and the server
+    echoes it in the reply, so that many calls can be in flight
+    on one connection.
+
+    usage:
+      rpc = MqttRpcClient(user, pw, host, port, topic_req, topic_rep)
+      rpc.start()
+      f = rpc.call_async(data)  # concurrent.futures.Future
+      reply = f.result()
+      reply = rpc.call(data)    # blocking
+      rpc.end()
+    '''
+    DEF_TIMEOUT = 10  # sec
+
+    def __init__(self, user, pw, host, port, topic_request, topic_reply,
+                 debug=False):
+        self._debug = debug
+        self._log = get_logger(__class__.__name__, self._debug)
+        self._log.debug('user=%s, pw=%s, host=%s, port=%s,',
+                        user, pw, host, port)
+        self._log.debug('topic_request=%s, topic_reply=%s',
+                        topic_request, topic_reply)
+
+        self._mqtt = Mqtt(user, pw, host, port, debug=self._debug)
+        self._topic_request = topic_request
+        self._topic_reply = topic_reply
+
+        self._id_prefix = uuid.uuid4().hex[:8]
+        self._id_count = itertools.count()
+
+        self._pending = {}  # {rpc_id: (Future, deadline)}
+        self._pending_lock = threading.Lock()
+
+        self._th = threading.Thread(target=self.receiver, daemon=True)
+        self._active = False
+
+    def start(self):
+        self._log.debug('')
+
+        self._mqtt.set_subscribe(self._topic_reply)
+        ret = self._mqtt.start()
+        if ret != 0:
+            self._log.error('start(): failed')
+            return ret
+
+        self._active = True
+        self._th.start()
+
+        self._log.debug('done: ret=%s', ret)
+        return ret
+
+    def end(self):
+        self._log.debug('')
+        self._active = False
+
+        if self._th.is_alive():
+            self._log.debug('join ..')
+            self._th.join()
+
+        with self._pending_lock:
+            pending = self._pending
+            self._pending = {}
+        for f, _ in pending.values():
+            # already running: cancel() would not complete it
+            f.set_exception(ConnectionError('rpc client closed'))
+
+        self._mqtt.unsubscribe(self._topic_reply)
+
+        self._log.debug('_mqtt.end() ..')
+        self._mqtt.end()
+
+        self._log.debug('done')
+
+    def call_async(self, data, timeout=DEF_TIMEOUT, qos=Mqtt.DEF_QOS):
+        '''
+        return: concurrent.futures.Future
+          result():  reply data
+          exception: TimeoutError after ``timeout`` sec
+                     ConnectionError if not started or closed
+        '''
+        rpc_id = '%s-%d' % (self._id_prefix, next(self._id_count))
+        self._log.debug('rpc_id=%s, data=%s, timeout=%s',
+                        rpc_id, data, timeout)
+
+        f = Future()
+        f.set_running_or_notify_cancel()
+        with self._pending_lock:
+            if not self._active or not self._th.is_alive():
+                # nobody would resolve or expire it
+                f.set_exception(ConnectionError('rpc client not running'))
+                return f
+            self._pending[rpc_id] = (f, time.monotonic() + timeout)
+
+        self._mqtt.publish_async(self._topic_request,
+                                 rpc_wrap(rpc_id, data), qos=qos)
+        return f
+
+    def call(self, data, timeout=DEF_TIMEOUT, qos=Mqtt.DEF_QOS):
+        '''
+        return: reply data
+        raise: TimeoutError, ConnectionError
+        '''
+        f = self.call_async(data, timeout, qos)
+        # the receiver expires it, the margin is for a dead receiver
+        return f.result(timeout + Mqtt.WAIT_TIMEOUT)
+
+    def receiver(self):
+        self._log.debug('')
+
+        while self._active:
+            t, d = self._mqtt.get_msg(Mqtt.MSG_DATA, self._topic_reply,
+                                      timeout=Mqtt.WAIT_TIMEOUT / 4)
+            if t == Mqtt.MSG_DATA:
+                try:
+                    self.resolve(d.payload)
+                except Exception as e:
+                    self._log.warning('%s: %s:%s', d, type(e).__name__, e)
+
+            self.expire()
+
+        self._log.debug('done')
+
+    def resolve(self, payload):
+        rpc_id, data = rpc_unwrap(payload)
+
+        with self._pending_lock:
+            ent = self._pending.pop(rpc_id, None)
+
+        if ent is None:
+            # reply to another client or already timed out
+            self._log.debug('rpc_id=%s: ** ignore **', rpc_id)
+            return
+
+        ent[0].set_result(data)
+
+    def expire(self):
+        now = time.monotonic()
+
+        with self._pending_lock:
+            expired = [rpc_id for rpc_id, (f, deadline)
+                       in self._pending.items() if deadline <= now]
+            ents = [self._pending.pop(rpc_id) for rpc_id in expired]
+
+        for f, _ in ents:
+            f.set_exception(TimeoutError('rpc timeout'))
+
+
 @click.command(context_settings=CONTEXT_SETTINGS,
                help='''
 MQTT Common class
@@ -621,9 +1560,19 @@ MQTT Common class
               help='server port')
 @click.option('--mode', '-m', 'mode', type=str, default='',
               help='mode: \'\' or \'s\' or \'c\'')
+@click.option('--workers', '-w', 'workers', type=int, default=0,
+              help='number of workers (server mode)')
+@click.option('--queue_depth', '-q', 'queue_depth', type=int,
+              default=MqttServerApp.DEF_QUEUE_DEPTH,
+              help='max requests waiting for a worker (server mode)')
+@click.option('--process', 'process', is_flag=True, default=False,
+              help='run workers in processes (server mode)')
+@click.option('--unordered', 'unordered', is_flag=True, default=False,
+              help='reply as completed (server mode)')
 @click.option('--debug', '-d', 'debug', is_flag=True, default=False,
               help='debug flag')
-def main(user, mqtt_host, mqtt_port, topic1, topic2, mode, debug):
+def main(user, mqtt_host, mqtt_port, topic1, topic2, mode,
+         workers, queue_depth, process, unordered, debug):
     log = get_logger(__name__, debug=debug)
 
     topic = [topic1] + list(topic2)
@@ -647,7 +1596,10 @@ def main(user, mqtt_host, mqtt_port, topic1, topic2, mode, debug):
             print('topics must be .. {request topic} {reply topic}')
             return
         app = MqttServerApp(user, '', mqtt_host, mqtt_port,
-                            topic[0], topic[1], debug=debug)
+                            topic[0], topic[1],
+                            workers=workers, queue_depth=queue_depth,
+                            process=process, ordered=not unordered,
+                            debug=debug)
 
     if app is None:
         return